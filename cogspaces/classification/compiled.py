@@ -0,0 +1,195 @@
+"""
+Torch-free affine decoder, compiled from a fitted multi-study model.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class CompiledDecoder(object):
+    def __init__(self, coefs, intercepts):
+        """
+        Affine multi-study decoder, evaluated with NumPy only.
+
+        In eval mode, a `MultiStudyClassifier` is an affine map per study
+        followed by a log-softmax. This object holds these maps, so that
+        predicting a batch of maps costs a single matrix product per study.
+        It is obtained with `MultiStudyClassifier.compile`.
+
+        Parameters
+        ----------
+        coefs : Dict[str, np.ndarray]
+            Coefficients of each study, of shape (n_targets, n_features)
+
+        intercepts : Dict[str, np.ndarray]
+            Biases of each study, of shape (n_targets, )
+        """
+        self.coefs = coefs
+        self.intercepts = intercepts
+
+    @property
+    def studies(self):
+        return list(self.coefs.keys())
+
+    @property
+    def n_features(self):
+        return next(iter(self.coefs.values())).shape[1]
+
+    def decision_function(self, X):
+        """
+        Compute the logits for input data (dictionary of study, data)
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray]
+            Dictionary of input data (one array per study).
+
+        Returns
+        -------
+        y: Dict[str, np.ndarray]
+            Logits of each study
+        """
+        logits = {}
+        for study, this_X in X.items():
+            coef = self.coefs[study]
+            this_X = np.asarray(this_X, dtype=coef.dtype)
+            logits[study] = this_X.dot(coef.T)
+            logits[study] += self.intercepts[study]
+        return logits
+
+    def predict_log_proba(self, X):
+        """
+        Predict the log probabilities for input data (dictionary of study, data)
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray]
+            Dictionary of input data (one array per study).
+
+        Returns
+        -------
+        y: Dict[str, np.ndarray]
+            Predicted label log probabilities.
+        """
+        preds = self.decision_function(X)
+        for pred in preds.values():
+            _log_softmax(pred)
+        return preds
+
+    def predict(self, X):
+        """
+        Predict the labels for input data (dictionary of study, data)
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray]
+            Dictionary of input data (one array per study).
+
+        Returns
+        -------
+        y: Dict[str, pd.Dataframe]
+            Predicted label. Must be processed through
+             `cogspaces.preprocessing.MultiTargetEncoder`.
+        """
+        # The softmax does not change the argmax
+        preds = self.decision_function(X)
+        dfs = {}
+        for study, pred in preds.items():
+            dfs[study] = pd.DataFrame(
+                dict(contrast=np.argmax(pred, axis=1), study=0,
+                     study_contrast=0,
+                     subject=0))
+        return dfs
+
+    def predict_iter(self, X, chunk_size=1024):
+        """
+        Predict the labels for input data, chunk by chunk.
+
+        Input and logit buffers are allocated once, so that memory does not
+        grow with the number of samples.
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray or Iterable[np.ndarray]]
+            Dictionary of input data (one array per study). Arrays may be
+            memory-mapped, or given as iterables of 2D chunks.
+
+        chunk_size : int
+            Number of samples processed at once
+
+        Yields
+        ------
+        study : str
+            Study of the chunk
+
+        labels : np.ndarray, shape (n_chunk_samples, )
+            Predicted labels of the next samples of `study`
+        """
+        dtype = next(iter(self.coefs.values())).dtype
+        buffer = np.empty((chunk_size, self.n_features), dtype=dtype)
+        max_targets = max(coef.shape[0] for coef in self.coefs.values())
+        logits_buffer = np.empty((chunk_size * max_targets, ), dtype=dtype)
+        for study, this_X in X.items():
+            coef, intercept = self.coefs[study], self.intercepts[study]
+            logits = logits_buffer[:chunk_size * coef.shape[0]].reshape(
+                chunk_size, coef.shape[0])
+            for chunk in _iter_chunks(this_X, chunk_size):
+                n = chunk.shape[0]
+                np.copyto(buffer[:n], chunk, casting='unsafe')
+                np.dot(buffer[:n], coef.T, out=logits[:n])
+                logits[:n] += intercept
+                yield study, np.argmax(logits[:n], axis=1)
+
+    def save(self, filename):
+        """
+        Save the decoder in a `.npz` file.
+
+        Parameters
+        ----------
+        filename : str
+        """
+        arrays = {'studies': np.array(self.studies)}
+        for i, study in enumerate(self.studies):
+            arrays['coef_%i' % i] = self.coefs[study]
+            arrays['intercept_%i' % i] = self.intercepts[study]
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a decoder saved with `CompiledDecoder.save`.
+
+        Parameters
+        ----------
+        filename : str
+
+        Returns
+        -------
+        decoder : CompiledDecoder
+        """
+        with np.load(filename) as arrays:
+            studies = arrays['studies'].tolist()
+            coefs = {study: arrays['coef_%i' % i]
+                     for i, study in enumerate(studies)}
+            intercepts = {study: arrays['intercept_%i' % i]
+                          for i, study in enumerate(studies)}
+        return cls(coefs, intercepts)
+
+
+def _iter_chunks(X, chunk_size):
+    """Split an array, or an iterable of arrays, in chunks of bounded size."""
+    if hasattr(X, 'iter_chunks'):
+        yield from X.iter_chunks(chunk_size)
+        return
+    if hasattr(X, 'shape'):
+        X = [X]
+    for this_X in X:
+        for start in range(0, this_X.shape[0], chunk_size):
+            yield this_X[start:start + chunk_size]
+
+
+def _log_softmax(logits):
+    """In-place log-softmax along the last axis."""
+    logits -= logits.max(axis=1, keepdims=True)
+    logits -= np.log(np.sum(np.exp(logits), axis=1, keepdims=True))
+    return logits
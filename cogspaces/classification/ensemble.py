@@ -1,17 +1,128 @@
 import copy
+import os
+import shutil
+import tempfile
+import time
+import warnings
+from math import ceil
+from os.path import join
 
 import numpy as np
+import pandas as pd
 import torch
-from joblib import Parallel, delayed, Memory
+from joblib import Parallel, delayed, Memory, effective_n_jobs, dump, \
+    load
+from joblib import hash as compute_hash
 from modl import DictFact
 from sklearn.base import BaseEstimator
 from sklearn.utils import check_random_state
 
+from cogspaces.classification.run_cache import _IGNORED_PARAMS
+from cogspaces.modules.batched import BatchedMultiStudyModules
+from cogspaces.optim import MaskedAdam
+
 
 class EnsembleClassifier(BaseEstimator):
     def __init__(self, estimator, n_jobs=1, seed=None, n_runs=2,
-                 alpha=1e-4, memory=Memory(cachedir=None),
-                 warmup=True):
+                 alpha=1e-4, memory=Memory(location=None),
+                 warmup=True, temp_folder=None, engine='joblib',
+                 runs_per_batch=None, tol=None, max_time=None,
+                 wave_size=10, consolidation='batch', online_epochs=2,
+                 checkpoint=None, run_cache=None):
+        """
+        Ensemble of multi-study models, consolidated by dictionary learning
+        on their embedders.
+
+        Parameters
+        ----------
+        estimator : MultiStudyClassifier
+            Model fitted for each run
+
+        n_jobs : int
+            Number of runs fitted in parallel
+
+        seed : int or None
+            Seed of the seeds of the runs
+
+        n_runs : int
+            Number of runs, or maximum number of runs if `tol` or
+            `max_time` is set
+
+        alpha : float
+            Code regularization of the dictionary learning
+
+        memory : joblib.Memory
+            Cache of the runs and of the consolidation
+
+        warmup : bool
+            Warm up the dictionary learning with a non-sparse pass
+
+        temp_folder : str or None
+            Folder where the training data is shared with the workers, as
+            float32 memory-mapped files. Defaults to `/dev/shm` if
+            available, to the system temporary folder otherwise. The
+            embedder weights of the runs are written in `temp_folder`, or
+            in the system temporary folder.
+
+        engine : str, {'joblib', 'batched'}
+            Fit each run separately ('joblib'), or stack runs along a
+            leading dimension and train them together with batched matrix
+            products ('batched'). The batched engine only supports
+            `sampling='random'` in `estimator`.
+
+        runs_per_batch : int or None
+            Number of runs trained together by the batched engine. Defaults
+            to spreading runs evenly over the `n_jobs` workers.
+
+        tol : float or None
+            Schedule runs in waves of `wave_size`, and stop once the
+            relative change of the mean coefficients of every study, and of
+            the mean singular values of the embedders, over the last wave
+            falls below `tol`
+
+        max_time : float or None
+            Schedule runs in waves of `wave_size`, and stop scheduling new
+            waves after `max_time` seconds
+
+        wave_size : int
+            Number of runs per wave, if `tol` or `max_time` is set
+
+        consolidation : str, {'batch', 'online'}
+            Learn the consolidated embedder once all runs are done
+            ('batch'), or feed the embedder of each run to the dictionary
+            learning as soon as it finishes, followed by `online_epochs`
+            passes over all runs ('online'). The online consolidation is
+            experimental: the batch one performs 20 passes, and the quality
+            of the online components has not been compared to it (see
+            `exps/benchmarks/consolidation.py`)
+
+        online_epochs : int
+            Number of passes over all runs that end the online
+            consolidation
+
+        checkpoint : str or None
+            File where the online dictionary learning is saved after each
+            wave. If it exists when fitting, it is resumed, skipping the
+            runs it has already seen, unless it was saved by a fit with other
+            data or parameters. It is removed once the fit succeeds.
+
+        run_cache : cogspaces.classification.run_cache.RunCache or None
+            Persistent cache of the runs, keyed on the training data, the
+            parameters of `estimator`, the seed and the engine. Runs are
+            reused when only the consolidation parameters (`alpha`, ...) or
+            `n_runs` change. With the batched engine, a run does not depend
+            on the runs it is batched with, and can be cached alike.
+
+        Attributes
+        ----------
+        n_runs_ : int
+            Number of runs performed
+
+        convergence_ : List[Dict]
+            For each wave, the number of runs, elapsed time, and relative
+            changes of the mean coefficients (largest over studies) and of
+            the mean singular values of the embedders
+        """
         self.estimator = estimator
 
         self.n_jobs = n_jobs
@@ -24,6 +135,21 @@ class EnsembleClassifier(BaseEstimator):
 
         self.memory = memory
 
+        self.temp_folder = temp_folder
+
+        self.engine = engine
+        self.runs_per_batch = runs_per_batch
+
+        self.tol = tol
+        self.max_time = max_time
+        self.wave_size = wave_size
+
+        self.consolidation = consolidation
+        self.online_epochs = online_epochs
+        self.checkpoint = checkpoint
+
+        self.run_cache = run_cache
+
     def fit(self, X, y, callback=None):
         self.estimator_ = copy.deepcopy(self.estimator)
         self.estimator_.max_iter = {'pretrain': 0, 'train': 0, 'finetune': 0}
@@ -32,34 +158,48 @@ class EnsembleClassifier(BaseEstimator):
 
         seeds = check_random_state(self.seed).randint(0, np.iinfo('int32').max,
                                                       size=(self.n_runs, ))
-        res = Parallel(n_jobs=self.n_jobs, verbose=10)(
-            delayed(self.memory.cache(_compute_coefs))(
-                self.estimator, X, y, seed) for seed in seeds)
-        embedder_weights, full_coefs, full_biases = zip(*res)
-        embedder_weights = np.concatenate(
-            [embedder_weight.numpy() for embedder_weight in embedder_weights],
-            axis=0)
-        mean_coefs = {
-            study: np.mean(np.concatenate([full_coef[study].numpy()[:, :, None]
-                                           for full_coef in full_coefs],
-                                          axis=2),
-                           axis=2)
-            for study in full_coefs[0]}
-        mean_biases = {
-            study: np.mean(np.concatenate([full_bias[study].numpy()[:, None]
-                                           for full_bias in
-                                           full_biases],
-                                          axis=0),
-                           axis=0)
-            for study in full_coefs[0]}
-        embedder_init = module.get_embedder_init().numpy()
-        embedder_weight = self.memory.cache(_compute_components)(
-            embedder_weights,
-            embedder_init,
-            self.alpha,
-            self.warmup)
+        # Workers receive a handle on data written once, instead of X and y
+        folder = tempfile.mkdtemp(prefix='cogspaces_ensemble_',
+                                  dir=_get_temp_folder(self.temp_folder))
+        # Embedder weights are spilled to disk rather than to shared memory
+        weights_folder = tempfile.mkdtemp(prefix='cogspaces_ensemble_',
+                                          dir=self.temp_folder)
+        try:
+            data = _SharedData(X, y, folder)
+            accumulator = _RunAccumulator(
+                join(weights_folder, 'embedder_weights.dat'),
+                spectrum=self.tol is not None or self.max_time is not None)
+            embedder_init = module.get_embedder_init().numpy()
+            if self.consolidation == 'online':
+                consolidator = self._load_checkpoint(data, embedder_init)
+            elif self.consolidation == 'batch':
+                consolidator = None
+            else:
+                raise ValueError('Wrong value for `consolidation`')
+            self._fit_runs(data, seeds, accumulator, consolidator)
+            shutil.rmtree(folder, ignore_errors=True)
+            mean_coefs = accumulator.mean_coefs
+            mean_biases = accumulator.mean_biases
+            embedder_weights = accumulator.embedder_weights()
+            if consolidator is None:
+                embedder_weight = self.memory.cache(_compute_components)(
+                    embedder_weights,
+                    embedder_init,
+                    self.alpha,
+                    self.warmup)
+            else:
+                embedder_weight = consolidator.finalize(embedder_weights)
+                if (self.checkpoint is not None
+                        and os.path.exists(self.checkpoint)):
+                    os.remove(self.checkpoint)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            shutil.rmtree(weights_folder, ignore_errors=True)
+        # The online consolidation learns in double precision
+        embedder_weight = embedder_weight.astype(np.float32)
         classifiers_weights = {
-            study: np.linalg.lstsq(embedder_weight.T, mean_coef, rcond=None)[0].T
+            study: np.linalg.lstsq(embedder_weight.T, mean_coef,
+                                   rcond=None)[0].T.astype(np.float32)
             for study, mean_coef in mean_coefs.items()}
 
         module.embedder.weight.data = torch.from_numpy(embedder_weight)
@@ -73,46 +213,659 @@ class EnsembleClassifier(BaseEstimator):
                 classifier.batch_norm.running_var.fill_(1.)
         return self
 
+    def _load_checkpoint(self, data, embedder_init):
+        """
+        Online consolidator resumed from `checkpoint`, if it was saved by a
+        fit of the same runs with the same consolidation parameters, or a
+        new one.
+        """
+        params = {name: value for name, value
+                  in self.estimator.get_params(deep=False).items()
+                  if name not in _IGNORED_PARAMS}
+        key = compute_hash((data.fingerprint, params, self.seed, self.engine,
+                            self.alpha, self.warmup, self.wave_size,
+                            embedder_init.shape))
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            consolidator = load(self.checkpoint)
+            if getattr(consolidator, 'key', None) == key:
+                consolidator.n_epochs = self.online_epochs
+                return consolidator
+            warnings.warn('Checkpoint %s was saved by another fit, it is'
+                          ' discarded' % self.checkpoint)
+        return _OnlineComponents(embedder_init, self.alpha,
+                                 warmup=self.warmup,
+                                 n_warmup_runs=self.wave_size,
+                                 n_epochs=self.online_epochs, key=key)
+
+    def _fit_runs(self, data, seeds, accumulator, consolidator=None):
+        """
+        Fit the runs, all at once or in waves, feeding `accumulator` and
+        the online `consolidator`.
+        """
+        start_time = time.perf_counter()
+        self.convergence_ = []
+        if self.tol is None and self.max_time is None:
+            wave_size = len(seeds)
+        else:
+            wave_size = self.wave_size
+        mean_coefs, mean_spectrum = None, None
+        for start in range(0, len(seeds), wave_size):
+            for index, run_res in self._iter_runs(
+                    data, seeds[start:start + wave_size], start):
+                accumulator.add(index, *run_res)
+                if consolidator is not None:
+                    consolidator.partial_fit(index, run_res[0].numpy())
+            if consolidator is not None and self.checkpoint is not None:
+                dump(consolidator, self.checkpoint)
+            elapsed = time.perf_counter() - start_time
+            coef_change = max(
+                _relative_change(mean_coef, mean_coefs[study])
+                for study, mean_coef in accumulator.mean_coefs.items()) \
+                if mean_coefs is not None else float('inf')
+            spectrum_change = _relative_change(accumulator.mean_spectrum,
+                                               mean_spectrum)
+            mean_coefs = accumulator.mean_coefs
+            mean_spectrum = accumulator.mean_spectrum
+            self.convergence_.append(dict(n_runs=accumulator.n_runs,
+                                          time=elapsed,
+                                          coef_change=coef_change,
+                                          spectrum_change=spectrum_change))
+            if wave_size < len(seeds):
+                print('Ensemble: %i runs, %.0fs, relative change of'
+                      ' coefficients %.2e, of embedder singular values %.2e'
+                      % (accumulator.n_runs, elapsed, coef_change,
+                         spectrum_change))
+            if self.tol is not None and max(coef_change,
+                                            spectrum_change) < self.tol:
+                break
+            if self.max_time is not None and elapsed > self.max_time:
+                break
+        self.n_runs_ = accumulator.n_runs
+
+    def _iter_runs(self, data, seeds, start=0):
+        """
+        Fit the runs, yielding `(index, (embedder_weight, full_coef,
+        full_bias))` in order of completion. Indices start at `start`.
+        Runs found in `run_cache` are yielded first.
+        """
+        runs = list(enumerate(seeds, start))
+        keys = {}
+        if self.run_cache is not None:
+            missing = []
+            for index, seed in runs:
+                keys[index] = self.run_cache.key(data.fingerprint,
+                                                 self.estimator, seed,
+                                                 engine=self.engine)
+                run_res = self.run_cache.get(keys[index])
+                if run_res is None:
+                    missing.append((index, seed))
+                else:
+                    yield index, run_res
+            runs = missing
+        if not runs:
+            return
+        for index, run_res in self._compute_runs(data, runs):
+            if self.run_cache is not None:
+                self.run_cache.put(keys[index], run_res)
+            yield index, run_res
+
+    def _compute_runs(self, data, runs):
+        parallel = Parallel(n_jobs=self.n_jobs, verbose=10,
+                            return_as='generator_unordered')
+        if self.engine == 'joblib':
+            compute_coefs = self.memory.cache(_compute_coefs,
+                                              ignore=['data'])
+            yield from parallel(
+                delayed(_indexed)(index, compute_coefs, self.estimator, data,
+                                  data.fingerprint, seed)
+                for index, seed in runs)
+        elif self.engine == 'batched':
+            runs_per_batch = self.runs_per_batch
+            if runs_per_batch is None:
+                runs_per_batch = ceil(len(runs)
+                                      / effective_n_jobs(self.n_jobs))
+            compute_coefs = self.memory.cache(_compute_coefs_batched,
+                                              ignore=['data'])
+            batches = [runs[i:i + runs_per_batch]
+                       for i in range(0, len(runs), runs_per_batch)]
+            for batch, res in parallel(
+                    delayed(_indexed)(batch, compute_coefs, self.estimator,
+                                      data, data.fingerprint,
+                                      [seed for _, seed in batch])
+                    for batch in batches):
+                for (index, _), run_res in zip(batch, res):
+                    yield index, run_res
+        else:
+            raise ValueError('Wrong value for `engine`')
+
     def predict(self, X):
         return self.estimator_.predict(X)
 
+    def compile(self, dtype=np.float32):
+        return self.estimator_.compile(dtype=dtype)
+
+    def save(self, filename):
+        """
+        Save the consolidated model in a flat, memory-mappable file, to be
+        loaded with `MultiStudyClassifier.load`.
+
+        Parameters
+        ----------
+        filename : str
+        """
+        self.estimator_.save(filename)
+
+
+def _get_temp_folder(temp_folder=None):
+    if temp_folder is not None:
+        return temp_folder
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class _SharedData(object):
+    def __init__(self, X, y, folder):
+        """
+        Training data written once as float32 .npy files, and loaded by
+        workers as memory maps. Only the paths are pickled.
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray or ChunkedArray]
+
+        y : Dict[str, pd.DataFrame]
+            Targets, of which only the 'contrast' column is kept
+
+        folder : str
+            Folder where the data is written
+        """
+        self.folder = folder
+        self.studies = list(X.keys())
+        y = {study: np.asarray(y[study]['contrast'].values, dtype=np.int64)
+             for study in self.studies}
+        X = dict(X)
+        for i, study in enumerate(self.studies):
+            filename = join(folder, 'X_%i.npy' % i)
+            if hasattr(X[study], 'iter_chunks'):
+                # Chunked arrays are streamed to disk
+                X[study] = X[study].copyto(np.lib.format.open_memmap(
+                    filename, mode='w+', dtype=np.float32,
+                    shape=X[study].shape))
+                X[study].flush()
+            else:
+                X[study] = np.ascontiguousarray(X[study], dtype=np.float32)
+                np.save(filename, X[study])
+            np.save(join(folder, 'y_%i.npy' % i), y[study])
+        # Cheaper than hashing X: shapes, column sums and a subset of rows
+        summary = {study: (X[study].shape,
+                           X[study].sum(axis=0, dtype=np.float64),
+                           X[study][::max(1, len(X[study]) // 64)])
+                   for study in self.studies}
+        self.fingerprint = compute_hash((self.studies, summary, y))
+
+    def load(self):
+        """
+        Returns
+        -------
+        X : Dict[str, np.ndarray]
+            Copy-on-write memory maps of the input data
+
+        y : Dict[str, pd.DataFrame]
+            Targets, with the 'contrast' column only
+        """
+        X, y = {}, {}
+        for i, study in enumerate(self.studies):
+            X[study] = np.load(join(self.folder, 'X_%i.npy' % i),
+                               mmap_mode='c')
+            y[study] = pd.DataFrame(dict(contrast=np.load(
+                join(self.folder, 'y_%i.npy' % i), mmap_mode='c')))
+        return X, y
+
+
+class _RunAccumulator(object):
+    def __init__(self, filename, spectrum=False):
+        """
+        Running means of the affine maps and of the embedder singular values
+        of the runs, fed as runs finish.
+        Embedder weights are written to a float32 file, at the position of
+        their run, so that memory does not grow with the number of runs.
+
+        Parameters
+        ----------
+        filename : str
+            File where embedder weights are written
+
+        spectrum : bool
+            Track the mean singular values of the embedders, a statistic
+            that does not depend on the order of the latent units, and
+            whose size does not grow with the number of input features
+        """
+        self.filename = filename
+        self.spectrum = spectrum
+        self.n_runs = 0
+        self.shape = None
+        self._mean_coefs = {}
+        self._mean_biases = {}
+        self._mean_spectrum = None
+        open(filename, 'wb').close()
+
+    def add(self, index, embedder_weight, full_coef, full_bias):
+        """
+        Parameters
+        ----------
+        index : int
+            Index of the run
+
+        embedder_weight, full_coef, full_bias :
+            Output of `_compute_coefs`
+        """
+        embedder_weight = np.ascontiguousarray(embedder_weight.numpy(),
+                                               dtype=np.float32)
+        self.shape = embedder_weight.shape
+        with open(self.filename, 'r+b') as f:
+            f.seek(index * embedder_weight.nbytes)
+            f.write(embedder_weight.data)
+        self.n_runs += 1
+        if self.spectrum:
+            # Sorted in decreasing order
+            spectrum = np.linalg.svd(embedder_weight.astype(np.float64),
+                                     compute_uv=False)
+            if self._mean_spectrum is None:
+                self._mean_spectrum = np.zeros(spectrum.shape)
+            self._mean_spectrum += (spectrum - self._mean_spectrum) \
+                / self.n_runs
+        for study in full_coef:
+            coef = full_coef[study].numpy()
+            bias = full_bias[study].numpy().ravel()
+            if study not in self._mean_coefs:
+                self._mean_coefs[study] = np.zeros(coef.shape)
+                self._mean_biases[study] = np.zeros(bias.shape)
+            self._mean_coefs[study] += (coef - self._mean_coefs[study]) \
+                / self.n_runs
+            self._mean_biases[study] += (bias - self._mean_biases[study]) \
+                / self.n_runs
+
+    @property
+    def mean_coefs(self):
+        return {study: mean_coef.astype(np.float32)
+                for study, mean_coef in self._mean_coefs.items()}
+
+    @property
+    def mean_spectrum(self):
+        if self._mean_spectrum is None:
+            return None
+        return self._mean_spectrum.copy()
+
+    @property
+    def mean_biases(self):
+        return {study: mean_bias.astype(np.float32)
+                for study, mean_bias in self._mean_biases.items()}
 
-def _compute_coefs(estimator, X, y, seed=0):
+    def embedder_weights(self):
+        """
+        Returns
+        -------
+        embedder_weights : np.memmap, shape (n_runs * latent_size, in_features)
+            Read-only map of the embedder weights of the runs, in run order
+        """
+        n_rows, in_features = self.shape
+        return np.memmap(self.filename, dtype=np.float32, mode='r',
+                         shape=(self.n_runs * n_rows, in_features))
+
+
+def _relative_change(new, old):
+    if old is None:
+        return float('inf')
+    return float(np.linalg.norm(new - old)
+                 / max(np.linalg.norm(new), np.finfo(np.float64).tiny))
+
+
+def _indexed(index, func, *args):
+    return index, func(*args)
+
+
+def _compute_coefs(estimator, data, fingerprint, seed=0):
+    """
+    Fit one run of the ensemble on the shared `data`. `fingerprint`
+    identifies the data in the cache of `EnsembleClassifier.memory`.
+    """
+    X, y = data.load()
+    # With the sequential backend, `estimator` is not copied by joblib
+    estimator = copy.deepcopy(estimator)
     estimator.n_jobs = 1
     estimator.seed = seed
     estimator.fit(X, y)
+    return _module_coefs(estimator.module_)
+
+
+def _compute_coefs_batched(estimator, data, fingerprint, seeds):
+    """
+    Fit several runs of the ensemble on the shared `data`, training them as
+    one batched model. Returns the output of `_compute_coefs` for each seed.
+
+    Heads are pretrained and finetuned run by run, with the `head_solver` of
+    `estimator`. The train phase of all runs is performed in lockstep by
+    `_train_batched`.
+    """
+    X, y = data.load()
+    estimators = []
+    for seed in seeds:
+        this_estimator = copy.deepcopy(estimator)
+        this_estimator.n_jobs = 1
+        this_estimator.seed = seed
+        this_estimator.max_iter = dict(estimator.max_iter, train=0,
+                                       finetune=0)
+        this_estimator.fit(X, y)
+        this_estimator.max_iter = estimator.max_iter
+        estimators.append(this_estimator)
+
+    X = {study: torch.from_numpy(np.asarray(this_X)).float()
+         for study, this_X in X.items()}
+    y = {study: torch.tensor(this_y['contrast'].values, dtype=torch.long)
+         for study, this_y in y.items()}
+    modules = [this_estimator.module_ for this_estimator in estimators]
+    if estimator.max_iter['train'] > 0:
+        _train_batched(estimator, modules, X, y, seeds)
+
+    res = []
+    for seed, this_estimator in zip(seeds, estimators):
+        torch.manual_seed(seed)
+        this_estimator._fit_third_layer(X, y, this_estimator.module_,
+                                        phase='finetune')
+        res.append(_module_coefs(this_estimator.module_))
+    return res
+
+
+def _train_batched(estimator, modules, X, y, seeds):
+    """
+    Train phase of `MultiStudyClassifier.fit`, for a list of modules
+    trained in lockstep.
+
+    Each run draws the study of its batches with the `weight_power` study
+    weights, and keeps its own dropout noise, epoch count and early stopping.
+    Its batches and noise are drawn from its own generator, so that a run
+    only depends on its seed, and not on the runs it is batched with.
+    Batches are drawn with replacement within the chosen study, and have the
+    size of the study if it is smaller than `batch_size`, as with
+    `sampling='random'`.
+
+    Parameters
+    ----------
+    estimator : MultiStudyClassifier
+        Hyper-parameters of the train phase
+
+    modules : List[VarMultiStudyModule]
+        Pretrained modules, updated in place
+
+    X : Dict[str, torch.tensor]
+
+    y : Dict[str, torch.LongTensor]
+
+    seeds : List[int]
+        Seed of the sampling and of the dropout noise of each run
+    """
+    if estimator.sampling != 'random':
+        raise ValueError("The batched engine only supports"
+                         " sampling='random'")
+    generators = [torch.Generator().manual_seed(int(seed))
+                  for seed in seeds]
+    for module in modules:
+        for classifier in module.classifiers.values():
+            classifier.linear.make_adaptive()
+    runs = BatchedMultiStudyModules(modules)
+    n_runs = runs.n_runs
+    studies = runs.studies
+
+    lengths = torch.tensor([len(X[study]) for study in studies])
+    offsets = torch.cumsum(lengths, 0) - lengths
+    X_all = torch.cat([X[study] for study in studies])
+    y_all = torch.cat([y[study] for study in studies])
+    n_samples = int(lengths.sum())
+    study_weights = lengths.double() ** estimator.weight_power
+    batch_size = estimator.batch_size
+    batch_sizes = lengths.clamp(max=batch_size)
+    positions = torch.arange(batch_size)
+    max_iter = estimator.max_iter['train']
+    if estimator.verbose != 0:
+        report_every = ceil(max_iter / estimator.verbose)
+    else:
+        report_every = None
+
+    lr = estimator.lr['train']
+    embedder_optimizer = MaskedAdam([runs.embedder_weight,
+                                     runs.embedder_bias], lr=lr,
+                                    amsgrad=True)
+    head_optimizer = MaskedAdam([runs.head_weight, runs.head_bias,
+                                 runs.head_log_alpha], lr=lr, amsgrad=True)
+
+    best_state = runs.get_run_state()
+    old_epoch = torch.full((n_runs,), -1, dtype=torch.long)
+    seen_samples = torch.zeros(n_runs, dtype=torch.long)
+    epoch_loss = torch.full((n_runs,), float('inf'))
+    epoch_batch = torch.zeros(n_runs)
+    best_loss = torch.full((n_runs,), float('inf'))
+    no_improvement = torch.zeros(n_runs, dtype=torch.long)
+    stopped = torch.zeros(n_runs, dtype=torch.bool)
+    last_report = -1
+    runs.train()
+    while True:
+        epoch = seen_samples // n_samples
+        new_epoch = (epoch > old_epoch) & ~stopped
+        if new_epoch.any():
+            max_epoch = int(epoch[~stopped].max())
+            if (report_every is not None and max_epoch > last_report
+                    and max_epoch % report_every == 0):
+                last_report = max_epoch
+                print('Epoch %i, %i active runs, mean train loss: %.4f'
+                      % (max_epoch, int((~stopped).sum()),
+                         epoch_loss[~stopped].mean()))
+            improved = new_epoch & ~(epoch_loss > best_loss)
+            no_improvement = torch.where(
+                improved, torch.zeros_like(no_improvement),
+                no_improvement + new_epoch.long())
+            best_loss = torch.where(improved, epoch_loss, best_loss)
+            runs.set_run_state(runs.get_run_state(), improved,
+                               target=best_state)
+            epoch_loss = torch.where(new_epoch, torch.zeros_like(epoch_loss),
+                                     epoch_loss)
+            epoch_batch = torch.where(new_epoch,
+                                      torch.zeros_like(epoch_batch),
+                                      epoch_batch)
+            old_epoch = torch.where(new_epoch, epoch, old_epoch)
+            stopped |= new_epoch & ((no_improvement > estimator.patience)
+                                    | (epoch >= max_iter))
+            if stopped.all():
+                break
+        active = ~stopped
+
+        batch_studies = torch.cat([
+            torch.multinomial(study_weights, 1, generator=generator)
+            for generator in generators])
+        this_batch_sizes = batch_sizes[batch_studies]
+        row_mask = positions[None, :] < this_batch_sizes[:, None]
+        indices = (torch.stack([torch.rand(batch_size, generator=generator)
+                                for generator in generators])
+                   * lengths[batch_studies][:, None]).long()
+        indices += offsets[batch_studies][:, None]
+        inputs, targets = X_all[indices], y_all[indices]
+
+        preds = runs(inputs, batch_studies, row_mask, active=active,
+                     generators=generators)
+        nll = - torch.gather(preds, 2, targets[:, :, None])[:, :, 0]
+        nll = torch.sum(nll * row_mask.float(), dim=1) / this_batch_sizes
+        loss = nll + runs.penalty(batch_studies)
+        embedder_optimizer.zero_grad()
+        head_optimizer.zero_grad()
+        torch.sum(loss[active]).backward()
+        embedder_optimizer.step(active)
+        head_mask = torch.zeros(n_runs * len(studies), dtype=torch.bool)
+        head_mask[runs._heads(batch_studies)[active]] = True
+        head_optimizer.step(head_mask)
+
+        seen_samples += torch.where(active, this_batch_sizes,
+                                    torch.zeros_like(this_batch_sizes))
+        epoch_batch += active.float()
+        loss = loss.detach()
+        epoch_loss = torch.where(
+            active, epoch_loss * (1 - 1 / epoch_batch.clamp(min=1))
+            + loss / epoch_batch.clamp(min=1), epoch_loss)
+    print('Stopped %i runs at epochs %s' % (n_runs, old_epoch.tolist()))
+    runs.set_run_state(best_state)
+    runs.to_modules(modules)
 
-    module = estimator.module_
-    weight = estimator.module_.embedder.weight.data
-    studies = list(estimator.module_.classifiers.keys())
-    in_features = estimator.module_.embedder.in_features
-    with torch.no_grad():
-        module.eval()
-        full_bias = module({study: torch.zeros((1, in_features))
-                            for study in studies}, logits=True)
-        full_coef = module({study: torch.eye(in_features)
-                            for study in studies}, logits=True)
-        full_coef = {study: full_coef[study] - full_bias[study]
-                     for study in studies}
+
+def _module_coefs(module):
+    """
+    Embedder weight, and affine logits of each study, as
+    (in_features, n_targets) coefficients and (1, n_targets) biases.
+    """
+    weight = module.embedder.weight.data
+    affine = module.compute_affine()
+    full_coef = {study: coef.t() for study, (coef, _) in affine.items()}
+    full_bias = {study: bias[None, :] for study, (_, bias) in affine.items()}
     return weight, full_coef, full_bias
 
 
+def _make_dict_fact(embedder_init, alpha, sparse, n_epochs=1, verbose=0):
+    return DictFact(comp_l1_ratio=1 if sparse else 0, comp_pos=True,
+                    n_components=embedder_init.shape[0],
+                    code_l1_ratio=0, batch_size=32,
+                    learning_rate=1,
+                    dict_init=embedder_init,
+                    code_alpha=alpha, verbose=verbose, n_epochs=n_epochs,
+                    )
+
+
 def _compute_components(embedder_weights, embedder_init, alpha, warmup):
     if warmup:
-        dict_fact = DictFact(comp_l1_ratio=0, comp_pos=True,
-                             n_components=embedder_init.shape[0],
-                             code_l1_ratio=0, batch_size=32,
-                             learning_rate=1,
-                             dict_init=embedder_init,
-                             code_alpha=alpha, verbose=0, n_epochs=2,
-                             )
+        dict_fact = _make_dict_fact(embedder_init, alpha, sparse=False,
+                                    n_epochs=2)
         dict_fact.fit(embedder_weights)
         embedder_init = dict_fact.components_
-    dict_fact = DictFact(comp_l1_ratio=1, comp_pos=True,
-                         n_components=embedder_init.shape[0],
-                         code_l1_ratio=0, batch_size=32, learning_rate=1,
-                         dict_init=embedder_init,
-                         code_alpha=alpha, verbose=10, n_epochs=20)
+    dict_fact = _make_dict_fact(embedder_init, alpha, sparse=True,
+                                n_epochs=20, verbose=10)
     dict_fact.fit(embedder_weights)
     components = dict_fact.components_
     return components
+
+
+class _OnlineComponents(object):
+    def __init__(self, embedder_init, alpha, warmup=True, n_warmup_runs=10,
+                 n_epochs=2, random_state=0, key=None):
+        """
+        Dictionary learning of the consolidated embedder, fed run by run
+        with `partial_fit` as runs finish.
+
+        The non-sparse warmup of `_compute_components` is learned on the
+        first `n_warmup_runs` runs. The sparse dictionary learning is then
+        initialized with its components, fed with these runs, and with
+        each following run. `finalize` performs `n_epochs` more passes over
+        all runs, in random order. The object can be pickled between calls
+        to `partial_fit`.
+
+        Experimental: the reconstruction error of its components has not
+        been compared to the one of `_compute_components`.
+
+        Parameters
+        ----------
+        embedder_init : np.ndarray, shape (latent_size, in_features)
+
+        alpha : float
+            Code regularization
+
+        warmup : bool
+            Learn a non-sparse dictionary on the first runs, to initialize
+            the sparse one
+
+        n_warmup_runs : int
+            Number of runs used by the warmup
+
+        n_epochs : int
+            Number of passes over all runs in `finalize`
+
+        random_state : int
+            Seed of the order of the final passes
+
+        key : str or None
+            Description of the fit feeding the runs, checked before
+            resuming from a checkpoint
+        """
+        self.embedder_init = embedder_init
+        self.alpha = alpha
+        self.warmup = warmup
+        self.n_warmup_runs = n_warmup_runs
+        self.n_epochs = n_epochs
+        self.random_state = random_state
+        self.key = key
+
+        self.seen_ = set()
+        self._warmup_buffer = []
+        self._warmup_dict_fact = None
+        self._dict_fact = None
+
+    def partial_fit(self, index, embedder_weight):
+        """
+        Parameters
+        ----------
+        index : int
+            Index of the run. Runs already seen are skipped.
+
+        embedder_weight : np.ndarray, shape (latent_size, in_features)
+
+        Returns
+        -------
+        self : _OnlineComponents
+        """
+        if index in self.seen_:
+            return self
+        self.seen_.add(index)
+        embedder_weight = np.asarray(embedder_weight, dtype=np.float64)
+        if self._dict_fact is not None:
+            self._dict_fact.partial_fit(embedder_weight)
+            return self
+        self._warmup_buffer.append(embedder_weight)
+        if self.warmup:
+            if self._warmup_dict_fact is None:
+                self._warmup_dict_fact = _make_dict_fact(
+                    self.embedder_init, self.alpha, sparse=False)
+            self._warmup_dict_fact.partial_fit(embedder_weight)
+        if len(self._warmup_buffer) >= self.n_warmup_runs:
+            self._start_sparse()
+        return self
+
+    def _start_sparse(self):
+        if self._warmup_dict_fact is not None:
+            dict_init = self._warmup_dict_fact.components_
+        else:
+            dict_init = self.embedder_init
+        self._dict_fact = _make_dict_fact(dict_init, self.alpha, sparse=True)
+        for embedder_weight in self._warmup_buffer:
+            self._dict_fact.partial_fit(embedder_weight)
+        self._warmup_buffer = []
+        self._warmup_dict_fact = None
+
+    def finalize(self, embedder_weights):
+        """
+        Parameters
+        ----------
+        embedder_weights : np.ndarray
+            Embedder weights of all runs, of shape
+            (n_runs * latent_size, in_features), e.g. a memory map
+
+        Returns
+        -------
+        components : np.ndarray, shape (latent_size, in_features)
+        """
+        if self._dict_fact is None:
+            self._start_sparse()
+        latent_size = self.embedder_init.shape[0]
+        n_runs = embedder_weights.shape[0] // latent_size
+        random_state = check_random_state(self.random_state)
+        for _ in range(self.n_epochs):
+            for run in random_state.permutation(n_runs):
+                self._dict_fact.partial_fit(np.asarray(
+                    embedder_weights[run * latent_size:
+                                     (run + 1) * latent_size],
+                    dtype=np.float64))
+        return self._dict_fact.components_
@@ -4,6 +4,8 @@ from sklearn.base import BaseEstimator
 from sklearn.linear_model import LogisticRegressionCV, LogisticRegression
 from sklearn.model_selection import GroupShuffleSplit
 
+from cogspaces.classification.compiled import CompiledDecoder
+
 
 class MultiLogisticClassifier(BaseEstimator):
     def __init__(self, l2_penalty=1e-4, verbose=0, max_iter=1000,
@@ -67,6 +69,19 @@ class MultiLogisticClassifier(BaseEstimator):
                 subject=0, study=0))
         return res
 
+    def compile(self, dtype=np.float32):
+        coefs, intercepts = {}, {}
+        for study, estimator in self.estimators_.items():
+            coef, intercept = estimator.coef_, estimator.intercept_
+            if coef.shape[0] == 1:
+                # Binary problem: the logit of the first class is 0
+                coef = np.concatenate([np.zeros_like(coef), coef])
+                intercept = np.concatenate([np.zeros_like(intercept),
+                                            intercept])
+            coefs[study] = np.ascontiguousarray(coef, dtype=dtype)
+            intercepts[study] = intercept.astype(dtype)
+        return CompiledDecoder(coefs, intercepts)
+
     @property
     def coef_(self):
         return {study: estimator.coef_ for study, estimator
@@ -2,7 +2,9 @@
 Multi-study decoder.
 """
 
+import json
 import tempfile
+import time
 from math import ceil, floor
 
 import numpy as np
@@ -13,9 +15,95 @@ from sklearn.base import BaseEstimator
 from torch.optim import Adam
 from torch.utils.data import TensorDataset, DataLoader
 
-from cogspaces.input_data import MultiStudyLoader
+from cogspaces.classification.compiled import CompiledDecoder
+from cogspaces.input_data import MultiStudyLoader, PackedTensor
+from cogspaces.modules.batched import BatchedLatentClassifiers
 from cogspaces.modules.factored import VarMultiStudyModule
 from cogspaces.modules.loss import MultiStudyLoss
+from cogspaces.optim import LazyAdam, MaskedAdam, minimize_lbfgs, \
+    minimize_newton
+from cogspaces.serialization import load_arrays, module_array_names, \
+    module_from_arrays, module_to_arrays, read_header, save_arrays
+
+
+def _normalize_latent(classifier, input, batch_norm_train=False):
+    """
+    Apply the batch normalization of a `LatentClassifier` on a full batch of
+    latent representations.
+    """
+    if not hasattr(classifier, 'batch_norm'):
+        return input
+    batch_norm = classifier.batch_norm
+    if batch_norm_train:
+        mean = input.mean(dim=0)
+        var = input.var(dim=0, unbiased=False)
+    else:
+        mean, var = batch_norm.running_mean, batch_norm.running_var
+    return (input - mean) / torch.sqrt(var + batch_norm.eps)
+
+
+def _to_tensor(X):
+    """Float tensor of input data, filled chunk by chunk from chunked
+    arrays."""
+    if hasattr(X, 'iter_chunks'):
+        tensor = torch.empty(X.shape, dtype=torch.float32)
+        X.copyto(tensor.numpy())
+        return tensor
+    return torch.from_numpy(X).float()
+
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def _expected_weight(linear):
+    """Weights of a DropoutLinear scaled by their keep probability."""
+    keep = 1 - torch.sigmoid(linear.get_log_alpha())
+    return linear.weight * keep.expand_as(linear.weight)
+
+
+def _head_objective(linear, input, target):
+    """
+    Deterministic objective of a non-adaptive third-layer head.
+
+    Under multiplicative gaussian dropout of variance `alpha` on the input,
+    logits are gaussian with mean `W x + b` and variances
+    `sigma2_k = sum_j alpha_j x_j ** 2 W_kj ** 2`. The expected
+    cross-entropy is replaced by its convex upper bound
+
+        logsumexp(W x + b + sigma2 / 2) - (W x + b)_y,
+
+    averaged over samples.
+
+    Parameters
+    ----------
+    linear : DropoutLinear
+        Linear layer of the head, with `level` in {'layer', 'atom'}
+
+    input : torch.tensor
+        Normalized latent representations
+
+    target : torch.LongTensor
+        Targets
+
+    Returns
+    -------
+    loss : torch.tensor
+        Scalar objective
+    """
+    weight = linear.weight
+    logits = F.linear(input, weight, linear.bias)
+    if linear.p > 0:
+        alpha = torch.exp(linear.get_log_alpha()).view(1, -1)
+        variance = F.linear(alpha * input ** 2, weight ** 2)
+        log_norm = torch.logsumexp(logits + .5 * variance, dim=1)
+    else:
+        log_norm = torch.logsumexp(logits, dim=1)
+    loss = torch.mean(log_norm - torch.gather(logits, 1,
+                                              target[:, None])[:, 0])
+    return loss + linear.penalty()
 
 
 class MultiStudyClassifier(BaseEstimator):
@@ -68,6 +156,19 @@ class MultiStudyClassifier(BaseEstimator):
 
         seed : int or None
             Seed the optimization loop.
+
+        sampling : str, {'random', 'stratified-block', 'cycle'}
+            How studies are chosen at each training step. 'random' and
+            'stratified-block' follow the `weight_power` study weights.
+
+        loader_engine : str, {'torch', 'indexed'}
+            Engine of the `MultiStudyLoader` used during training.
+            'indexed' gathers batches from contiguous in-memory tensors.
+
+        pack_size : int or None
+            If not None, each training step packs the batches of `pack_size`
+            study draws into a single tensor, so that the second layer is
+            applied once per step. Requires `loader_engine='indexed'`.
     """
     def __init__(self,
                  latent_size=30,
@@ -81,7 +182,12 @@ class MultiStudyClassifier(BaseEstimator):
                  init='normal',
                  n_jobs=1,
                  patience=200,
-                 seed=None):
+                 seed=None,
+                 sampling='random',
+                 loader_engine='torch',
+                 pack_size=None,
+                 head_solver='adam',
+                 train_optimizer='adam'):
         if lr is None:
             lr = {'pretrain': 1e-3, 'train': 1e-3, 'finetune': 1e-3}
         if max_iter is None:
@@ -102,6 +208,11 @@ class MultiStudyClassifier(BaseEstimator):
         self.verbose = verbose
         self.seed = seed
         self.n_jobs = n_jobs
+        self.sampling = sampling
+        self.loader_engine = loader_engine
+        self.pack_size = pack_size
+        self.head_solver = head_solver
+        self.train_optimizer = train_optimizer
 
     def fit(self, X, y, callback=None):
         """
@@ -109,8 +220,10 @@ class MultiStudyClassifier(BaseEstimator):
 
         Parameters
         ----------
-        X : Dict[str, np.ndarray]
-            Dictionary of input data (one array per study)
+        X : Dict[str, np.ndarray or ChunkedArray]
+            Dictionary of input data (one array per study). Chunked arrays
+            (see `cogspaces.datasets.chunked`) are copied chunk by chunk
+            into the training tensors
 
         y: Dict[str, pd.Dataframe]
             Label dictionary. Must be normalized using
@@ -128,9 +241,8 @@ class MultiStudyClassifier(BaseEstimator):
 
         torch.manual_seed(self.seed)
         # Data
-        X = {study: torch.from_numpy(this_X).float()
-             for study, this_X in X.items()}
-        y = {study: torch.from_numpy(this_y['contrast'].values).long()
+        X = {study: _to_tensor(this_X) for study, this_X in X.items()}
+        y = {study: torch.tensor(this_y['contrast'].values, dtype=torch.long)
              for study, this_y in y.items()}
         data = {study: TensorDataset(X[study], y[study]) for study in X}
 
@@ -147,15 +259,18 @@ class MultiStudyClassifier(BaseEstimator):
                        study, study_weight
                        in study_weights.items()}
 
-        data_loader = MultiStudyLoader(data, sampling='random',
+        data_loader = MultiStudyLoader(data, sampling=self.sampling,
                                        batch_size=self.batch_size,
                                        seed=self.seed,
                                        study_weights=study_weights,
+                                       engine=self.loader_engine,
+                                       pack_size=self.pack_size,
                                        )
         # Model
         target_sizes = {study: int(this_y.max()) + 1
                         for study, this_y in y.items()}
         in_features = next(iter(X.values())).shape[1]
+        self.n_features_in_ = in_features
 
         if self.latent_size == 'auto':
             latent_size = sum(list(target_sizes.values()))
@@ -179,6 +294,7 @@ class MultiStudyClassifier(BaseEstimator):
 
         n_samples = sum(len(this_X) for this_X in X.values())
 
+        self.head_stats_ = {}
         self._fit_third_layer(X, y, module, phase='pretrain')
 
         print('Phase : train')
@@ -192,9 +308,20 @@ class MultiStudyClassifier(BaseEstimator):
             module.embedder.bias.requires_grad = True
             for classifier in module.classifiers.values():
                 classifier.linear.make_adaptive()
-            optimizer = Adam(filter(lambda p: p.requires_grad,
-                                    module.parameters()),
-                             lr=self.lr['train'], amsgrad=True)
+            if self.train_optimizer == 'adam':
+                optimizer = Adam(filter(lambda p: p.requires_grad,
+                                        module.parameters()),
+                                 lr=self.lr['train'], amsgrad=True)
+            elif self.train_optimizer == 'lazy_adam':
+                param_groups = [module.embedder] + list(
+                    module.classifiers.values())
+                param_groups = [{'params': [p for p in group.parameters()
+                                            if p.requires_grad]}
+                                for group in param_groups]
+                optimizer = LazyAdam(param_groups, lr=self.lr['train'],
+                                     amsgrad=True)
+            else:
+                raise ValueError('Wrong value for `train_optimizer`')
 
             best_state = module.state_dict()
 
@@ -234,7 +361,11 @@ class MultiStudyClassifier(BaseEstimator):
                         print('-----------------------------------')
                         break
 
-                batch_size = sum(input.shape[0] for input in inputs.values())
+                if isinstance(inputs, PackedTensor):
+                    batch_size = inputs.data.shape[0]
+                else:
+                    batch_size = sum(input.shape[0]
+                                     for input in inputs.values())
                 seen_samples += batch_size
                 optimizer.zero_grad()
                 module.train()
@@ -291,6 +422,37 @@ class MultiStudyClassifier(BaseEstimator):
             report_every = ceil(self.max_iter[phase] / self.verbose)
         else:
             report_every = None
+        start = time.perf_counter()
+        if self.head_solver == 'adam':
+            self._fit_third_layer_adam(X, y, module, phase, report_every)
+        elif self.head_solver == 'batched_adam':
+            self._fit_third_layer_batched(X, y, module, phase,
+                                          report_every)
+        elif self.head_solver in ['lbfgs', 'newton']:
+            self._fit_third_layer_full_batch(X, y, module, phase)
+        else:
+            raise ValueError('Wrong value for `head_solver`')
+        elapsed = time.perf_counter() - start
+
+        losses = {}
+        with torch.no_grad():
+            module.embedder.eval()
+            for study, this_X in X.items():
+                classifier = module.classifiers[study]
+                input = _normalize_latent(classifier, module.embedder(this_X),
+                                          batch_norm_train=phase != 'finetune')
+                losses[study] = _head_objective(classifier.linear, input,
+                                                y[study]).item()
+        self.head_stats_[phase] = dict(time=elapsed, loss=losses)
+        print('Phase %s (%s): %.2fs, mean objective %.4f'
+              % (phase, self.head_solver, elapsed,
+                 np.mean(list(losses.values()))))
+
+    def _fit_third_layer_adam(self, X, y, module, phase, report_every):
+        """
+        Train the third layer classification heads one after the other,
+        with stochastic gaussian dropout.
+        """
         X_red = {}
         for study, this_X in X.items():
             print('Tuning %s' % study)
@@ -360,14 +522,297 @@ class MultiStudyClassifier(BaseEstimator):
                   (epoch, epoch_loss, best_loss))
             print('-----------------------------------')
 
+    def _fit_third_layer_batched(self, X, y, module, phase, report_every):
+        """
+        Train all third layer classification heads simultaneously.
+
+        Heads are stacked into a `BatchedLatentClassifiers` and trained in
+        lockstep: at each step, every head processes its next batch of
+        samples. Heads with fewer batches per epoch, and heads that met
+        their stopping criterion, are masked out of the update.
+        """
+        studies = list(X.keys())
+        classifiers = [module.classifiers[study] for study in studies]
+        for classifier in classifiers:
+            classifier.linear.make_non_adaptive()
+        with torch.no_grad():
+            module.embedder.eval()
+            X_red = [module.embedder(X[study]) for study in studies]
+        n_heads = len(studies)
+        lengths = torch.tensor([len(this_X) for this_X in X_red])
+        max_length = int(lengths.max())
+        latent_size = X_red[0].shape[1]
+        X_pad = X_red[0].new_zeros((n_heads, max_length, latent_size))
+        y_pad = torch.zeros((n_heads, max_length), dtype=torch.long)
+        for i, study in enumerate(studies):
+            X_pad[i, :lengths[i]] = X_red[i]
+            y_pad[i, :lengths[i]] = y[study]
+
+        heads = BatchedLatentClassifiers(classifiers)
+        optimizer = MaskedAdam([heads.weight, heads.bias],
+                               lr=self.lr[phase], amsgrad=True)
+        batch_size = self.batch_size
+        n_batches = (lengths + batch_size - 1) // batch_size
+        padding = torch.arange(max_length)[None, :] >= lengths[:, None]
+
+        stopped = torch.zeros(n_heads, dtype=torch.bool)
+        best_loss = torch.full((n_heads, ), float('inf'))
+        no_improvement = torch.zeros(n_heads, dtype=torch.long)
+        best_state = {key: value.clone()
+                      for key, value in heads.state_dict().items()}
+        epoch = 0
+        for epoch in range(self.max_iter[phase]):
+            # Padded samples are sent to the end of each permutation
+            keys = torch.rand((n_heads, max_length)).masked_fill(padding, 2)
+            permutations = torch.argsort(keys, dim=1)
+            epoch_loss = torch.zeros(n_heads)
+            for batch in range(int(n_batches[~stopped].max())):
+                start = batch * batch_size
+                indices = permutations[:, start:start + batch_size]
+                row_mask = (torch.arange(start, start + indices.shape[1])[
+                            None, :] < lengths[:, None])
+                active = (batch < n_batches) & ~stopped
+                input = torch.gather(X_pad, 1, indices[:, :, None].expand(
+                    -1, -1, latent_size))
+                target = torch.gather(y_pad, 1, indices)
+
+                optimizer.zero_grad()
+                heads.train()
+                pred = heads(input, row_mask, active,
+                             batch_norm_train=phase != 'finetune')
+                nll = - torch.gather(pred, 2, target[:, :, None])[:, :, 0]
+                nll = nll.masked_fill(~row_mask, 0)
+                loss = nll.sum(dim=1) / row_mask.sum(dim=1).clamp(min=1)
+                torch.sum(loss.masked_fill(~active, 0)).backward()
+                optimizer.step(active)
+                epoch_loss += loss.detach().masked_fill(~active, 0)
+            epoch_loss /= n_batches.float()
+            if (report_every is not None
+                    and epoch % report_every == 0):
+                print('Epoch %.2f, mean train loss: %.4f, active heads: %i'
+                      % (epoch, epoch_loss[~stopped].mean().item(),
+                         int((~stopped).sum())))
+
+            improved = (epoch_loss <= best_loss) & ~stopped
+            best_loss = torch.where(improved, epoch_loss, best_loss)
+            no_improvement = torch.where(
+                improved, torch.zeros_like(no_improvement),
+                no_improvement + (~stopped).long())
+            for key, value in heads.state_dict().items():
+                if key in best_state and value.dim() > 0 \
+                        and len(value) == n_heads:
+                    view = (-1,) + (1,) * (value.dim() - 1)
+                    best_state[key] = torch.where(improved.view(view),
+                                                  value, best_state[key])
+            stopped |= no_improvement > self.patience
+            if torch.all(stopped):
+                break
+        heads.load_state_dict(best_state)
+        heads.to_classifiers(classifiers)
+        for study, this_best_loss in zip(studies, best_loss.tolist()):
+            print('%s: best model loss %.2f' % (study, this_best_loss))
+        print('Stopping at epoch %.2f' % epoch)
+        print('-----------------------------------')
+
+    def _fit_third_layer_full_batch(self, X, y, module, phase):
+        """
+        Train the third layer classification heads with a full-batch second
+        order solver on the cached latent representations.
+
+        Batch normalization is performed once on the whole data (using the
+        running statistics during fine-tuning). Gaussian dropout is replaced
+        by a deterministic upper bound of the expected loss (see
+        `_head_objective`).
+        """
+        with torch.no_grad():
+            module.embedder.eval()
+            X_red = {study: module.embedder(this_X)
+                     for study, this_X in X.items()}
+        for study, this_X_red in X_red.items():
+            classifier = module.classifiers[study]
+            classifier.linear.make_non_adaptive()
+            batch_norm_train = phase != 'finetune'
+            with torch.no_grad():
+                if batch_norm_train and hasattr(classifier, 'batch_norm'):
+                    batch_norm = classifier.batch_norm
+                    batch_norm.running_mean.copy_(this_X_red.mean(dim=0))
+                    batch_norm.running_var.copy_(this_X_red.var(dim=0))
+                    batch_norm.num_batches_tracked += 1
+                input = _normalize_latent(classifier, this_X_red,
+                                          batch_norm_train)
+            linear = classifier.linear
+            params = [linear.weight, linear.bias]
+
+            def objective():
+                return _head_objective(linear, input, y[study])
+
+            if self.head_solver == 'lbfgs':
+                loss = minimize_lbfgs(objective, params,
+                                      max_iter=self.max_iter[phase])
+            else:
+                loss = minimize_newton(objective, params,
+                                       max_iter=self.max_iter[phase])
+            print('%s: final loss %.4f' % (study, loss))
+        print('-----------------------------------')
+
+    def prune(self, threshold=1e-2, X=None, y=None):
+        """
+        Remove latent units and input atoms that carry little signal.
+
+        The signal of a latent unit is the largest norm of the weights
+        that the classification heads give to it (after batch
+        normalization), scaled by their keep probability. The signal of an
+        input atom is the norm of its embedder weights towards the kept
+        latent units, scaled by their keep probability. Units and atoms
+        whose signal is below `threshold` times the largest one are
+        removed, yielding a smaller dense model.
+
+        Parameters
+        ----------
+        threshold : float
+            Relative signal under which units and atoms are removed
+
+        X : Dict[str, np.ndarray] or None
+            If provided, the mean of removed atoms is folded into the
+            embedder bias, and the accuracy before and after pruning is
+            reported
+
+        y : Dict[str, pd.Dataframe] or None
+            Labels of `X`, normalized using
+            `cogspaces.preprocessing.MultiTargetEncoder`
+
+        Returns
+        -------
+        self: MultiStudyClassifier
+        """
+        module = self.module_
+        if X is not None and y is not None:
+            accuracies = self._accuracies(X, y)
+        with torch.no_grad():
+            embedder = module.embedder
+            latent_signal = torch.zeros(embedder.out_features)
+            for classifier in module.classifiers.values():
+                # Latent units are batch-normalized before the heads
+                weight = _expected_weight(classifier.linear)
+                latent_signal = torch.max(
+                    latent_signal, torch.sqrt(torch.sum(weight ** 2, dim=0)))
+            latent_indices = torch.nonzero(
+                latent_signal >= threshold * latent_signal.max())[:, 0]
+
+            weight = _expected_weight(embedder)[latent_indices]
+            atom_signal = torch.sqrt(torch.sum(weight ** 2, dim=0))
+            atom_indices = torch.nonzero(
+                atom_signal >= threshold * atom_signal.max())[:, 0]
+
+            if X is not None:
+                removed = np.ones(embedder.in_features, dtype=bool)
+                removed[atom_indices.numpy()] = False
+                support = getattr(self, 'input_support_',
+                                  np.arange(embedder.in_features))
+                mean = np.concatenate([this_X[:, support]
+                                       for this_X in X.values()]).mean(axis=0)
+                mean = torch.from_numpy(mean[removed]).float()
+                embedder.bias += embedder.weight[:, removed].matmul(mean)
+
+        n_latent, n_atoms = embedder.out_features, embedder.in_features
+        module.select(latent_indices, atom_indices)
+        support = getattr(self, 'input_support_', np.arange(n_atoms))
+        self.input_support_ = support[atom_indices.numpy()]
+        print('Pruned latent units: %i -> %i, input atoms: %i -> %i'
+              % (n_latent, len(latent_indices), n_atoms, len(atom_indices)))
+        self.prune_report_ = dict(latent_size=(n_latent,
+                                               len(latent_indices)),
+                                  in_features=(n_atoms, len(atom_indices)))
+        if X is not None and y is not None:
+            pruned_accuracies = self._accuracies(X, y)
+            self.prune_report_['accuracy'] = {
+                study: (accuracies[study], pruned_accuracies[study])
+                for study in accuracies}
+            delta = np.mean([pruned_accuracies[study] - accuracies[study]
+                             for study in accuracies])
+            self.prune_report_['accuracy_delta'] = delta
+            print('Mean accuracy delta: %.4f' % delta)
+        return self
+
+    def expand_pruned(self, coef):
+        """
+        Expand coefficients over the input atoms kept by `prune` to all
+        input features, with zeros for pruned atoms.
+
+        Parameters
+        ----------
+        coef : np.ndarray, shape (n_targets, n_kept_atoms)
+
+        Returns
+        -------
+        full_coef : np.ndarray, shape (n_targets, n_features_in_)
+        """
+        if not hasattr(self, 'input_support_'):
+            return coef
+        full_coef = np.zeros((coef.shape[0], self.n_features_in_),
+                             dtype=coef.dtype)
+        full_coef[:, self.input_support_] = coef
+        return full_coef
+
+    def _accuracies(self, X, y):
+        preds = self.predict(X)
+        return {study: float(np.mean(preds[study]['contrast'].values
+                                     == y[study]['contrast'].values))
+                for study in preds}
+
+    def compile_sparse(self, threshold=0.01):
+        """
+        Compile the pruned weights of the fitted module for fast prediction.
+        See `cogspaces.modules.linear.DropoutLinear.compile_sparse`.
+
+        Parameters
+        ----------
+        threshold : float
+            Density under which weights are stored in CSR format
+
+        Returns
+        -------
+        self: MultiStudyClassifier
+        """
+        self.module_.eval()
+        self.module_.compile_sparse(threshold)
+        return self
+
+    def compile(self, dtype=np.float32):
+        """
+        Export the fitted model as a torch-free affine decoder.
+
+        In eval mode, the module is an affine map per study (embedder,
+        batch-norm with running statistics, third-layer head), which is
+        fused into a single coefficient matrix and bias.
+
+        Parameters
+        ----------
+        dtype : np.dtype
+            Precision of the decoder
+
+        Returns
+        -------
+        decoder: cogspaces.classification.compiled.CompiledDecoder
+            Decoder taking the same inputs as `predict`
+        """
+        coefs, intercepts = {}, {}
+        for study, (coef, bias) in self.module_.compute_affine().items():
+            # Pruned atoms have no weight
+            coef = self.expand_pruned(coef.numpy())
+            coefs[study] = np.ascontiguousarray(coef, dtype=dtype)
+            intercepts[study] = bias.numpy().astype(dtype)
+        return CompiledDecoder(coefs, intercepts)
+
     def predict_log_proba(self, X):
         """
         Predict the log probabilities for input data (dictionary of study, data)
 
         Parameters
         ----------
-        X : Dict[str, np.ndarray]
-            Dictionary of input data (one array per study).
+        X : Dict[str, np.ndarray or ChunkedArray]
+            Dictionary of input data (one array per study). Chunked arrays
+            (see `cogspaces.datasets.chunked`) are predicted chunk by chunk.
 
         Returns
         -------
@@ -375,18 +820,34 @@ class MultiStudyClassifier(BaseEstimator):
             Predicted label log probabilities.
         """
 
-        X_ = {}
+        X_, chunked = {}, {}
         for study, this_X in X.items():
+            if hasattr(this_X, 'iter_chunks'):
+                chunked[study] = this_X
+                continue
+            if hasattr(self, 'input_support_'):
+                this_X = this_X[:, self.input_support_]
             this_X = torch.from_numpy(this_X).float()
             X_[study] = this_X
         with torch.no_grad():
             self.module_.eval()
-            preds = self.module_(X_)
-        return {study: pred.data.numpy() for study, pred in
-                preds.items()}
-
-
-    def predict(self, X):
+            preds = {study: pred.data.numpy() for study, pred
+                     in self.module_(X_).items()} if X_ else {}
+            # Chunked arrays are predicted chunk by chunk
+            for study, this_X in chunked.items():
+                these_preds = []
+                for chunk in this_X.iter_chunks():
+                    if hasattr(self, 'input_support_'):
+                        chunk = chunk[:, self.input_support_]
+                    chunk = torch.from_numpy(
+                        np.ascontiguousarray(chunk)).float()
+                    these_preds.append(
+                        self.module_({study: chunk})[study].data.numpy())
+                preds[study] = np.concatenate(these_preds)
+        return {study: preds[study] for study in X}
+
+
+    def predict(self, X, chunk_size=None, out=None):
         """
         Predict the labels for input data (dictionary of study, data)
 
@@ -395,12 +856,38 @@ class MultiStudyClassifier(BaseEstimator):
         X : Dict[str, np.ndarray]
             Dictionary of input data (one array per study).
 
+        chunk_size : int or None
+            If not None, predict `chunk_size` samples at a time using the
+            compiled decoder (see `predict_iter`), and return label arrays.
+            Inputs may then be memory-mapped arrays or iterables of chunks.
+
+        out : Dict[str, np.ndarray] or None
+            Preallocated label arrays (e.g. memory-mapped) to write the
+            predictions of each study into, when `chunk_size` is not None
+
         Returns
         -------
-        y: Dict[str, pd.Dataframe]
+        y: Dict[str, pd.Dataframe] or Dict[str, np.ndarray]
             Predicted label. Must be processed through
-             `cogspaces.preprocessing.MultiTargetEncoder`.
+             `cogspaces.preprocessing.MultiTargetEncoder`. If `chunk_size`
+             is not None, label arrays, `out` if provided.
         """
+        if chunk_size is not None:
+            labels = {study: [] for study in X}
+            offsets = {study: 0 for study in X}
+            for study, these_labels in self.predict_iter(X, chunk_size):
+                if out is not None:
+                    offset = offsets[study]
+                    out[study][offset:offset + len(these_labels)] \
+                        = these_labels
+                    offsets[study] += len(these_labels)
+                else:
+                    labels[study].append(these_labels)
+            if out is not None:
+                return out
+            return {study: np.concatenate(these_labels)
+                    if these_labels else np.empty(0, dtype=np.intp)
+                    for study, these_labels in labels.items()}
         preds = self.predict_log_proba(X)
         preds = {study: np.argmax(pred, axis=1)
                  for study, pred in preds.items()}
@@ -413,9 +900,109 @@ class MultiStudyClassifier(BaseEstimator):
                      subject=0))
         return dfs
 
+    def predict_iter(self, X, chunk_size=1024):
+        """
+        Predict the labels for input data, with memory bounded by
+        `chunk_size`. See `CompiledDecoder.predict_iter`.
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray or Iterable[np.ndarray]]
+            Dictionary of input data (one array per study). Arrays may be
+            memory-mapped, or given as iterables of 2D chunks.
+
+        chunk_size : int
+            Number of samples processed at once
+
+        Yields
+        ------
+        study : str
+            Study of the chunk
+
+        labels : np.ndarray, shape (n_chunk_samples, )
+            Predicted labels of the next samples of `study`
+        """
+        return self.compile().predict_iter(X, chunk_size=chunk_size)
+
+    def save(self, filename):
+        """
+        Save the estimator in a flat, memory-mappable file.
+
+        See `cogspaces.serialization`.
+
+        Parameters
+        ----------
+        filename : str
+        """
+        arrays, meta = self._to_arrays()
+        save_arrays(filename, arrays, meta)
+
+    @classmethod
+    def load(cls, filename, studies=None, mmap_mode='c'):
+        """
+        Load an estimator saved with `save`.
+
+        Parameters
+        ----------
+        filename : str
+
+        studies : Iterable[str] or None
+            Studies whose classification heads are loaded, all if None. The
+            tensors of other studies are not read.
+
+        mmap_mode : {'r', 'c'} or None
+            See `cogspaces.serialization.load_arrays`. With the default
+            copy-on-write mode, weights are read lazily from disk.
+
+        Returns
+        -------
+        estimator: MultiStudyClassifier
+        """
+        header, _ = read_header(filename)
+        names = [name for name in header['tensors']
+                 if not name.startswith('module_.')]
+        names += module_array_names(header, studies)
+        arrays, meta = load_arrays(filename, names, mmap_mode=mmap_mode)
+        estimator = cls(**meta['params'])
+        estimator._from_arrays(arrays, meta, studies=studies)
+        return estimator
+
+    def _to_arrays(self):
+        arrays = {}
+        attributes = {}
+        for key, value in self.__dict__.items():
+            if key == 'module_':
+                module_arrays, module_config = module_to_arrays(value)
+                arrays.update({'module_.%s' % name: array
+                               for name, array in module_arrays.items()})
+            elif key.endswith('_') and isinstance(value, np.ndarray):
+                arrays[key] = value
+            elif key.endswith('_'):
+                attributes[key] = value
+        meta = dict(params=self.get_params(), attributes=attributes)
+        if 'module_' in self.__dict__:
+            meta['module'] = module_config
+        # Round-trip through JSON for NumPy scalars
+        meta = json.loads(json.dumps(meta, default=_to_builtin))
+        return arrays, meta
+
+    def _from_arrays(self, arrays, meta, studies=None):
+        self.__dict__.update(meta['attributes'])
+        module_arrays = {}
+        for name, array in arrays.items():
+            if name.startswith('module_.'):
+                module_arrays[name[len('module_.'):]] = array
+            else:
+                setattr(self, name, array)
+        if 'module' in meta:
+            self.module_ = module_from_arrays(module_arrays, meta['module'],
+                                              studies=studies)
+            self.module_.eval()
+
     def __getstate__(self):
         """
-        Override serialization for pytorch components.
+        Override serialization for pytorch components: the module is
+        stored as NumPy arrays, pickled without copies.
 
         Returns
         -------
@@ -423,14 +1010,9 @@ class MultiStudyClassifier(BaseEstimator):
             Serialized state
         """
         state = self.__dict__.copy()
-        for key in ['module_']:
-            if key in state:
-                val = state.pop(key)
-                with tempfile.SpooledTemporaryFile() as f:
-                    torch.save(val, f)
-                    f.seek(0)
-                    state[key] = f.read()
-
+        if 'module_' in state:
+            arrays, config = module_to_arrays(state.pop('module_'))
+            state['module_'] = dict(arrays=arrays, config=config)
         return state
 
     def __setstate__(self, state):
@@ -445,14 +1027,22 @@ class MultiStudyClassifier(BaseEstimator):
         -------
 
         """
-        for key in ['module_']:
-            if key not in state:
-                continue
-            dump = state.pop(key)
-            with tempfile.SpooledTemporaryFile() as f:
-                f.write(dump)
-                f.seek(0)
-                val = torch.load(f)
-            state[key] = val
+        if 'module_' in state:
+            dump = state.pop('module_')
+            if isinstance(dump, bytes):
+                # Pickles of former versions hold a torch archive
+                with tempfile.SpooledTemporaryFile() as f:
+                    f.write(dump)
+                    f.seek(0)
+                    try:
+                        module = torch.load(f, weights_only=False)
+                    except TypeError:  # torch < 1.13
+                        f.seek(0)
+                        module = torch.load(f)
+            else:
+                arrays = {name: np.require(array, requirements='W')
+                          for name, array in dump['arrays'].items()}
+                module = module_from_arrays(arrays, dump['config'])
+            state['module_'] = module
 
         self.__dict__.update(state)
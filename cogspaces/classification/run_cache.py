@@ -0,0 +1,144 @@
+"""
+Persistent cache of the runs of `EnsembleClassifier`.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from os.path import join
+
+import numpy as np
+import torch
+
+# Parameters that do not change the result of a run
+_IGNORED_PARAMS = ('n_jobs', 'verbose')
+
+
+class RunCache(object):
+    def __init__(self, location, max_bytes=2 ** 32):
+        """
+        Content-addressed cache of the runs of an ensemble, on disk.
+
+        Each run `(embedder_weight, full_coef, full_bias)` is stored in its
+        own uncompressed .npz file, named after a key built from the
+        fingerprint of the training data, the parameters of the estimator
+        and the seed of the run. Unlike `joblib.Memory`, neither the
+        estimator nor the data are hashed at each call. When the cache
+        outgrows `max_bytes`, the least recently used runs are removed.
+
+        Parameters
+        ----------
+        location : str
+            Folder of the cache
+
+        max_bytes : int
+            Size budget of the cache, in bytes
+        """
+        self.location = location
+        self.max_bytes = max_bytes
+        os.makedirs(location, exist_ok=True)
+
+    def key(self, fingerprint, estimator, seed, engine='joblib'):
+        """
+        Parameters
+        ----------
+        fingerprint : str
+            Fingerprint of the training data, e.g.
+            `_SharedData.fingerprint`
+
+        estimator : MultiStudyClassifier
+            Estimator fitted by the run
+
+        seed : int
+            Seed of the run
+
+        engine : str
+            Engine of the ensemble
+
+        Returns
+        -------
+        key : str
+        """
+        params = {name: value for name, value
+                  in estimator.get_params(deep=False).items()
+                  if name not in _IGNORED_PARAMS}
+        description = json.dumps(
+            [fingerprint, type(estimator).__name__, params, int(seed),
+             engine], sort_keys=True, default=str)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        run : Tuple or None
+            `(embedder_weight, full_coef, full_bias)`, as returned by
+            `_compute_coefs`, or None if the run is not cached
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as arrays:
+                studies = arrays['studies'].tolist()
+                weight = torch.from_numpy(arrays['weight'])
+                full_coef = {study: torch.from_numpy(arrays['coef_%i' % i])
+                             for i, study in enumerate(studies)}
+                full_bias = {study: torch.from_numpy(arrays['bias_%i' % i])
+                             for i, study in enumerate(studies)}
+        except (IOError, KeyError, ValueError):
+            return None
+        # Mark as recently used
+        os.utime(filename)
+        return weight, full_coef, full_bias
+
+    def put(self, key, run):
+        """
+        Parameters
+        ----------
+        key : str
+
+        run : Tuple
+            `(embedder_weight, full_coef, full_bias)`
+        """
+        weight, full_coef, full_bias = run
+        studies = list(full_coef.keys())
+        arrays = dict(studies=np.array(studies), weight=weight.numpy())
+        for i, study in enumerate(studies):
+            arrays['coef_%i' % i] = full_coef[study].numpy()
+            arrays['bias_%i' % i] = full_bias[study].numpy()
+        # Write then rename, so that readers never see partial files
+        fd, temp_filename = tempfile.mkstemp(dir=self.location,
+                                             suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_filename, self._filename(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used runs beyond `max_bytes`."""
+        entries = []
+        for filename in os.listdir(self.location):
+            if filename.endswith('.npz'):
+                stat = os.stat(join(self.location, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        entries.sort()
+        nbytes = sum(size for _, size, _ in entries)
+        # The newest run is kept, even if larger than max_bytes
+        for _, size, filename in entries[:-1]:
+            if nbytes <= self.max_bytes:
+                break
+            try:
+                os.remove(join(self.location, filename))
+            except FileNotFoundError:
+                pass
+            nbytes -= size
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def _filename(self, key):
+        return join(self.location, '%s.npz' % key)
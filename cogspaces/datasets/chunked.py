@@ -0,0 +1,696 @@
+"""
+Out-of-core, row-chunked storage of voxel-level data.
+
+A chunked store is a directory with one sub-directory per study. Each study
+holds its rows in fixed-size chunks (`chunk_00000.npy`, ...), stored as
+float32 or float16, its targets as categorical codes (`targets.npz`, see
+`cogspaces.datasets.store.encode_targets`) and a manifest
+(`manifest.json`). The manifest is written last, so that a study is
+complete whenever it exists. Studies are either written sequentially
+(`ChunkedStudyWriter`), or preallocated and filled chunk by chunk in
+parallel (`PreallocatedStudy`). The manifest may identify the map of each
+row, and the parameters that produced the rows, so that new maps are
+appended to a study rather than rewriting it (see `plan_update`).
+Loading returns `ChunkedArray`s, that memory-map the chunks and read them
+one at a time.
+"""
+
+import hashlib
+import json
+import numbers
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from cogspaces.datasets.store import decode_targets, encode_targets
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+# Default size of a chunk, in bytes
+CHUNK_BYTES = 2 ** 26
+
+
+class ChunkedArray(object):
+    def __init__(self, chunks, dtype=np.float32, rows=None, transforms=()):
+        """
+        2D array split in row chunks, e.g. memory-mapped chunk files.
+
+        Row indexing returns a lazy view, and `iter_chunks` reads the rows
+        chunk by chunk, so that whole arrays are never loaded, unless
+        converted with `np.asarray`.
+
+        Parameters
+        ----------
+        chunks : List[np.ndarray]
+            Chunks of rows, with the same number of columns
+
+        dtype : np.dtype
+            Data type of the rows returned by the array
+
+        rows : np.ndarray or None
+            Rows of the chunks viewed by the array, all if None
+
+        transforms : Tuple[Callable]
+            Functions applied to each chunk of rows, in order (see `map`)
+        """
+        self.chunks = chunks
+        self.dtype = np.dtype(dtype)
+        self.rows = rows
+        self.transforms = tuple(transforms)
+        self.offsets = np.cumsum([0] + [len(chunk) for chunk in chunks])
+
+    @property
+    def shape(self):
+        n_samples = (self.offsets[-1] if self.rows is None
+                     else len(self.rows))
+        return int(n_samples), self.chunks[0].shape[1]
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def chunk_size(self):
+        return max(len(chunk) for chunk in self.chunks)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            rows, columns = index[0], index[1:]
+            if isinstance(rows, numbers.Integral):
+                return self[rows][columns]
+            return np.asarray(self[rows])[(slice(None), ) + columns]
+        if isinstance(index, numbers.Integral):
+            return np.asarray(self[[index]])[0]
+        rows = np.arange(len(self))[index]
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return ChunkedArray(self.chunks, dtype=self.dtype, rows=rows,
+                            transforms=self.transforms)
+
+    def map(self, transform):
+        """
+        Lazily apply a row-wise function to the array.
+
+        Parameters
+        ----------
+        transform : Callable
+            Function mapping a 2D chunk of rows to a 2D array of the same
+            shape, e.g. `StandardScaler().transform`
+
+        Returns
+        -------
+        array : ChunkedArray
+        """
+        return ChunkedArray(self.chunks, dtype=self.dtype, rows=self.rows,
+                            transforms=self.transforms + (transform, ))
+
+    def iter_chunks(self, chunk_size=None):
+        """
+        Parameters
+        ----------
+        chunk_size : int or None
+            Maximum number of rows of each chunk, the size of the stored
+            chunks if None
+
+        Yields
+        ------
+        chunk : np.ndarray
+            Next rows of the array
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        if self.rows is None:
+            for chunk in self.chunks:
+                for start in range(0, len(chunk), chunk_size):
+                    yield self._transform(chunk[start:start + chunk_size])
+        else:
+            for start in range(0, len(self.rows), chunk_size):
+                yield self._transform(
+                    self._take(self.rows[start:start + chunk_size]))
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def copyto(self, out):
+        """
+        Copy the rows of the array into `out`, chunk by chunk.
+
+        Parameters
+        ----------
+        out : np.ndarray, shape (n_samples, n_features)
+            Destination, e.g. a memory-mapped array or the view of a tensor
+
+        Returns
+        -------
+        out : np.ndarray
+        """
+        start = 0
+        for chunk in self.iter_chunks():
+            np.copyto(out[start:start + len(chunk)], chunk, casting='unsafe')
+            start += len(chunk)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            dtype = self.dtype
+        return self.copyto(np.empty(self.shape, dtype=dtype))
+
+    def _take(self, rows):
+        """Gather rows, reading each chunk once."""
+        out = np.empty((len(rows), self.shape[1]), dtype=self.dtype)
+        chunk_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+        for chunk_id in np.unique(chunk_ids):
+            mask = chunk_ids == chunk_id
+            out[mask] = self.chunks[chunk_id][rows[mask]
+                                              - self.offsets[chunk_id]]
+        return out
+
+    def _transform(self, chunk):
+        chunk = np.asarray(chunk, dtype=self.dtype)
+        for transform in self.transforms:
+            chunk = transform(chunk)
+        return chunk
+
+
+class ChunkedStudyWriter(object):
+    def __init__(self, dirname, study, chunk_size=None, dtype=np.float32):
+        """
+        Writer of the rows of a study in a chunked store.
+
+        Rows are appended block by block, and written chunk by chunk, so
+        that a study never needs to fit in memory. `close` writes the
+        targets and the manifest.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory of the store
+
+        study : str
+
+        chunk_size : int or None
+            Number of rows of each chunk. If None, chunks are about
+            `CHUNK_BYTES` large
+
+        dtype : {np.float32, np.float16}
+            Data type of the stored rows
+        """
+        self.dirname = join(dirname, study)
+        self.study = study
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype)
+
+        os.makedirs(self.dirname, exist_ok=True)
+        # The study is incomplete until closed
+        for filename in os.listdir(self.dirname):
+            if filename in [MANIFEST, 'layout.json'] \
+                    or filename.endswith('.done'):
+                os.remove(join(self.dirname, filename))
+        self.chunks_ = []
+        self.n_samples_ = 0
+        self._buffer = None
+        self._cursor = 0
+
+    def append(self, X):
+        """
+        Parameters
+        ----------
+        X : np.ndarray, shape (n_samples, n_features)
+            Next rows of the study
+        """
+        if self._buffer is None:
+            chunk_size = self.chunk_size
+            if chunk_size is None:
+                chunk_size = max(1, CHUNK_BYTES // (X.shape[1]
+                                                    * self.dtype.itemsize))
+            self._buffer = np.empty((chunk_size, X.shape[1]),
+                                    dtype=self.dtype)
+        start = 0
+        while start < len(X):
+            n = min(len(X) - start, len(self._buffer) - self._cursor)
+            self._buffer[self._cursor:self._cursor + n] = X[start:start + n]
+            self._cursor += n
+            start += n
+            if self._cursor == len(self._buffer):
+                self._flush()
+
+    def close(self, targets):
+        """
+        Write the last chunk, the targets and the manifest.
+
+        Parameters
+        ----------
+        targets : pd.DataFrame
+            Targets of the rows of the study
+        """
+        if len(targets) != self.n_samples_ + self._cursor:
+            raise ValueError('Expected %i targets, got %i'
+                             % (self.n_samples_ + self._cursor,
+                                len(targets)))
+        self._flush()
+        n_features = 0 if self._buffer is None else self._buffer.shape[1]
+        _write_manifest(self.dirname, self.study, self.chunks_, n_features,
+                        self.dtype, targets)
+
+    def _flush(self):
+        if self._cursor == 0:
+            return
+        filename = 'chunk_%05i.npy' % len(self.chunks_)
+        np.save(join(self.dirname, filename), self._buffer[:self._cursor])
+        self.chunks_.append(dict(filename=filename, n_samples=self._cursor))
+        self.n_samples_ += self._cursor
+        self._cursor = 0
+
+
+class PreallocatedStudy(object):
+    def __init__(self, dirname, study, n_samples, n_features,
+                 chunk_size=None, dtype=np.float32, params=None,
+                 append=False, maps=None):
+        """
+        Study of a chunked store with preallocated chunks, filled in any
+        order, possibly by several processes.
+
+        Filled chunks are marked as done, so that an interrupted filling
+        resumes with the pending chunks. Instances only hold paths, and
+        are cheap to send to workers. `close` writes the targets and the
+        manifest.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory of the store
+
+        study : str
+
+        n_samples : int
+            Number of rows to write
+
+        n_features : int
+
+        chunk_size : int or None
+            Number of rows of each chunk. If None, chunks are about
+            `CHUNK_BYTES` large
+
+        dtype : {np.float32, np.float16}
+            Data type of the stored rows
+
+        params : Dict or None
+            Parameters that produced the rows, recorded in the manifest
+
+        append : bool
+            Append the rows to the complete study of the store, if any.
+            Readers see the previous rows until `close`
+
+        maps : List or None
+            Identifiers of the rows to write, e.g. `[name, content hash]` of
+            the maps they come from. An interrupted filling is only resumed
+            for the same maps. Recorded in the manifest by `close`
+        """
+        self.dirname = join(dirname, study)
+        self.study = study
+        self.n_samples = n_samples
+        self.n_features = n_features
+        self.dtype = np.dtype(dtype)
+        self.params = params
+        self.maps = maps
+        if chunk_size is None:
+            chunk_size = max(1, CHUNK_BYTES // (n_features
+                                                * self.dtype.itemsize))
+        self.chunk_size = chunk_size
+
+        self.base_ = read_manifest(dirname, study) if append else None
+        if self.base_ is not None and (
+                self.base_['n_features'] != n_features
+                or self.base_['dtype'] != self.dtype.name):
+            raise ValueError('Cannot append rows of another shape or type'
+                             ' to %s' % study)
+        first = 0 if self.base_ is None else len(self.base_['chunks'])
+        self.starts_ = list(range(0, n_samples, chunk_size))
+        self.chunks_ = [dict(filename='chunk_%05i.npy' % (first + i),
+                             n_samples=min(chunk_size, n_samples - start))
+                        for i, start in enumerate(self.starts_)]
+
+        self._done = False
+        if not append and self.complete:
+            manifest = read_manifest(dirname, study)
+            if (manifest['chunks'] == self.chunks_
+                    and manifest['n_features'] == n_features
+                    and manifest['dtype'] == self.dtype.name
+                    and manifest.get('params') == params
+                    and (maps is None or manifest.get('maps') == maps)):
+                self._done = True
+                return
+        maps_hash = None if maps is None else hashlib.sha1(
+            json.dumps(maps).encode('utf-8')).hexdigest()
+        layout = dict(n_samples=n_samples, n_features=n_features,
+                      dtype=self.dtype.name, chunk_size=chunk_size,
+                      first=first, params=params, maps=maps_hash)
+        layout_file = join(self.dirname, 'layout.json')
+        if os.path.exists(layout_file):
+            with open(layout_file, 'r') as f:
+                if json.load(f) == layout:
+                    return
+        os.makedirs(self.dirname, exist_ok=True)
+        # Remove markers, and chunks that are not part of the new layout
+        keep = [chunk['filename'] for chunk in self.chunks_]
+        if self.base_ is not None:
+            keep += [chunk['filename'] for chunk in self.base_['chunks']]
+        for filename in os.listdir(self.dirname):
+            if filename.endswith('.npy') and filename not in keep \
+                    or filename.endswith('.done') \
+                    or filename == MANIFEST and self.base_ is None:
+                os.remove(join(self.dirname, filename))
+        # Chunk files are sparse until written
+        for chunk in self.chunks_:
+            np.lib.format.open_memmap(
+                join(self.dirname, chunk['filename']), mode='w+',
+                dtype=self.dtype, shape=(chunk['n_samples'], n_features))
+        with open(layout_file, 'w') as f:
+            json.dump(layout, f)
+
+    @property
+    def complete(self):
+        return os.path.exists(join(self.dirname, MANIFEST))
+
+    def rows(self, i):
+        """Rows written in the i-th chunk."""
+        return slice(self.starts_[i],
+                     self.starts_[i] + self.chunks_[i]['n_samples'])
+
+    def pending(self):
+        """
+        Returns
+        -------
+        chunks : List[int]
+            Chunks that are not marked as done
+        """
+        if self._done:
+            return []
+        return [i for i, chunk in enumerate(self.chunks_)
+                if not os.path.exists(self._marker(i))]
+
+    def write(self, i, X, offset=0):
+        """
+        Write rows in a chunk.
+
+        Parameters
+        ----------
+        i : int
+            Index of the chunk
+
+        X : np.ndarray, shape (n_rows, n_features)
+
+        offset : int
+            First row of the chunk to write
+        """
+        chunk = np.load(join(self.dirname, self.chunks_[i]['filename']),
+                        mmap_mode='r+')
+        chunk[offset:offset + len(X)] = X
+        chunk.flush()
+
+    def mark_done(self, i):
+        open(self._marker(i), 'w').close()
+
+    def close(self, targets, maps=None, drop=()):
+        """
+        Write the targets and the manifest, once all chunks are done.
+
+        Parameters
+        ----------
+        targets : pd.DataFrame
+            Targets of the written rows
+
+        maps : List or None
+            Identifiers of the written rows, e.g. `[name, content hash]`
+            of the maps they come from, recorded in the manifest. Defaults
+            to the maps given at construction
+
+        drop : Iterable[int]
+            Rows of the previous study to hide, when appending
+        """
+        pending = self.pending()
+        if pending:
+            raise ValueError('%i chunks of %s are not done'
+                             % (len(pending), self.study))
+        if len(targets) != self.n_samples:
+            raise ValueError('Expected %i targets, got %i'
+                             % (self.n_samples, len(targets)))
+        if self._done:
+            return
+        if maps is None:
+            maps = self.maps
+        chunks, rows = self.chunks_, None
+        if self.base_ is not None:
+            base = self.base_
+            with np.load(join(self.dirname, 'targets.npz')) as arrays:
+                base_targets = decode_targets(dict(arrays), base['columns'])
+            targets = pd.concat([base_targets, targets], ignore_index=True)
+            chunks = base['chunks'] + chunks
+            if maps is not None or 'maps' in base:
+                maps = (base.get('maps', [None] * base['n_samples'])
+                        + (maps if maps is not None
+                           else [None] * self.n_samples))
+            drop = set(drop)
+            rows = ([row for row in live_rows(base) if row not in drop]
+                    + list(range(base['n_samples'],
+                                 base['n_samples'] + self.n_samples)))
+        _write_manifest(self.dirname, self.study, chunks, self.n_features,
+                        self.dtype, targets, maps=maps, params=self.params,
+                        rows=rows)
+        for i in range(len(self.chunks_)):
+            os.remove(self._marker(i))
+        os.remove(join(self.dirname, 'layout.json'))
+
+    def _marker(self, i):
+        return join(self.dirname, self.chunks_[i]['filename'] + '.done')
+
+
+def _write_manifest(study_dir, study, chunks, n_features, dtype, targets,
+                    maps=None, params=None, rows=None):
+    """Write the targets, then the manifest that completes a study."""
+    np.savez(join(study_dir, 'targets.npz'), **encode_targets(targets))
+    manifest = dict(version=VERSION, study=study,
+                    n_samples=sum(chunk['n_samples'] for chunk in chunks),
+                    n_features=n_features, dtype=np.dtype(dtype).name,
+                    chunks=chunks, columns=list(map(str, targets.columns)))
+    for key, value in [('maps', maps), ('params', params), ('rows', rows)]:
+        if value is not None:
+            manifest[key] = value
+    with open(join(study_dir, MANIFEST + '.tmp'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(join(study_dir, MANIFEST + '.tmp'),
+               join(study_dir, MANIFEST))
+
+
+def read_manifest(dirname, study):
+    """
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store
+
+    study : str
+
+    Returns
+    -------
+    manifest : Dict or None
+        Manifest of the study, None if the study is not complete
+    """
+    filename = join(dirname, study, MANIFEST)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    if manifest['version'] > VERSION:
+        raise ValueError('Unsupported store version %i'
+                         % manifest['version'])
+    return manifest
+
+
+def live_rows(manifest):
+    """Rows of a study that are not hidden, in order."""
+    return manifest.get('rows', list(range(manifest['n_samples'])))
+
+
+def plan_update(dirname, study, maps, params):
+    """
+    Find the maps of a study that are not in a chunked store yet.
+
+    Maps are identified by `[name, content hash]`. A map is new if the
+    study does not hold it with the same hash, and the rows of the
+    previous versions of changed maps are to be dropped. If the store was
+    written with other parameters, all maps are new.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store
+
+    study : str
+
+    maps : List
+        `[name, content hash]` of each map of the study
+
+    params : Dict
+        Parameters of the processing of the maps
+
+    Returns
+    -------
+    new : List[int]
+        Indices of the maps to process
+
+    drop : List[int]
+        Rows of the study to drop
+
+    append : bool
+        Whether new rows are to be appended to the study, or the study
+        rewritten
+    """
+    manifest = read_manifest(dirname, study)
+    if (manifest is None or manifest.get('params') != params
+            or 'maps' not in manifest):
+        return list(range(len(maps))), [], False
+    rows = live_rows(manifest)
+    stored = {tuple(manifest['maps'][row]): row for row in rows}
+    names = {manifest['maps'][row][0]: row for row in rows}
+    new = [i for i, this_map in enumerate(maps)
+           if tuple(this_map) not in stored]
+    drop = [names[maps[i][0]] for i in new if maps[i][0] in names]
+    return new, drop, True
+
+
+def write_chunked_study(dirname, study, X, targets, chunk_size=None,
+                        dtype=np.float32):
+    """
+    Write the data of a study in a chunked store.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store
+
+    study : str
+
+    X : np.ndarray or Iterable[np.ndarray]
+        Rows of the study, or successive blocks of rows
+
+    targets : pd.DataFrame
+        Targets of the rows
+
+    chunk_size : int or None
+        Number of rows of each chunk, see `ChunkedStudyWriter`
+
+    dtype : {np.float32, np.float16}
+        Data type of the stored rows
+    """
+    writer = ChunkedStudyWriter(dirname, study, chunk_size=chunk_size,
+                                dtype=dtype)
+    if hasattr(X, 'shape'):
+        X = [X]
+    for this_X in X:
+        writer.append(this_X)
+    writer.close(targets)
+
+
+def chunked_studies(dirname):
+    """
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store
+
+    Returns
+    -------
+    studies : List[str]
+        Sorted studies of the store that are complete
+    """
+    if not os.path.exists(dirname):
+        return []
+    return sorted(study for study in os.listdir(dirname)
+                  if os.path.exists(join(dirname, study, MANIFEST)))
+
+
+def load_chunked_study(dirname, study, dtype=np.float32, mmap_mode='r'):
+    """
+    Load a study written by `ChunkedStudyWriter`.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store
+
+    study : str
+
+    dtype : np.dtype
+        Data type of the rows returned by the array. float16 chunks are
+        cast chunk by chunk
+
+    mmap_mode : {'r', 'c'}
+        Memory-map the chunks read-only ('r') or copy-on-write ('c')
+
+    Returns
+    -------
+    X : ChunkedArray
+        Memory-mapped rows of the study
+
+    y : pd.DataFrame
+        Targets of the study
+    """
+    study_dir = join(dirname, study)
+    manifest = read_manifest(dirname, study)
+    if manifest is None:
+        raise FileNotFoundError('No complete study %s in %s'
+                                % (study, dirname))
+    chunks = [np.load(join(study_dir, chunk['filename']),
+                      mmap_mode=mmap_mode)
+              for chunk in manifest['chunks']]
+    if not chunks:
+        chunks = [np.empty((0, manifest['n_features']),
+                           dtype=manifest['dtype'])]
+    with np.load(join(study_dir, 'targets.npz')) as arrays:
+        y = decode_targets(dict(arrays), manifest['columns'])
+    if 'rows' not in manifest:
+        return ChunkedArray(chunks, dtype=dtype), y
+    # Rows hidden by updates are skipped
+    rows = np.array(manifest['rows'], dtype=np.int64)
+    return (ChunkedArray(chunks, dtype=dtype, rows=rows),
+            y.iloc[rows].reset_index(drop=True))
+
+
+def load_chunked_studies(dirname, studies=None, dtype=np.float32,
+                         mmap_mode='r'):
+    """
+    Load several studies of a chunked store.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory of the store
+
+    studies : List[str] or None
+        Studies to load, all the complete ones if None
+
+    dtype : np.dtype
+
+    mmap_mode : {'r', 'c'}
+
+    Returns
+    -------
+    Xs : Dict[str, ChunkedArray]
+
+    ys : Dict[str, pd.DataFrame]
+    """
+    if studies is None:
+        studies = chunked_studies(dirname)
+    Xs, ys = {}, {}
+    for study in studies:
+        Xs[study], ys[study] = load_chunked_study(dirname, study,
+                                                  dtype=dtype,
+                                                  mmap_mode=mmap_mode)
+    return Xs, ys
@@ -1,11 +1,11 @@
 from os.path import join
 from typing import List
 
+import numpy as np
 import pandas as pd
-from joblib import load
 from nilearn.datasets import fetch_neurovault_ids
 
-from cogspaces.datasets.derivative import STUDY_LIST
+from cogspaces.datasets.chunked import load_chunked_studies
 
 nv_ids = {'archi': 4339, 'hcp': 4337, 'brainomics': 4341, 'camcan': 4342,
           'la5c': 4343, 'brainpedia': 1952}
@@ -29,22 +29,62 @@ def _assemble(images, images_meta, study):
     return df
 
 
-def fetch_contrasts(studies: str or List[str] = 'all', data_dir=None):
+def fetch_contrasts(studies: str or List[str] = 'all', data_dir=None,
+                    mode='download_new'):
+    """Fetch the contrast maps of studies from NeuroVault.
+
+    Parameters
+    ----------
+    studies: str or List[str]
+        Studies to fetch, all of `nv_ids` if 'all'
+    data_dir: string, optional
+        Path of the data directory
+    mode: {'download_new', 'overwrite', 'offline'}
+        'download_new' only downloads the maps that are not on disk,
+        'overwrite' downloads all maps again, so that updated maps are
+        refreshed, and 'offline' uses the maps on disk only. See
+        `nilearn.datasets.fetch_neurovault_ids`
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Filenames of the maps ('z_map'), with their study, subject, task
+        and contrast
+    """
     dfs = []
     if studies == 'all':
         studies = nv_ids.keys()
     for study in studies:
         if study not in nv_ids:
             return ValueError('Wrong dataset.')
-        data = fetch_neurovault_ids([nv_ids[study]], data_dir=data_dir, verbose=10,
-                                    mode='download_new')
+        data = fetch_neurovault_ids([nv_ids[study]], data_dir=data_dir,
+                                    verbose=10, mode=mode)
         dfs.append(_assemble(data['images'], data['images_meta'], study))
     return pd.concat(dfs)
 
 
-def load_masked_contrasts(data_dir):
-    Xs, ys = {}, {}
-    for study in STUDY_LIST:
-        Xs[study], ys[study] = load(join(data_dir, 'masked',
-                                         'data_%s.npy'), mmap_mode='r')
-    return Xs, ys
\ No newline at end of file
+def load_masked_contrasts(data_dir, studies=None, dtype=np.float32):
+    """Load the masked contrasts written by `exps/reduce.py`.
+
+    Parameters
+    ----------
+    data_dir: string
+        Path of the data directory, holding the chunked store of masked
+        contrasts in `masked/` (see `cogspaces.datasets.chunked`)
+    studies: List[str] or None
+        Studies to load, all the masked ones if None
+    dtype: np.dtype
+        Data type of the returned rows
+
+    Returns
+    -------
+    Xs: Dict[str, ChunkedArray]
+        Memory-mapped masked contrasts of each study, read chunk by chunk
+    ys: Dict[str, pd.DataFrame]
+        Targets of each study
+    """
+    Xs, ys = load_chunked_studies(join(data_dir, 'masked'), studies=studies,
+                                  dtype=dtype)
+    for study, y in ys.items():
+        y['study_contrast'] = y['study'] + '_' + y['contrast']
+    return Xs, ys
@@ -7,6 +7,8 @@ import pandas as pd
 from joblib import load
 from sklearn.datasets.base import Bunch
 
+from cogspaces.datasets.store import load_multi_study, store_exists, \
+    write_multi_study
 from cogspaces.datasets.utils import get_data_dir
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='h5py')
@@ -106,7 +108,43 @@ def fetch_reduced_loadings(data_dir=None, url=None, verbose=False,
     return params
 
 
-def load_reduced_loadings(data_dir=None, url=None, verbose=False, resume=True):
+def load_reduced_loadings(data_dir=None, url=None, verbose=False, resume=True,
+                          lazy=False):
+    """Load the reduced loadings of all studies.
+
+    Parameters
+    ----------
+    data_dir: string, optional
+        Path of the data directory. Used to force data storage in a non-
+        standard location. Default: None (meaning: default)
+    url: string, optional
+        Download URL of the dataset. Overwrite the default URL.
+    lazy: bool, optional
+        Return lazy mappings over a consolidated, memory-mapped store of
+        the loadings (see `cogspaces.datasets.store`), built on first use
+        and rebuilt when the size or modification time of a loading file
+        changes. The loadings of a study are only read when accessed.
+
+    Returns
+    -------
+    Xs: Dict[str, np.ndarray] or Mapping[str, np.memmap]
+        Loadings of each study
+    ys: Dict[str, pd.DataFrame] or Mapping[str, pd.DataFrame]
+        Targets of each study
+    """
+    if lazy:
+        dirname = join(_get_dataset_dir('loadings',
+                                        data_dir=get_data_dir(data_dir),
+                                        verbose=0), 'consolidated')
+        loadings = fetch_reduced_loadings(data_dir, url, verbose, resume)
+        sources = [[os.path.basename(loadings[study]),
+                    os.path.getsize(loadings[study]),
+                    os.path.getmtime(loadings[study])]
+                   for study in STUDY_LIST]
+        if not store_exists(dirname, sources):
+            Xs, ys = load_reduced_loadings(data_dir, url, verbose, resume)
+            write_multi_study(Xs, ys, dirname, sources=sources)
+        return load_multi_study(dirname)
     loadings = fetch_reduced_loadings(data_dir, url, verbose, resume)
     del loadings['description']
     del loadings['data_dir']
@@ -0,0 +1,249 @@
+"""
+Consolidated, memory-mapped storage of multi-study data.
+
+A store is a directory holding the input data of all studies as one
+contiguous float32 array (`X.npy`), the targets of all studies as
+categorical codes (`targets.npz`), and an index of the studies and of their
+offsets (`index.json`). The index is written last, so that a store is
+complete whenever it exists. Loading returns lazy mappings: the data of a
+study is memory-mapped, and its targets decoded, on access.
+"""
+
+import json
+import os
+from collections.abc import Mapping
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+INDEX = 'index.json'
+VERSION = 1
+
+
+def write_multi_study(Xs, ys, dirname, sources=None):
+    """
+    Write multi-study data in a consolidated store.
+
+    Parameters
+    ----------
+    Xs : Dict[str, np.ndarray]
+        Input data of each study, with the same number of features
+
+    ys : Dict[str, pd.DataFrame]
+        Targets of each study, with the same columns
+
+    dirname : str
+        Directory of the store, created if needed
+
+    sources : List or None
+        JSON-serializable description of the files the data was read from,
+        e.g. their names, sizes and modification times, checked by
+        `store_exists`
+    """
+    os.makedirs(dirname, exist_ok=True)
+    # A store being rewritten is incomplete
+    if os.path.exists(join(dirname, INDEX)):
+        os.remove(join(dirname, INDEX))
+    studies = list(Xs.keys())
+    lengths = [len(Xs[study]) for study in studies]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+    n_features = Xs[studies[0]].shape[1]
+    X = np.lib.format.open_memmap(join(dirname, 'X.npy'), mode='w+',
+                                  dtype=np.float32,
+                                  shape=(offsets[-1], n_features))
+    for study, start, stop in zip(studies, offsets[:-1], offsets[1:]):
+        X[start:stop] = Xs[study]
+    X.flush()
+    del X
+
+    y = pd.concat([ys[study] for study in studies], ignore_index=True)
+    np.savez(join(dirname, 'targets.npz'), **encode_targets(y))
+
+    index = dict(version=VERSION, studies=studies, offsets=offsets,
+                 n_features=n_features, columns=list(map(str, y.columns)),
+                 sources=sources)
+    with open(join(dirname, INDEX + '.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(join(dirname, INDEX + '.tmp'), join(dirname, INDEX))
+
+
+def load_multi_study(dirname, mmap_mode='c'):
+    """
+    Load a store written by `write_multi_study`.
+
+    Parameters
+    ----------
+    dirname : str
+
+    mmap_mode : {'r', 'c'}
+        Memory-map the input data read-only ('r') or copy-on-write ('c')
+
+    Returns
+    -------
+    Xs : Mapping[str, np.memmap]
+        Lazy mapping of the input data of each study
+
+    ys : Mapping[str, pd.DataFrame]
+        Lazy mapping of the targets of each study
+    """
+    with open(join(dirname, INDEX), 'r') as f:
+        index = json.load(f)
+    if index['version'] > VERSION:
+        raise ValueError('Unsupported store version %i' % index['version'])
+    return (StudyArrays(dirname, index, mmap_mode=mmap_mode),
+            StudyTargets(dirname, index))
+
+
+def store_exists(dirname, sources=None):
+    """
+    Parameters
+    ----------
+    dirname : str
+
+    sources : List or None
+        If not None, the store must have been written from these sources
+
+    Returns
+    -------
+    exists : bool
+        Whether a complete, up-to-date store exists in `dirname`
+    """
+    if not os.path.exists(join(dirname, INDEX)):
+        return False
+    if sources is None:
+        return True
+    with open(join(dirname, INDEX), 'r') as f:
+        index = json.load(f)
+    # Round-trip through JSON, as the index
+    return index.get('sources') == json.loads(json.dumps(sources))
+
+
+def encode_targets(y):
+    """
+    Encode targets as categorical codes, one array pair per column.
+
+    Parameters
+    ----------
+    y : pd.DataFrame
+
+    Returns
+    -------
+    arrays : Dict[str, np.ndarray]
+        `codes_i` and sorted `categories_i` of the i-th column. Missing
+        values are coded as -1
+    """
+    arrays = {}
+    for i, column in enumerate(y.columns):
+        codes, categories = pd.factorize(y[column], sort=True)
+        categories = np.asarray(categories)
+        if categories.dtype == object:
+            categories = categories.astype(str)
+        dtype = np.int16 if len(categories) < 2 ** 15 else np.int32
+        arrays['codes_%i' % i] = codes.astype(dtype)
+        arrays['categories_%i' % i] = categories
+    return arrays
+
+
+def decode_targets(arrays, columns, start=None, stop=None):
+    """
+    Decode the rows `start:stop` of targets encoded by `encode_targets`.
+
+    Parameters
+    ----------
+    arrays : Dict[str, np.ndarray]
+
+    columns : List[str]
+
+    start, stop : int or None
+
+    Returns
+    -------
+    y : pd.DataFrame
+    """
+    decoded = {}
+    for i, column in enumerate(columns):
+        codes = arrays['codes_%i' % i][start:stop]
+        categories = arrays['categories_%i' % i]
+        if len(categories) == 0:
+            decoded[column] = np.full(len(codes), np.nan, dtype=object)
+            continue
+        values = categories[codes]
+        if values.dtype.kind == 'U':
+            values = values.astype(object)
+        missing = codes < 0
+        if missing.any():
+            values = values.astype(object)
+            values[missing] = np.nan
+        decoded[column] = values
+    return pd.DataFrame(decoded, columns=columns)
+
+
+class _LazyStudies(Mapping):
+    def __init__(self, index):
+        self.studies = index['studies']
+        self.offsets = dict(zip(self.studies,
+                                zip(index['offsets'][:-1],
+                                    index['offsets'][1:])))
+
+    def __iter__(self):
+        return iter(self.studies)
+
+    def __len__(self):
+        return len(self.studies)
+
+    def __contains__(self, study):
+        return study in self.offsets
+
+
+class StudyArrays(_LazyStudies):
+    def __init__(self, dirname, index, mmap_mode='c'):
+        """
+        Input data of each study, memory-mapped on first access.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory of the store
+
+        index : Dict
+            Index of the store
+
+        mmap_mode : {'r', 'c'}
+        """
+        super().__init__(index)
+        self.filename = join(dirname, 'X.npy')
+        self.mmap_mode = mmap_mode
+        self._X = None
+
+    def __getitem__(self, study):
+        start, stop = self.offsets[study]
+        if self._X is None:
+            self._X = np.load(self.filename, mmap_mode=self.mmap_mode)
+        return self._X[start:stop]
+
+
+class StudyTargets(_LazyStudies):
+    def __init__(self, dirname, index):
+        """
+        Targets of each study, decoded on access.
+
+        Parameters
+        ----------
+        dirname : str
+            Directory of the store
+
+        index : Dict
+            Index of the store
+        """
+        super().__init__(index)
+        self.filename = join(dirname, 'targets.npz')
+        self.columns = index['columns']
+        self._arrays = None
+
+    def __getitem__(self, study):
+        start, stop = self.offsets[study]
+        if self._arrays is None:
+            with np.load(self.filename) as arrays:
+                self._arrays = dict(arrays)
+        return decode_targets(self._arrays, self.columns, start, stop)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import re
 
@@ -52,6 +53,28 @@ def get_output_dir(output_dir=None):
         return os.path.expanduser('~/cogspaces_data')
 
 
+def hash_file(filename, block_size=2 ** 20):
+    """ Returns the SHA-1 hash of the content of a file, read block by block.
+
+    Parameters
+    ----------
+    filename: string
+
+    block_size: int
+        Number of bytes read at once
+
+    Returns
+    -------
+    hash: string
+        Hexadecimal digest
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
 def filter_contrast(contrast):
     contrast = contrast.lower()
     contrast = contrast.replace('lf', 'left foot')
@@ -1,4 +1,5 @@
 import itertools
+from collections import namedtuple
 
 import numpy as np
 import pandas as pd
@@ -28,10 +29,50 @@ def infinite_iter(iterable):
             yield elem
 
 
+class PackedTensor(namedtuple('PackedTensor',
+                               ['data', 'studies', 'offsets'])):
+    """
+    Rows of several studies packed along the first dimension of one tensor.
+
+    Parameters
+    ----------
+    data : torch.Tensor
+        Concatenated rows, study after study
+
+    studies : List[str]
+        Studies present in the batch, in the order of the rows
+
+    offsets : torch.LongTensor
+        Tensor of size `len(studies) + 1`. Rows of `studies[i]` are
+        `data[offsets[i]:offsets[i + 1]]`
+    """
+    __slots__ = ()
+
+    @property
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def split(self):
+        """
+        Returns
+        -------
+        split: Dict[str, torch.Tensor]
+            Rows of each study
+        """
+        offsets = self.offsets.tolist()
+        return {study: self.data[start:stop] for study, start, stop
+                in zip(self.studies, offsets[:-1], offsets[1:])}
+
+
 class RandomChoiceIter:
     """
     Simple iterable that randomly chooses from a list, with probabilitie.
 
+    Choices are drawn in blocks of `block_size` through a single search in
+    the cumulative distribution. As `numpy.random.RandomState.choice`
+    performs the same inverse-CDF search, the drawn sequence is identical to
+    calling `random_state.choice(choices, p=p)` at every step.
+
     Parameters
     ----------
     choices :  List,
@@ -42,14 +83,111 @@ class RandomChoiceIter:
 
     seed : int or None
         Seed the sampler
+
+    block_size : int
+        Number of choices pre-drawn at once
     """
-    def __init__(self, choices, p, seed=None):
+    def __init__(self, choices, p, seed=None, block_size=1024):
         self.random_state = check_random_state(seed)
         self.choices = choices
         self.p = p
+        self.block_size = block_size
+
+        cdf = np.cumsum(p)
+        cdf /= cdf[-1]
+        self.cdf = cdf
+        self._block = []
+        self._cursor = 0
+
+    def _draw_block(self):
+        uniform_samples = self.random_state.random_sample(self.block_size)
+        return self.cdf.searchsorted(uniform_samples, side='right').tolist()
+
+    def __iter__(self):
+        return self
 
     def __next__(self):
-        return self.random_state.choice(self.choices, p=self.p)
+        if self._cursor >= len(self._block):
+            self._block = self._draw_block()
+            self._cursor = 0
+        idx = self._block[self._cursor]
+        self._cursor += 1
+        return self.choices[idx]
+
+
+class StratifiedChoiceIter(RandomChoiceIter):
+    """
+    Iterable that randomly chooses from a list, with stratified blocks.
+
+    Each block of `block_size` choices is obtained by systematic sampling of
+    the cumulative distribution, so that element `i` appears either
+    `floor(block_size * p[i])` or `ceil(block_size * p[i])` times. The block
+    is then shuffled. The marginal distribution of each choice is `p`, with
+    a lower variance of the counts than independent sampling.
+
+    Parameters
+    ----------
+    choices :  List,
+        List of elements to choose from
+
+    p : List[float]
+        Probabilities weights. Must sum to one
+
+    seed : int or None
+        Seed the sampler
+
+    block_size : int
+        Number of choices pre-drawn at once
+    """
+    def _draw_block(self):
+        offset = self.random_state.random_sample()
+        points = (offset + np.arange(self.block_size)) / self.block_size
+        block = self.cdf.searchsorted(points, side='right')
+        # Guard against rounding of cdf[-1]
+        np.minimum(block, len(self.cdf) - 1, out=block)
+        self.random_state.shuffle(block)
+        return block.tolist()
+
+
+def _get_study_iter(studies, sampling, study_weights=None, seed=None):
+    """
+    Create the iterable that chooses which study to load at each step.
+
+    Parameters
+    ----------
+    studies : List[str]
+        Studies to choose from
+
+    sampling : str in {'random', 'stratified-block', 'cycle', 'all'}
+        Sampling strategy.
+
+    study_weights : Dict[str, float]
+        Used to sample studies when `sampling` is 'random' or
+        'stratified-block'
+
+    seed : int or None
+        Seed the sampling of studies
+
+    Returns
+    -------
+    study_iter : iterable or None
+        Iterable yielding study names, None if `sampling == 'all'`
+    """
+    if sampling in ['random', 'stratified-block']:
+        p = np.array([study_weights[study] for study in studies],
+                     dtype=np.float64)
+        assert (np.all(p >= 0))
+        p /= np.sum(p)
+        if sampling == 'random':
+            return RandomChoiceIter(studies, p, seed)
+        else:
+            return StratifiedChoiceIter(studies, p, seed)
+    elif sampling == 'cycle':
+        return itertools.cycle(studies)
+    elif sampling == 'all':
+        return None
+    else:
+        raise ValueError('Wrong value for `sampling`')
 
 
 class MultiStudyLoaderIter:
@@ -65,25 +203,16 @@ class MultiStudyLoaderIter:
         self.loader_iters = {study: infinite_iter(loader)
                              for study, loader in loaders.items()}
 
-        studies = list(data.keys())
+        self.studies = list(data.keys())
         self.sampling = loader.sampling
-        if self.sampling == 'random':
-            p = np.array([loader.study_weights[study] for study in studies])
-            assert (np.all(p >= 0))
-            p /= np.sum(p)
-            self.study_iter = RandomChoiceIter(studies, p, loader.seed)
-        elif self.sampling == 'cycle':
-            self.study_iter = itertools.cycle(studies)
-        elif self.sampling == 'all':
-            self.studies = studies
-        else:
-            raise ValueError('Wrong value for `sampling`')
+        self.study_iter = _get_study_iter(self.studies, loader.sampling,
+                                          loader.study_weights, loader.seed)
 
         self.device = loader.device
 
     def __next__(self):
         inputs, targets = {}, {}
-        if self.sampling == 'all':
+        if self.study_iter is None:
             for study in self.studies:
                 input, target = next(self.loader_iters[study])
                 input = input.to(device=self.device)
@@ -98,6 +227,101 @@ class MultiStudyLoaderIter:
         return inputs, targets
 
 
+class IndexedMultiStudyLoaderIter:
+    """Tensor-resident loader iterable for a collection of study data.
+
+    All studies are concatenated into contiguous tensors on the target
+    device, each study occupying a contiguous slice. A permutation of the
+    study samples is drawn at the beginning of each epoch and batches are
+    gathered with a single `index_select`, so that no per-sample Python work
+    is performed.
+
+    If the loader has a `pack_size`, batches of several studies are packed
+    into a single `PackedTensor`.
+    """
+    def __init__(self, loader):
+        data = loader.data
+        self.device = loader.device
+        self.batch_size = loader.batch_size
+        self.pack_size = loader.pack_size
+        self.generator = torch.Generator()
+        if loader.seed is not None:
+            self.generator.manual_seed(int(loader.seed))
+        else:
+            self.generator.seed()
+
+        self.studies = list(data.keys())
+        self.lengths = {study: len(data[study]) for study in self.studies}
+        self.tensors = tuple(
+            torch.cat([data[study].tensors[i] for study in self.studies])
+            .to(device=self.device).contiguous()
+            for i in range(len(data[self.studies[0]].tensors)))
+        offsets = np.cumsum([0] + [self.lengths[study]
+                                   for study in self.studies])
+        self.offsets = {study: int(offset) for study, offset
+                        in zip(self.studies, offsets)}
+        self.permutations = {study: None for study in data}
+        self.cursors = {study: 0 for study in data}
+
+        self.sampling = loader.sampling
+        self.study_iter = _get_study_iter(self.studies, loader.sampling,
+                                          loader.study_weights, loader.seed)
+
+    def _next_indices(self, study):
+        """Return the indices of the next batch of `study` within the
+        concatenated tensors, drawing a new permutation when the previous
+        epoch is exhausted."""
+        cursor = self.cursors[study]
+        length = self.lengths[study]
+        if self.permutations[study] is None or cursor >= length:
+            permutation = torch.randperm(length, generator=self.generator)
+            permutation += self.offsets[study]
+            self.permutations[study] = permutation.to(device=self.device)
+            cursor = 0
+        indices = self.permutations[study][cursor:cursor + self.batch_size]
+        self.cursors[study] = cursor + self.batch_size
+        return indices
+
+    def _gather(self, indices):
+        return tuple(torch.index_select(tensor, 0, indices)
+                     for tensor in self.tensors)
+
+    def _next_packed(self):
+        if self.study_iter is None:
+            counts = {study: 1 for study in self.studies}
+        else:
+            counts = {}
+            for _ in range(self.pack_size):
+                study = next(self.study_iter)
+                counts[study] = counts.get(study, 0) + 1
+        studies = list(counts.keys())
+        indices, lengths = [], []
+        for study in studies:
+            these_indices = [self._next_indices(study)
+                             for _ in range(counts[study])]
+            lengths.append(sum(len(this_indices)
+                               for this_indices in these_indices))
+            indices.extend(these_indices)
+        offsets = torch.from_numpy(np.cumsum([0] + lengths)).to(
+            device=self.device)
+        input, target = self._gather(torch.cat(indices))
+        return (PackedTensor(input, studies, offsets),
+                PackedTensor(target, studies, offsets))
+
+    def __next__(self):
+        if self.pack_size is not None:
+            return self._next_packed()
+        inputs, targets = {}, {}
+        if self.study_iter is None:
+            studies = self.studies
+        else:
+            studies = [next(self.study_iter)]
+        for study in studies:
+            inputs[study], targets[study] = self._gather(
+                self._next_indices(study))
+        return inputs, targets
+
+
 class MultiStudyLoader:
     """Pytorch loader for a collection of study data.
 
@@ -109,8 +333,11 @@ class MultiStudyLoader:
     batch_size : int
         Batch size for samples
 
-    sampling : str in {'random', 'cycle', 'all'}
-        Sampling strategy.
+    sampling : str in {'random', 'stratified-block', 'cycle', 'all'}
+        Sampling strategy. 'random' draws one study per batch according to
+        `study_weights`, 'stratified-block' does the same with
+        low-variance blocks of draws, 'cycle' iterates over studies
+        and 'all' loads one batch of each study.
 
     study_weights : Dict[str, float]
         Used to sample studies
@@ -120,22 +347,43 @@ class MultiStudyLoader:
 
     device : torch.device
         Device to load the data on
+
+    engine : str in {'torch', 'indexed'}
+        Loading engine. 'torch' uses one `torch.utils.data.DataLoader` per
+        study. 'indexed' keeps each study as a contiguous tensor on `device`
+        and gathers batches from pre-drawn permutations, which avoids the
+        per-sample overhead of `DataLoader`.
+
+    pack_size : int or None
+        If not None, pack the batches of `pack_size` study draws into a
+        single `PackedTensor` at each step (all studies if
+        `sampling == 'all'`). Requires `engine == 'indexed'`.
     """
     def __init__(self, data,
                  batch_size=128, sampling='cycle',
-                 study_weights=None, seed=None, device=torch.device('cpu')):
+                 study_weights=None, seed=None, device=torch.device('cpu'),
+                 engine='torch', pack_size=None):
         self.data = data
         self.batch_size = batch_size
         self.sampling = sampling
         self.study_weights = study_weights
         self.device = device
         self.seed = seed
+        self.engine = engine
+        self.pack_size = pack_size
 
     def __iter__(self):
         """
         Returns
         -------
-        iterable: MultiStudyLoaderIter
+        iterable: MultiStudyLoaderIter or IndexedMultiStudyLoaderIter
             Iterator that yields samples.
         """
-        return MultiStudyLoaderIter(self)
+        if self.engine == 'torch':
+            if self.pack_size is not None:
+                raise ValueError("Packed batches require engine='indexed'")
+            return MultiStudyLoaderIter(self)
+        elif self.engine == 'indexed':
+            return IndexedMultiStudyLoaderIter(self)
+        else:
+            raise ValueError('Wrong value for `engine`')
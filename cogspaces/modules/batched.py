@@ -0,0 +1,411 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+from cogspaces.modules.linear import k1, k2, k3
+
+
+class BatchedLatentClassifiers(nn.Module):
+    def __init__(self, classifiers):
+        """
+        Stack of third-layer classification heads, evaluated in parallel.
+
+        Weights of the heads are padded up to the largest number of targets
+        and stacked along a leading "head" dimension, so that all heads are
+        applied with a single batched matrix multiplication. Only
+        non-adaptive heads with `level='layer'` dropout are supported.
+
+        Parameters
+        ----------
+        classifiers : List[LatentClassifier]
+            Heads to stack. Their parameters are copied.
+        """
+        super().__init__()
+        for classifier in classifiers:
+            linear = classifier.linear
+            if linear.level != 'layer' or linear.adaptive:
+                raise ValueError('Only non-adaptive layer-level dropout heads'
+                                 ' can be batched')
+        self.batch_norm = hasattr(classifiers[0], 'batch_norm')
+        n_heads = len(classifiers)
+        latent_size = classifiers[0].linear.in_features
+        target_sizes = [classifier.linear.out_features
+                        for classifier in classifiers]
+        max_target_size = max(target_sizes)
+
+        weight = torch.zeros(n_heads, max_target_size, latent_size)
+        bias = torch.zeros(n_heads, max_target_size)
+        log_alpha = torch.zeros(n_heads)
+        p = torch.zeros(n_heads)
+        for i, classifier in enumerate(classifiers):
+            linear = classifier.linear
+            weight[i, :target_sizes[i]] = linear.weight.data
+            bias[i, :target_sizes[i]] = linear.bias.data
+            log_alpha[i] = linear.log_alpha.data.view(-1)[0]
+            p[i] = linear.p
+        self.weight = nn.Parameter(weight)
+        self.bias = nn.Parameter(bias)
+        self.register_buffer('log_alpha', log_alpha)
+        self.register_buffer('p', p)
+        self.register_buffer('target_sizes', torch.tensor(target_sizes))
+        self.register_buffer('target_mask', torch.arange(max_target_size)[
+            None, :] < self.target_sizes[:, None])
+
+        if self.batch_norm:
+            bn = classifiers[0].batch_norm
+            self.eps = bn.eps
+            self.momentum = bn.momentum
+            self.register_buffer('running_mean', torch.stack(
+                [classifier.batch_norm.running_mean
+                 for classifier in classifiers]))
+            self.register_buffer('running_var', torch.stack(
+                [classifier.batch_norm.running_var
+                 for classifier in classifiers]))
+            self.register_buffer('num_batches_tracked', torch.stack(
+                [classifier.batch_norm.num_batches_tracked
+                 for classifier in classifiers]))
+
+    def forward(self, input, row_mask, active=None, batch_norm_train=False):
+        """
+        Parameters
+        ----------
+        input : torch.tensor, shape (n_heads, batch_size, latent_size)
+            Batch of latent inputs for each head
+
+        row_mask : torch.BoolTensor, shape (n_heads, batch_size)
+            Valid rows of `input`, others are padding
+
+        active : torch.BoolTensor, shape (n_heads, ) or None
+            Heads whose batch-norm statistics may be updated
+
+        batch_norm_train : bool
+            Use batch statistics in batch-norm, as
+            `LatentClassifier.batch_norm.train()`
+
+        Returns
+        -------
+        pred : torch.tensor, shape (n_heads, batch_size, max_target_size)
+            Log-probabilities, -inf for padded targets
+        """
+        if self.batch_norm:
+            input = self._batch_norm(input, row_mask, active,
+                                     batch_norm_train)
+        if self.training:
+            std = torch.exp(.5 * torch.clamp(self.log_alpha, -8, 8))
+            std = torch.where(self.p > 0, std, torch.zeros_like(std))
+            eps = torch.randn_like(input)
+            input = input * (1 + std[:, None, None] * eps)
+        logits = torch.baddbmm(self.bias[:, None, :], input,
+                               self.weight.transpose(1, 2))
+        logits = logits.masked_fill(~self.target_mask[:, None, :],
+                                    float('-inf'))
+        return F.log_softmax(logits, dim=2)
+
+    def _batch_norm(self, input, row_mask, active, batch_norm_train):
+        if not batch_norm_train:
+            mean, var = self.running_mean, self.running_var
+            return ((input - mean[:, None, :])
+                    / torch.sqrt(var[:, None, :] + self.eps))
+        mask = row_mask[:, :, None].float()
+        n = mask.sum(dim=1)
+        # LatentClassifier skips batch-norm on batches of a single sample
+        use_batch = n[:, 0] > 1
+        if active is not None:
+            use_batch = use_batch & active
+        mean = (input * mask).sum(dim=1) / n.clamp(min=1)
+        var = (((input - mean[:, None, :]) ** 2) * mask).sum(dim=1) \
+            / n.clamp(min=1)
+        with torch.no_grad():
+            unbiased_var = var * n / (n - 1).clamp(min=1)
+            update = use_batch[:, None]
+            momentum = self.momentum
+            self.running_mean.copy_(torch.where(
+                update, (1 - momentum) * self.running_mean + momentum * mean,
+                self.running_mean))
+            self.running_var.copy_(torch.where(
+                update, (1 - momentum) * self.running_var
+                + momentum * unbiased_var, self.running_var))
+            self.num_batches_tracked += use_batch.long()
+        output = (input - mean[:, None, :]) / torch.sqrt(
+            var[:, None, :] + self.eps)
+        return torch.where(use_batch[:, None, None], output, input)
+
+    def to_classifiers(self, classifiers):
+        """
+        Copy the parameters of the stacked heads back into `classifiers`.
+
+        Parameters
+        ----------
+        classifiers : List[LatentClassifier]
+            Heads, in the order used at construction
+        """
+        for i, classifier in enumerate(classifiers):
+            target_size = int(self.target_sizes[i])
+            linear = classifier.linear
+            linear.weight.data.copy_(self.weight.data[i, :target_size])
+            linear.bias.data.copy_(self.bias.data[i, :target_size])
+            if self.batch_norm:
+                bn = classifier.batch_norm
+                bn.running_mean.copy_(self.running_mean[i])
+                bn.running_var.copy_(self.running_var[i])
+                bn.num_batches_tracked.copy_(self.num_batches_tracked[i])
+
+
+class BatchedMultiStudyModules(nn.Module):
+    def __init__(self, modules):
+        """
+        Stack of multi-study modules of identical shapes, trained in lockstep.
+
+        Embedders and heads of the modules are stacked along a leading "run"
+        dimension, so that one step of every run is computed with a few
+        batched matrix multiplications. Heads are padded up to the largest
+        number of targets and stored with a leading dimension of
+        `n_runs * n_studies`, so that each (run, study) pair can be updated
+        independently by `cogspaces.optim.MaskedAdam`.
+
+        Only the configuration of the train phase of `MultiStudyClassifier`
+        is supported: non-adaptive layer-level dropout in the embedders,
+        adaptive layer-level dropout and batch-norm in the heads.
+
+        Parameters
+        ----------
+        modules : List[VarMultiStudyModule]
+            Modules to stack, with the same studies and shapes. Their
+            parameters are copied.
+        """
+        super().__init__()
+        self.studies = list(modules[0].classifiers.keys())
+        self.n_runs = len(modules)
+        self.n_studies = len(self.studies)
+        for module in modules:
+            if module.embedder.level != 'layer' or module.embedder.adaptive:
+                raise ValueError('Only non-adaptive layer-level dropout'
+                                 ' embedders can be batched')
+            for classifier in module.classifiers.values():
+                if (classifier.linear.level != 'layer'
+                        or not hasattr(classifier, 'batch_norm')):
+                    raise ValueError('Only layer-level dropout heads with'
+                                     ' batch-norm can be batched')
+        bn = modules[0].classifiers[self.studies[0]].batch_norm
+        self.eps = bn.eps
+        self.momentum = bn.momentum
+
+        embedders = [module.embedder for module in modules]
+        self.embedder_weight = nn.Parameter(torch.stack(
+            [embedder.weight.data for embedder in embedders]))
+        self.embedder_bias = nn.Parameter(torch.stack(
+            [embedder.bias.data for embedder in embedders]))
+        embedder_std = torch.tensor(
+            [torch.exp(.5 * embedder.get_log_alpha()).item()
+             if embedder.p > 0 else 0. for embedder in embedders])
+        self.register_buffer('embedder_std', embedder_std)
+
+        classifiers = [module.classifiers[study] for module in modules
+                       for study in self.studies]
+        linears = [classifier.linear for classifier in classifiers]
+        latent_size = linears[0].in_features
+        target_sizes = [linear.out_features for linear in linears]
+        max_target_size = max(target_sizes)
+        weight = torch.zeros(len(linears), max_target_size, latent_size)
+        bias = torch.zeros(len(linears), max_target_size)
+        for i, linear in enumerate(linears):
+            weight[i, :target_sizes[i]] = linear.weight.data
+            bias[i, :target_sizes[i]] = linear.bias.data
+        self.head_weight = nn.Parameter(weight)
+        self.head_bias = nn.Parameter(bias)
+        self.head_log_alpha = nn.Parameter(torch.tensor(
+            [linear.log_alpha.data.view(-1)[0].item() for linear in linears]))
+        self.register_buffer('head_noisy', torch.tensor(
+            [linear.p > 0 for linear in linears]))
+        self.register_buffer('var_penalty', torch.tensor(
+            [float(linear.var_penalty) for linear in linears]))
+        target_sizes = torch.tensor(target_sizes[:self.n_studies])
+        self.register_buffer('head_numel', target_sizes.float() * latent_size)
+        self.register_buffer('target_mask', torch.arange(max_target_size)[
+            None, :] < target_sizes[:, None])
+        self.register_buffer('running_mean', torch.stack(
+            [classifier.batch_norm.running_mean
+             for classifier in classifiers]))
+        self.register_buffer('running_var', torch.stack(
+            [classifier.batch_norm.running_var
+             for classifier in classifiers]))
+        self.register_buffer('num_batches_tracked', torch.stack(
+            [classifier.batch_norm.num_batches_tracked
+             for classifier in classifiers]))
+
+    _run_tensors = ('embedder_weight', 'embedder_bias', 'head_weight',
+                    'head_bias', 'head_log_alpha', 'running_mean',
+                    'running_var', 'num_batches_tracked')
+
+    def forward(self, input, studies, row_mask, active=None,
+                generators=None):
+        """
+        Parameters
+        ----------
+        input : torch.tensor, shape (n_runs, batch_size, in_features)
+            Batch of inputs of each run
+
+        studies : torch.LongTensor, shape (n_runs, )
+            Study of the batch of each run, as an index in `self.studies`
+
+        row_mask : torch.BoolTensor, shape (n_runs, batch_size)
+            Valid rows of `input`, others are padding
+
+        active : torch.BoolTensor, shape (n_runs, ) or None
+            Runs whose batch-norm statistics may be updated
+
+        generators : List[torch.Generator] or None
+            Generator of the dropout noise of each run, so that the noise of
+            a run does not depend on the other runs. If None, the noise is
+            drawn from the default generator
+
+        Returns
+        -------
+        pred : torch.tensor, shape (n_runs, batch_size, max_target_size)
+            Log-probabilities, -inf for padded targets
+        """
+        heads = self._heads(studies)
+        if self.training:
+            eps = _randn_like(input, generators)
+            input = input * (1 + self.embedder_std[:, None, None] * eps)
+        latent = torch.baddbmm(self.embedder_bias[:, None, :], input,
+                               self.embedder_weight.transpose(1, 2))
+        latent = self._batch_norm(latent, heads, row_mask, active)
+        weight = self.head_weight[heads]
+        logits = torch.baddbmm(self.head_bias[heads][:, None, :], latent,
+                               weight.transpose(1, 2))
+        if self.training:
+            # Local reparametrization, as in adaptive `DropoutLinear`
+            var = torch.bmm(latent * latent,
+                            (weight * weight).transpose(1, 2))
+            var = var * torch.exp(self.head_log_alpha[heads])[:, None, None]
+            std = torch.sqrt(var + 1e-8) * _randn_like(logits, generators)
+            logits = logits + torch.where(
+                self.head_noisy[heads][:, None, None], std,
+                torch.zeros_like(std))
+        logits = logits.masked_fill(~self.target_mask[studies][:, None, :],
+                                    float('-inf'))
+        return F.log_softmax(logits, dim=2)
+
+    def penalty(self, studies):
+        """
+        Variational penalty of each run, as `VarMultiStudyModule.penalty`.
+
+        Parameters
+        ----------
+        studies : torch.LongTensor, shape (n_runs, )
+            Study of the batch of each run
+
+        Returns
+        -------
+        penalty : torch.tensor, shape (n_runs, )
+        """
+        heads = self._heads(studies)
+        log_alpha = torch.clamp(self.head_log_alpha[heads], -8, 8)
+        penalty = - k1 * (torch.sigmoid(k2 + k3 * log_alpha)
+                          - .5 * F.softplus(-log_alpha) - 1)
+        return penalty * self.head_numel[studies] * self.var_penalty[heads]
+
+    def _heads(self, studies):
+        return (torch.arange(self.n_runs, device=studies.device)
+                * self.n_studies + studies)
+
+    def _batch_norm(self, input, heads, row_mask, active):
+        if not self.training:
+            mean, var = self.running_mean[heads], self.running_var[heads]
+            return ((input - mean[:, None, :])
+                    / torch.sqrt(var[:, None, :] + self.eps))
+        mask = row_mask[:, :, None].float()
+        n = mask.sum(dim=1)
+        # LatentClassifier skips batch-norm on batches of a single sample
+        use_batch = n[:, 0] > 1
+        mean = (input * mask).sum(dim=1) / n.clamp(min=1)
+        var = (((input - mean[:, None, :]) ** 2) * mask).sum(dim=1) \
+            / n.clamp(min=1)
+        with torch.no_grad():
+            update = use_batch if active is None else use_batch & active
+            unbiased_var = var * n / (n - 1).clamp(min=1)
+            momentum = self.momentum
+            running_mean = self.running_mean[heads]
+            running_var = self.running_var[heads]
+            self.running_mean[heads] = torch.where(
+                update[:, None],
+                (1 - momentum) * running_mean + momentum * mean,
+                running_mean)
+            self.running_var[heads] = torch.where(
+                update[:, None],
+                (1 - momentum) * running_var + momentum * unbiased_var,
+                running_var)
+            self.num_batches_tracked[heads] += update.long()
+        output = (input - mean[:, None, :]) / torch.sqrt(
+            var[:, None, :] + self.eps)
+        return torch.where(use_batch[:, None, None], output, input)
+
+    def get_run_state(self):
+        """Copy of the tensors that differ between runs."""
+        return {name: getattr(self, name).detach().clone()
+                for name in self._run_tensors}
+
+    def set_run_state(self, state, runs=None, target=None):
+        """
+        Copy `state` into the selected runs.
+
+        Parameters
+        ----------
+        state : Dict[str, torch.tensor]
+            Output of `get_run_state`
+
+        runs : torch.BoolTensor, shape (n_runs, ) or None
+            Runs to copy, all if None
+
+        target : Dict[str, torch.tensor] or None
+            State to update in place, the module itself if None
+        """
+        for name in self._run_tensors:
+            if target is None:
+                tensor = getattr(self, name).data
+            else:
+                tensor = target[name]
+            if runs is None:
+                tensor.copy_(state[name])
+            else:
+                mask = runs.repeat_interleave(tensor.shape[0] // self.n_runs)
+                mask = mask.view((-1,) + (1,) * (tensor.dim() - 1))
+                tensor.copy_(torch.where(mask, state[name], tensor))
+
+    def to_modules(self, modules):
+        """
+        Copy the parameters of the stacked runs back into `modules`.
+
+        Parameters
+        ----------
+        modules : List[VarMultiStudyModule]
+            Modules, in the order used at construction
+        """
+        for i, module in enumerate(modules):
+            module.embedder.weight.data.copy_(self.embedder_weight.data[i])
+            module.embedder.bias.data.copy_(self.embedder_bias.data[i])
+            for j, study in enumerate(self.studies):
+                head = i * self.n_studies + j
+                classifier = module.classifiers[study]
+                linear = classifier.linear
+                target_size = linear.out_features
+                linear.weight.data.copy_(
+                    self.head_weight.data[head, :target_size])
+                linear.bias.data.copy_(
+                    self.head_bias.data[head, :target_size])
+                linear.log_alpha.data.fill_(
+                    self.head_log_alpha.data[head].item())
+                bn = classifier.batch_norm
+                bn.running_mean.copy_(self.running_mean[head])
+                bn.running_var.copy_(self.running_var[head])
+                bn.num_batches_tracked.copy_(self.num_batches_tracked[head])
+
+
+def _randn_like(input, generators=None):
+    """Gaussian noise of the shape of `input`, drawn run by run."""
+    if generators is None:
+        return torch.randn_like(input)
+    return torch.stack([torch.randn(input.shape[1:], generator=generator,
+                                    dtype=input.dtype, device=input.device)
+                        for generator in generators])
@@ -1,4 +1,5 @@
 import math
+from contextlib import ExitStack
 
 import numpy as np
 import torch
@@ -6,6 +7,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from cogspaces.datasets import fetch_atlas_modl
+from cogspaces.input_data import PackedTensor
 from cogspaces.modules.linear import DropoutLinear
 
 
@@ -60,6 +62,28 @@ class LatentClassifier(nn.Module):
         self.linear.reset_parameters()
         self.batch_norm.reset_parameters()
 
+    def select_latent(self, indices):
+        """
+        Keep only a subset of the latent units, in place.
+
+        Parameters
+        ----------
+        indices : torch.LongTensor
+            Latent units to keep
+        """
+        self.linear.select(in_indices=indices)
+        if hasattr(self, 'batch_norm'):
+            batch_norm = nn.BatchNorm1d(len(indices), affine=False,
+                                        eps=self.batch_norm.eps,
+                                        momentum=self.batch_norm.momentum)
+            batch_norm.running_mean.copy_(
+                self.batch_norm.running_mean[indices])
+            batch_norm.running_var.copy_(self.batch_norm.running_var[indices])
+            batch_norm.num_batches_tracked.copy_(
+                self.batch_norm.num_batches_tracked)
+            batch_norm.train(self.batch_norm.training)
+            self.batch_norm = batch_norm
+
     def penalty(self):
         return self.linear.penalty()
 
@@ -152,19 +176,48 @@ class VarMultiStudyModule(nn.Module):
         return weight
 
     def forward(self, inputs, logits=False):
+        """
+        Parameters
+        ----------
+        inputs: Dict[str, torch.tensor] or PackedTensor
+            Input of each study. If packed, the embedder is applied once on
+            all rows, and the predictions are packed, padded with zeros up to
+            the largest number of targets.
+
+        logits: bool
+            Return logits instead of log-probabilities
+
+        Returns
+        -------
+        preds: Dict[str, torch.tensor] or PackedTensor
+            Prediction of each study
+        """
+        if isinstance(inputs, PackedTensor):
+            return self._forward_packed(inputs, logits=logits)
         preds = {}
         for study, input in inputs.items():
             preds[study] = self.classifiers[study](self.embedder(input),
                                                    logits=logits)
         return preds
 
+    def _forward_packed(self, inputs, logits=False):
+        latent = self.embedder(inputs.data)
+        offsets = inputs.offsets.tolist()
+        preds = [self.classifiers[study](latent[start:stop], logits=logits)
+                 for study, start, stop in zip(inputs.studies, offsets[:-1],
+                                               offsets[1:])]
+        width = max(pred.shape[1] for pred in preds)
+        preds = torch.cat([F.pad(pred, (0, width - pred.shape[1]))
+                           for pred in preds])
+        return PackedTensor(preds, inputs.studies, inputs.offsets)
+
     def penalty(self, studies):
         """
         Return the variational penalty of the model.
 
         Parameters
         ----------
-        studies: Iterable[str],
+        studies: Iterable[str] or PackedTensor,
             Studies to consider when computing the penalty
 
         Returns
@@ -172,10 +225,80 @@ class VarMultiStudyModule(nn.Module):
         penalty: torch.tensor,
             Scalar penalty
         """
+        if isinstance(studies, PackedTensor):
+            studies = studies.studies
         return (self.embedder.penalty()
                 + sum(self.classifiers[study].penalty()
                       for study in studies))
 
+    def select(self, latent_indices=None, atom_indices=None):
+        """
+        Keep only a subset of the latent units and input atoms, in place.
+
+        Parameters
+        ----------
+        latent_indices : torch.LongTensor or None
+            Latent units to keep, all if None
+
+        atom_indices : torch.LongTensor or None
+            Input atoms to keep, all if None
+        """
+        self.embedder.select(in_indices=atom_indices,
+                             out_indices=latent_indices)
+        if latent_indices is not None:
+            for classifier in self.classifiers.values():
+                classifier.select_latent(latent_indices)
+
+    def compile_sparse(self, threshold=0.01):
+        """
+        Compile the pruned weights of the embedder and of the classification
+        heads for fast eval-mode inference. See
+        `DropoutLinear.compile_sparse`.
+
+        Parameters
+        ----------
+        threshold : float
+            Density under which weights are stored in CSR format
+
+        Returns
+        -------
+        densities : Tuple[float, Dict[str, float]]
+            Density of the compiled embedder and heads
+        """
+        return (self.embedder.compile_sparse(threshold),
+                {study: classifier.linear.compile_sparse(threshold)
+                 for study, classifier in self.classifiers.items()})
+
+    def compute_affine(self):
+        """
+        Compute the affine map of each study in eval mode, by pushing the
+        canonical basis through the module.
+
+        Returns
+        -------
+        affine : Dict[str, Tuple[torch.tensor, torch.tensor]]
+            Coefficients, of shape (n_targets, in_features), and biases,
+            of shape (n_targets, ), of the logits of each study
+        """
+        training = self.training
+        in_features = self.embedder.in_features
+        with ExitStack() as stack, torch.no_grad():
+            # Going back to training mode would discard the compiled weights
+            for module in self.modules():
+                if isinstance(module, DropoutLinear):
+                    stack.enter_context(module.keep_compiled())
+            self.eval()
+            # The embedder is shared: embed the basis once
+            latent = self.embedder(torch.cat([torch.zeros((1, in_features)),
+                                              torch.eye(in_features)]))
+            affine = {}
+            for study, classifier in self.classifiers.items():
+                logits = classifier(latent, logits=True)
+                bias = logits[0]
+                affine[study] = ((logits[1:] - bias).t(), bias)
+            self.train(training)
+        return affine
+
     def get_dropout(self):
         return (self.embedder.get_dropout(),
                 {study: classifier.get_dropout() for study, classifier in
@@ -1,4 +1,5 @@
 import math
+from contextlib import contextmanager
 
 import torch
 from torch import nn
@@ -9,6 +10,90 @@ k2 = 1.87320
 k3 = 1.48695
 
 
+class _LocalReparametrization(torch.autograd.Function):
+    """
+    Fused forward and backward of the local reparametrization trick.
+
+    Computes `input W^T + b + sqrt(input ** 2 Sigma^T + 1e-8) * eps`, where
+    the variance weight `Sigma` is `exp(log_alpha) * W ** 2`, or
+    `exp(log_sigma2)` for `level='additive'`. For `level` in {'layer',
+    'atom'}, `exp(log_alpha)` is applied to the (smaller) input or output
+    instead of a weight-sized tensor. The squared input and weights are
+    computed once and reused in the backward pass.
+    """
+    @staticmethod
+    def forward(ctx, input, weight, bias, log_var, eps, level):
+        x2 = input * input
+        if level == 'additive':
+            var_weight = torch.exp(log_var)
+            var = x2.mm(var_weight.t())
+        else:
+            var_weight = weight * weight
+            if level == 'coef':
+                var_weight.mul_(torch.exp(log_var))
+                var = x2.mm(var_weight.t())
+            elif level == 'atom':
+                x2.mul_(torch.exp(log_var))
+                var = x2.mm(var_weight.t())
+            else:
+                var = x2.mm(var_weight.t()).mul_(torch.exp(log_var))
+        std = var.add_(1e-8).sqrt_()
+        if bias is not None:
+            output = torch.addmm(bias, input, weight.t())
+        else:
+            output = input.mm(weight.t())
+        output.addcmul_(std, eps)
+        ctx.level = level
+        ctx.save_for_backward(input, weight, log_var, x2, var_weight, std,
+                              eps)
+        return output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        input, weight, log_var, x2, var_weight, std, eps = ctx.saved_tensors
+        level = ctx.level
+        needs_input, needs_weight, needs_bias, needs_log_var = \
+            ctx.needs_input_grad[:4]
+        grad_input = grad_weight = grad_bias = grad_log_var = None
+
+        # Gradient with respect to the output variance
+        grad_var = grad_output * eps
+        grad_var.div_(std).mul_(.5)
+        if level in ['layer', 'atom']:
+            alpha = torch.exp(log_var)
+
+        if needs_input:
+            grad_input = grad_output.mm(weight)
+            var_grad_input = grad_var.mm(var_weight)
+            if level in ['layer', 'atom']:
+                var_grad_input.mul_(alpha)
+            grad_input.addcmul_(input, var_grad_input, value=2)
+        if needs_weight or needs_log_var:
+            # For level='atom', x2 already holds alpha * input ** 2
+            grad_var_weight = grad_var.t().mm(x2)
+        if needs_weight:
+            grad_weight = grad_output.t().mm(input)
+            if level == 'layer':
+                grad_weight.addcmul_(weight, grad_var_weight * alpha,
+                                     value=2)
+            elif level == 'atom':
+                grad_weight.addcmul_(weight, grad_var_weight, value=2)
+            elif level == 'coef':
+                grad_weight.addcmul_(
+                    weight, grad_var_weight * torch.exp(log_var), value=2)
+        if needs_bias:
+            grad_bias = grad_output.sum(dim=0)
+        if needs_log_var:
+            if level == 'layer':
+                grad_log_var = alpha * torch.sum(var_weight * grad_var_weight)
+            elif level == 'atom':
+                grad_log_var = torch.sum(var_weight * grad_var_weight,
+                                         dim=0, keepdim=True)
+            else:
+                grad_log_var = var_weight * grad_var_weight
+        return grad_input, grad_weight, grad_bias, grad_log_var, None, None
+
+
 class DropoutLinear(nn.Linear):
     def __init__(self, in_features, out_features, bias=True, p=1e-8,
                  level='layer', var_penalty=0., adaptive=False,
@@ -40,6 +125,9 @@ class DropoutLinear(nn.Linear):
         self.adaptive = adaptive
         self.level = level
 
+        self._compiled_weight = None
+        self._compiled_columns = None
+
         self.reset_dropout()
 
     def reset_parameters(self):
@@ -81,6 +169,44 @@ class DropoutLinear(nn.Linear):
         self.adaptive = True
         self.log_alpha.requires_grad = True
 
+    def select(self, in_indices=None, out_indices=None):
+        """
+        Keep only a subset of the input and output features, in place.
+
+        Parameters
+        ----------
+        in_indices : torch.LongTensor or None
+            Input features to keep, all if None
+
+        out_indices : torch.LongTensor or None
+            Output features to keep, all if None
+        """
+        self.decompile_sparse()
+        with torch.no_grad():
+            if in_indices is None:
+                in_indices = torch.arange(self.in_features)
+            if out_indices is None:
+                out_indices = torch.arange(self.out_features)
+            self.weight = Parameter(self.weight[out_indices][:, in_indices],
+                                    requires_grad=self.weight.requires_grad)
+            if self.bias is not None:
+                self.bias = Parameter(self.bias[out_indices],
+                                      requires_grad=self.bias.requires_grad)
+            if self.level == 'additive':
+                self.log_sigma2 = Parameter(
+                    self.log_sigma2[out_indices][:, in_indices],
+                    requires_grad=self.log_sigma2.requires_grad)
+            if self.level == 'atom':
+                self.log_alpha = Parameter(
+                    self.log_alpha[:, in_indices],
+                    requires_grad=self.log_alpha.requires_grad)
+            elif self.level == 'coef':
+                self.log_alpha = Parameter(
+                    self.log_alpha[out_indices][:, in_indices],
+                    requires_grad=self.log_alpha.requires_grad)
+        self.in_features = len(in_indices)
+        self.out_features = len(out_indices)
+
     def get_var_weight(self):
         if self.level == 'additive':
             return torch.exp(self.log_sigma2)
@@ -103,25 +229,129 @@ class DropoutLinear(nn.Linear):
             if self.p == 0:
                 return F.linear(input, self.weight, self.bias)
             if self.adaptive:
-                output = F.linear(input, self.weight, self.bias)
                 # Local reparemtrization trick: gaussian latent_dropout noise on input
                 # <-> gaussian noise on output
-                std = torch.sqrt(
-                    F.linear(input ** 2, self.get_var_weight(), None) + 1e-8)
-                eps = torch.randn_like(output, requires_grad=False)
-                return output + std * eps
+                if input.dim() != 2:
+                    return self._forward_reference(input)
+                eps = torch.randn((input.shape[0], self.out_features),
+                                  dtype=input.dtype, device=input.device)
+                if self.level == 'additive':
+                    log_var = self.log_sigma2
+                else:
+                    log_var = self.log_alpha
+                return _LocalReparametrization.apply(
+                    input, self.weight, self.bias, log_var, eps, self.level)
             else:
                 eps = torch.randn_like(input, requires_grad=False)
                 input = input * (
                         1 + torch.exp(.5 * self.get_log_alpha()) * eps)
                 return F.linear(input, self.weight, self.bias)
         else:
+            # Estimators pickled before `compile_sparse` existed lack the
+            # attribute
+            if getattr(self, '_compiled_weight', None) is not None:
+                return self._forward_compiled(input)
             if self.sparsify:
                 weight = self.sparse_weight
             else:
                 weight = self.weight
             return F.linear(input, weight, self.bias)
 
+    def train(self, mode=True):
+        if mode:
+            self.decompile_sparse()
+        return super().train(mode)
+
+    def compile_sparse(self, threshold=0.01):
+        """
+        Freeze the weights used in eval mode into a compressed
+        representation.
+
+        Input atoms whose weights are all zero (after pruning of weights with
+        `log_alpha > 3` if `sparsify`) are dropped, and the remaining block
+        is stored dense, or in CSR format if its density is below
+        `threshold`. Eval-mode `forward` then uses this representation
+        until the module is put back in training mode, or its state dict is
+        loaded. The weights must be compiled again after in-place edits.
+
+        Dense BLAS is fast on the small layers of the reduced models: the CSR
+        format only pays off for very sparse layers. See
+        `exps/benchmarks/sparse_inference.py` to tune `threshold`.
+
+        Parameters
+        ----------
+        threshold : float
+            Density under which the weights are stored in CSR format
+
+        Returns
+        -------
+        density : float
+            Density of the compiled block
+        """
+        with torch.no_grad():
+            weight = self.sparse_weight if self.sparsify else self.weight
+            weight = weight.detach()
+            columns = torch.nonzero(torch.any(weight != 0, dim=0))[:, 0]
+            if len(columns) < weight.shape[1]:
+                weight = weight[:, columns]
+                self._compiled_columns = columns
+            else:
+                self._compiled_columns = None
+            density = (weight != 0).float().mean().item() \
+                if weight.numel() > 0 else 0.
+            if density < threshold:
+                if hasattr(weight, 'to_sparse_csr'):
+                    weight = weight.to_sparse_csr()
+                else:
+                    weight = weight.to_sparse()
+            else:
+                weight = weight.contiguous()
+            self._compiled_weight = weight
+        return density
+
+    def decompile_sparse(self):
+        """Discard the representation built by `compile_sparse`."""
+        self._compiled_weight = None
+        self._compiled_columns = None
+
+    @contextmanager
+    def keep_compiled(self):
+        """
+        Context manager keeping the representation built by
+        `compile_sparse` across changes of mode, for computations that do
+        not modify the weights.
+        """
+        compiled = (getattr(self, '_compiled_weight', None),
+                    getattr(self, '_compiled_columns', None))
+        try:
+            yield self
+        finally:
+            self._compiled_weight, self._compiled_columns = compiled
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.decompile_sparse()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def _forward_compiled(self, input):
+        if getattr(self, '_compiled_columns', None) is not None:
+            input = input.index_select(-1, self._compiled_columns)
+        weight = self._compiled_weight
+        if weight.layout == torch.strided:
+            return F.linear(input, weight, self.bias)
+        output = torch.mm(weight, input.reshape(-1, input.shape[-1]).t()).t()
+        output = output.reshape(input.shape[:-1] + (self.out_features, ))
+        if self.bias is not None:
+            output = output + self.bias
+        return output
+
+    def _forward_reference(self, input):
+        """Unfused local reparametrization, for inputs that are not 2D."""
+        output = F.linear(input, self.weight, self.bias)
+        std = torch.sqrt(
+            F.linear(input ** 2, self.get_var_weight(), None) + 1e-8)
+        eps = torch.randn_like(output, requires_grad=False)
+        return output + std * eps
+
     def penalty(self):
         if not self.adaptive or self.var_penalty == 0:
             return torch.tensor(0., device=self.weight.device,
@@ -130,7 +360,15 @@ class DropoutLinear(nn.Linear):
             log_alpha = self.get_log_alpha()
             var_penalty = - k1 * (torch.sigmoid(k2 + k3 * log_alpha)
                                   - .5 * F.softplus(-log_alpha)
-                                  - 1).expand(*self.weight.shape).sum()
+                                  - 1)
+            # log_alpha is shared by all weights of the layer, or by all
+            # weights of an input atom: avoid expanding to the weight shape
+            if self.level == 'layer':
+                var_penalty = var_penalty.sum() * self.weight.numel()
+            elif self.level == 'atom':
+                var_penalty = var_penalty.sum() * self.out_features
+            else:
+                var_penalty = var_penalty.sum()
             return var_penalty * self.var_penalty
 
     @property
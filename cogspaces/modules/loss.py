@@ -4,6 +4,8 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from cogspaces.input_data import PackedTensor
+
 
 class MultiStudyLoss(nn.Module):
     def __init__(self, study_weights: Dict[str, float],
@@ -14,10 +16,24 @@ class MultiStudyLoss(nn.Module):
     def forward(self, preds: Dict[str, torch.FloatTensor],
                 targets: Dict[str, torch.LongTensor]) \
             -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        if isinstance(preds, PackedTensor):
+            return self._forward_packed(preds, targets)
         loss = 0
         for study in preds:
             pred = preds[study]
             target = targets[study]
             this_loss = F.nll_loss(pred, target, reduction='elementwise_mean')
             loss += this_loss * self.study_weights[study]
-        return loss
\ No newline at end of file
+        return loss
+
+    def _forward_packed(self, preds: PackedTensor,
+                        targets: PackedTensor) -> torch.FloatTensor:
+        # Per-study mean, weighted, computed as a single weighted sum
+        lengths = preds.lengths
+        weights = torch.tensor([self.study_weights[study]
+                                for study in preds.studies],
+                               dtype=preds.data.dtype,
+                               device=preds.data.device)
+        weights = torch.repeat_interleave(weights / lengths.float(), lengths)
+        nll = - torch.gather(preds.data, 1, targets.data[:, None])[:, 0]
+        return torch.sum(nll * weights)
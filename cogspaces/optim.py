@@ -0,0 +1,322 @@
+"""
+Optimizers for the multi-study models.
+"""
+
+import torch
+from torch.optim import Optimizer
+
+
+class MaskedAdam(Optimizer):
+    """
+    Adam for parameters stacked along their first dimension.
+
+    Each slice `param[i]` behaves as an independent parameter, with its own
+    step count. At each step, only the slices selected by `mask` are
+    updated, leaving the parameters and moments of the other slices
+    untouched. This allows to train a batch of independent models in
+    lockstep while stopping some of them early.
+
+    Parameters
+    ----------
+    params : Iterable[torch.Tensor]
+        Parameters to optimize, sharing the same first dimension
+
+    lr : float
+        Learning rate
+
+    betas : Tuple[float, float]
+        Coefficients of the running averages of the gradient and of its
+        square
+
+    eps : float
+        Term added to the denominator for numerical stability
+
+    amsgrad : bool
+        Use the AMSGrad variant
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 amsgrad=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps, amsgrad=amsgrad)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, mask):
+        """
+        Performs a single optimization step on the selected slices.
+
+        Parameters
+        ----------
+        mask : torch.BoolTensor
+            Slices to update, of size `param.shape[0]`
+        """
+        # Only the selected slices are read and written, which is cheaper
+        # than masking whole tensors when few slices are selected
+        index = torch.nonzero(mask, as_tuple=True)[0]
+        if len(index) == 0:
+            return
+        if len(index) == len(mask):
+            index = slice(None)
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = torch.zeros(p.shape[0],
+                                                device=p.device)
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                    if group['amsgrad']:
+                        state['max_exp_avg_sq'] = torch.zeros_like(p)
+                # Basic indexing returns views, updated in place
+                views = isinstance(index, slice)
+                view = (-1,) + (1,) * (p.dim() - 1)
+                state['step'][index] += 1
+                step = state['step'][index].view(view)
+                grad = p.grad[index]
+
+                exp_avg = state['exp_avg'][index]
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq = state['exp_avg_sq'][index]
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                if not views:
+                    state['exp_avg'][index] = exp_avg
+                    state['exp_avg_sq'][index] = exp_avg_sq
+                if group['amsgrad']:
+                    max_exp_avg_sq = state['max_exp_avg_sq'][index]
+                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+                    if not views:
+                        state['max_exp_avg_sq'][index] = max_exp_avg_sq
+                    denom = max_exp_avg_sq.sqrt()
+                else:
+                    denom = exp_avg_sq.sqrt()
+                bias_correction1 = 1 - beta1 ** step
+                bias_correction2 = 1 - beta2 ** step
+                denom.div_(bias_correction2.sqrt()).add_(group['eps'])
+                update = exp_avg / denom
+                update.mul_(group['lr'] / bias_correction1)
+                if views:
+                    p.sub_(update)
+                else:
+                    p[index] = p[index] - update
+
+
+class LazyAdam(Optimizer):
+    """
+    Adam that only updates the parameters that received a gradient.
+
+    Gradients are reset to None by `zero_grad`, so that parameters that did
+    not take part in the last forward pass (e.g. the classification heads of
+    studies absent from the batch) are skipped by `step`. The cost of a step
+    thus scales with the number of active parameters.
+
+    When a parameter becomes active again after `k` skipped steps, its
+    moment estimates are decayed by `beta1 ** k` and `beta2 ** k`, as
+    dense Adam would have done with zero gradients, and bias correction
+    uses the global step count. Unlike dense Adam, the parameter is not
+    moved by its momentum during the skipped steps.
+
+    Parameters
+    ----------
+    params : Iterable[torch.Tensor] or Iterable[Dict]
+        Parameters to optimize, or parameter groups
+
+    lr : float
+        Learning rate
+
+    betas : Tuple[float, float]
+        Coefficients of the running averages of the gradient and of its
+        square
+
+    eps : float
+        Term added to the denominator for numerical stability
+
+    amsgrad : bool
+        Use the AMSGrad variant
+    """
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 amsgrad=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps, amsgrad=amsgrad)
+        super().__init__(params, defaults)
+        self.n_steps = 0
+
+    def zero_grad(self, set_to_none=True):
+        for group in self.param_groups:
+            for p in group['params']:
+                p.grad = None
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        self.n_steps += 1
+        n_steps = self.n_steps
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            bias_correction1 = 1 - beta1 ** n_steps
+            bias_correction2 = 1 - beta2 ** n_steps
+            step_size = group['lr'] / bias_correction1
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                state = self.state[p]
+                if len(state) == 0:
+                    state['last_step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                    if group['amsgrad']:
+                        state['max_exp_avg_sq'] = torch.zeros_like(p)
+                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+                skipped = n_steps - state['last_step'] - 1
+                if skipped > 0:
+                    exp_avg.mul_(beta1 ** skipped)
+                    exp_avg_sq.mul_(beta2 ** skipped)
+                state['last_step'] = n_steps
+
+                exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                if group['amsgrad']:
+                    max_exp_avg_sq = state['max_exp_avg_sq']
+                    torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+                    denom = max_exp_avg_sq.sqrt()
+                else:
+                    denom = exp_avg_sq.sqrt()
+                denom.div_(bias_correction2 ** .5).add_(group['eps'])
+                p.addcdiv_(exp_avg, denom, value=-step_size)
+        return loss
+
+
+def _flat_grad(loss, params, create_graph=False, retain_graph=None):
+    grads = torch.autograd.grad(loss, params, create_graph=create_graph,
+                                retain_graph=retain_graph)
+    return torch.cat([grad.reshape(-1) for grad in grads])
+
+
+def _add_to_params(params, direction, step_size):
+    offset = 0
+    for p in params:
+        numel = p.numel()
+        p.add_(direction[offset:offset + numel].view_as(p), alpha=step_size)
+        offset += numel
+
+
+def minimize_lbfgs(objective, params, max_iter=100, tol=1e-6):
+    """
+    Minimize a deterministic objective with full-batch L-BFGS.
+
+    Parameters
+    ----------
+    objective : Callable[[], torch.tensor]
+        Function returning the scalar objective
+
+    params : List[torch.Tensor]
+        Parameters to optimize, in place
+
+    max_iter : int
+        Maximum number of iterations
+
+    tol : float
+        Tolerance on the gradient norm
+
+    Returns
+    -------
+    loss : float
+        Final value of the objective
+    """
+    optimizer = torch.optim.LBFGS(params, lr=1, max_iter=max_iter,
+                                  tolerance_grad=tol,
+                                  tolerance_change=1e-12,
+                                  history_size=20,
+                                  line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = objective()
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    with torch.no_grad():
+        return objective().item()
+
+
+def minimize_newton(objective, params, max_iter=100, tol=1e-6,
+                    max_cg_iter=50):
+    """
+    Minimize a deterministic objective with a truncated Newton method.
+
+    The Newton direction is obtained by conjugate gradient on exact
+    Hessian-vector products, so that the Hessian is never formed. The step
+    size is chosen by backtracking line search.
+
+    Parameters
+    ----------
+    objective : Callable[[], torch.tensor]
+        Function returning the scalar objective
+
+    params : List[torch.Tensor]
+        Parameters to optimize, in place
+
+    max_iter : int
+        Maximum number of Newton iterations
+
+    tol : float
+        Tolerance on the gradient norm
+
+    max_cg_iter : int
+        Maximum number of conjugate gradient iterations per Newton step
+
+    Returns
+    -------
+    loss : float
+        Final value of the objective
+    """
+    for _ in range(max_iter):
+        loss = objective()
+        grad = _flat_grad(loss, params, create_graph=True)
+        grad_norm = grad.norm()
+        if grad_norm.item() < tol:
+            break
+
+        # Conjugate gradient on H d = - g, stopped on negative curvature
+        direction = torch.zeros_like(grad)
+        residual = - grad.detach()
+        conjugate = residual.clone()
+        residual_sq = residual.dot(residual)
+        cg_tol = min(.5, grad_norm.sqrt().item()) * grad_norm.item()
+        for _ in range(max_cg_iter):
+            hvp = _flat_grad(grad.dot(conjugate), params, retain_graph=True)
+            curvature = conjugate.dot(hvp)
+            if curvature.item() <= 0:
+                if not torch.any(direction != 0):
+                    direction = - grad.detach()
+                break
+            step = residual_sq / curvature
+            direction += step * conjugate
+            residual -= step * hvp
+            new_residual_sq = residual.dot(residual)
+            if new_residual_sq.sqrt().item() < cg_tol:
+                break
+            conjugate = residual + new_residual_sq / residual_sq * conjugate
+            residual_sq = new_residual_sq
+
+        # Backtracking line search (Armijo condition)
+        loss = loss.item()
+        slope = grad.detach().dot(direction).item()
+        step_size = 1.
+        with torch.no_grad():
+            _add_to_params(params, direction, step_size)
+            new_loss = objective().item()
+            while new_loss > loss + 1e-4 * step_size * slope \
+                    and step_size > 1e-10:
+                _add_to_params(params, direction, - step_size / 2)
+                step_size /= 2
+                new_loss = objective().item()
+        if loss - new_loss < 1e-12 * max(1., abs(loss)):
+            break
+    with torch.no_grad():
+        return objective().item()
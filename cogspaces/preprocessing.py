@@ -25,22 +25,66 @@ class MultiStandardScaler(BaseEstimator, TransformerMixin):
     """
 
     def fit(self, data):
+        """
+        Parameters
+        ----------
+        data : Dict[str, np.ndarray or ChunkedArray]
+            Input data of each study. Chunked arrays
+            (see `cogspaces.datasets.chunked`) are read chunk by chunk
+
+        Returns
+        -------
+        self: MultiStandardScaler
+        """
         self.sc_ = {}
+        return self.partial_fit(data)
+
+    def partial_fit(self, data):
+        """
+        Update the statistics of each study with new rows.
+
+        Parameters
+        ----------
+        data : Dict[str, np.ndarray or ChunkedArray]
+            Next rows of the input data of each study
+
+        Returns
+        -------
+        self: MultiStandardScaler
+        """
+        if not hasattr(self, 'sc_'):
+            self.sc_ = {}
         for study, this_data in data.items():
-            self.sc_[study] = StandardScaler().fit(this_data)
+            if study not in self.sc_:
+                self.sc_[study] = StandardScaler()
+            if hasattr(this_data, 'iter_chunks'):
+                for chunk in this_data.iter_chunks():
+                    self.sc_[study].partial_fit(chunk)
+            else:
+                self.sc_[study].partial_fit(this_data)
             # self.sc_[study].scale_ /= np.sqrt(len(this_data))
         return self
 
     def transform(self, data):
+        """Standard-scale each study. Chunked arrays are scaled lazily,
+        chunk by chunk."""
         transformed = {}
         for study, this_data in data.items():
-            transformed[study] = self.sc_[study].transform(this_data)
+            if hasattr(this_data, 'iter_chunks'):
+                transformed[study] = this_data.map(self.sc_[study].transform)
+            else:
+                transformed[study] = self.sc_[study].transform(this_data)
         return transformed
 
     def inverse_transform(self, data):
         transformed = {}
         for study, this_data in data.items():
-            transformed[study] = self.sc_[study].inverse_transform(this_data)
+            if hasattr(this_data, 'iter_chunks'):
+                transformed[study] = this_data.map(
+                    self.sc_[study].inverse_transform)
+            else:
+                transformed[study] = self.sc_[study].inverse_transform(
+                    this_data)
         return transformed
 
     @property
@@ -0,0 +1,240 @@
+"""
+Projection of voxel-level maps on the components of an atlas, factorized
+once.
+"""
+
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve
+
+# Below this fraction of non-zero loadings, sparse products are faster
+# than dense ones
+SPARSE_DENSITY = 0.05
+
+
+class AtlasProjector(object):
+    def __init__(self, components, sparse='auto'):
+        """
+        Projection of maps on a dictionary of components, by dot product or
+        least squares.
+
+        The Gram matrix of the components and its Cholesky factor are
+        computed once, so that the least-squares loadings of a block of
+        maps `X` are obtained by solving `G B = C X^T` with two triangular
+        solves, at about the cost of the dot product `C X^T`. Sparse
+        components are stored as a CSC matrix.
+
+        Parameters
+        ----------
+        components : np.ndarray or scipy.sparse matrix,
+                     shape (n_components, n_features)
+            Components of the atlas, masked
+
+        sparse : bool or 'auto'
+            Store the components as a sparse matrix. If 'auto', when less
+            than `SPARSE_DENSITY` of the loadings are non-zero
+        """
+        if sparse == 'auto':
+            density = (components.nnz if sp.issparse(components)
+                       else np.count_nonzero(components)) \
+                / np.prod(components.shape)
+            sparse = density < SPARSE_DENSITY
+        # The Gram matrix squares the condition number: compute it in
+        # double precision, once
+        if sparse:
+            components = sp.csc_matrix(components, dtype=np.float32)
+            components64 = components.astype(np.float64)
+            gram = (components64 @ components64.T).toarray()
+        else:
+            if sp.issparse(components):
+                components = components.toarray()
+            components = np.ascontiguousarray(components, dtype=np.float32)
+            components64 = components.astype(np.float64)
+            gram = components64 @ components64.T
+        try:
+            self.cholesky_ = cho_factor(gram, lower=True)[0]
+        except np.linalg.LinAlgError:
+            # Linearly dependent components: only dot products are defined
+            self.cholesky_ = None
+        self.components_ = components
+        self.source_ = None
+
+    @property
+    def n_components(self):
+        return self.components_.shape[0]
+
+    @property
+    def n_features(self):
+        return self.components_.shape[1]
+
+    def transform(self, X, method='lstsq', block_size=256, out=None):
+        """
+        Project maps on the components.
+
+        Parameters
+        ----------
+        X : np.ndarray or ChunkedArray, shape (n_samples, n_features)
+            Masked maps. Chunked arrays (see `cogspaces.datasets.chunked`)
+            are read block by block
+
+        method : {'lstsq', 'dot'}
+            Least-squares loadings, or dot products with the components
+
+        block_size : int
+            Number of maps projected at once
+
+        out : np.ndarray or None, shape (n_samples, n_components)
+            Preallocated output, e.g. memory-mapped
+
+        Returns
+        -------
+        loadings : np.ndarray, shape (n_samples, n_components)
+        """
+        if out is None:
+            out = np.empty((X.shape[0], self.n_components), dtype=np.float32)
+        start = 0
+        for loadings in self.iter_transform(X, method=method,
+                                            block_size=block_size):
+            out[start:start + len(loadings)] = loadings
+            start += len(loadings)
+        return out
+
+    def iter_transform(self, X, method='lstsq', block_size=256):
+        """
+        Project maps on the components, block by block.
+
+        Parameters
+        ----------
+        X : np.ndarray, ChunkedArray or Iterable[np.ndarray]
+            Masked maps, or successive blocks of maps
+
+        method : {'lstsq', 'dot'}
+
+        block_size : int
+
+        Yields
+        ------
+        loadings : np.ndarray, shape (n_block_samples, n_components)
+            Loadings of the next maps
+        """
+        if method not in ['lstsq', 'dot']:
+            raise ValueError('Wrong value for `method`')
+        if method == 'lstsq' and self.cholesky_ is None:
+            raise ValueError('Components are linearly dependent, use'
+                             ' method="dot"')
+        if hasattr(X, 'iter_chunks'):
+            blocks = X.iter_chunks(block_size)
+        elif hasattr(X, 'shape'):
+            blocks = (X[start:start + block_size]
+                      for start in range(0, X.shape[0], block_size))
+        else:
+            blocks = X
+        for block in blocks:
+            block = np.asarray(block, dtype=np.float32)
+            # (n_components, n_block_samples), sparse @ dense when sparse
+            products = self.components_ @ block.T
+            if method == 'lstsq':
+                products = cho_solve((self.cholesky_, True),
+                                     products.astype(np.float64),
+                                     overwrite_b=True, check_finite=False)
+            yield products.T.astype(np.float32)
+
+    def save(self, filename):
+        """
+        Save the projector in a `.npz` file.
+
+        Parameters
+        ----------
+        filename : str
+        """
+        arrays = dict(source=np.array(json.dumps(self.source_)))
+        if self.cholesky_ is not None:
+            arrays['cholesky'] = self.cholesky_
+        if sp.issparse(self.components_):
+            arrays.update(data=self.components_.data,
+                          indices=self.components_.indices,
+                          indptr=self.components_.indptr,
+                          shape=np.array(self.components_.shape))
+        else:
+            arrays['components'] = self.components_
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a projector saved by `AtlasProjector.save`, without
+        factorizing the components again.
+
+        Parameters
+        ----------
+        filename : str
+
+        Returns
+        -------
+        projector : AtlasProjector
+        """
+        projector = cls.__new__(cls)
+        with np.load(filename) as arrays:
+            if 'components' in arrays:
+                projector.components_ = arrays['components']
+            else:
+                projector.components_ = sp.csc_matrix(
+                    (arrays['data'], arrays['indices'], arrays['indptr']),
+                    shape=tuple(arrays['shape']))
+            projector.cholesky_ = (arrays['cholesky'] if 'cholesky' in arrays
+                                   else None)
+            projector.source_ = json.loads(str(arrays['source']))
+        return projector
+
+    @classmethod
+    def from_atlas(cls, atlas_img, mask_img, sparse='auto', cache=True):
+        """
+        Projector on the components of an atlas, masked. The projector is
+        cached next to the atlas, in `<atlas>_projector.npz`, and rebuilt
+        when the atlas or the mask change.
+
+        Parameters
+        ----------
+        atlas_img : str
+            Filename of the 4D image of the components, e.g.
+            `fetch_atlas_modl()['components_453_gm']`
+
+        mask_img : str
+            Filename of the mask, e.g. `fetch_mask()`
+
+        sparse : bool or 'auto'
+
+        cache : bool
+            Load and save the projector next to the atlas
+
+        Returns
+        -------
+        projector : AtlasProjector
+        """
+        from nilearn.input_data import NiftiMasker
+
+        source = [[os.path.abspath(filename), os.path.getmtime(filename)]
+                  for filename in (atlas_img, mask_img)]
+        filename = _projector_filename(atlas_img)
+        if cache and os.path.exists(filename):
+            projector = cls.load(filename)
+            if projector.source_ == source:
+                return projector
+        components = NiftiMasker(mask_img=mask_img).fit().transform(
+            atlas_img)
+        projector = cls(components, sparse=sparse)
+        projector.source_ = source
+        if cache:
+            projector.save(filename)
+        return projector
+
+
+def _projector_filename(atlas_img):
+    root = atlas_img
+    for ext in ['.gz', '.nii']:
+        if root.endswith(ext):
+            root = root[:-len(ext)]
+    return root + '_projector.npz'
@@ -0,0 +1,217 @@
+"""
+Registry of the models trained by `exps/train.py`, loaded lazily and kept
+in a memory-bounded LRU cache.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict
+from os.path import join
+
+import numpy as np
+
+from cogspaces.classification.compiled import _log_softmax
+from cogspaces.datasets.utils import get_output_dir
+from cogspaces.serving import DecodingModel
+
+
+class _LRUCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        value, nbytes = self._entries.pop(key)
+        self._entries[key] = value, nbytes
+        return value
+
+    def put(self, key, value, nbytes):
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        self._entries[key] = value, nbytes
+        self.nbytes += nbytes
+        # The newest entry is kept, even if larger than max_bytes
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ModelRegistry(object):
+    def __init__(self, output_dir=None, max_bytes=2 ** 30):
+        """
+        Index of the models of an output directory, with seed-averaged
+        predictions.
+
+        Models are looked up in `output_dir/<estimator>/<seed>`, as written
+        by `exps/train.py`. They are compiled into affine decoders on first
+        use (see `cogspaces.serving.DecodingModel`), and kept in an LRU
+        cache. Averaging over seeds stacks the decoders of all seeds, so
+        that a single matrix product per study scores all of them.
+
+        Parameters
+        ----------
+        output_dir : str or None
+            Root of the models, `cogspaces.datasets.utils.get_output_dir()`
+            if None
+
+        max_bytes : int
+            Memory budget of the cached decoders, in bytes
+        """
+        self.output_dir = get_output_dir(output_dir)
+        self.max_bytes = max_bytes
+
+        self._cache = _LRUCache(max_bytes)
+        self._lock = threading.Lock()
+        self.scan()
+
+    def scan(self):
+        """
+        Index the model directories, keeping loaded models.
+
+        Returns
+        -------
+        self: ModelRegistry
+        """
+        regex = re.compile(r'[0-9]+$')
+        self.index_ = {}
+        if not os.path.exists(self.output_dir):
+            return self
+        for estimator in sorted(os.listdir(self.output_dir)):
+            estimator_dir = join(self.output_dir, estimator)
+            if not os.path.isdir(estimator_dir):
+                continue
+            for seed in filter(regex.match, os.listdir(estimator_dir)):
+                model_dir = join(estimator_dir, seed)
+                files = os.listdir(model_dir)
+                if 'target_encoder.pkl' in files and (
+                        'estimator.cogspaces' in files
+                        or 'estimator.pkl' in files):
+                    self.index_[(estimator, int(seed))] = model_dir
+        return self
+
+    @property
+    def estimators(self):
+        return sorted({estimator for estimator, _ in self.index_})
+
+    def seeds(self, estimator):
+        return sorted(seed for this_estimator, seed in self.index_
+                      if this_estimator == estimator)
+
+    def get(self, estimator, seed):
+        """
+        Parameters
+        ----------
+        estimator : str
+            Name of the estimator, e.g. 'multi_study'
+
+        seed : int
+
+        Returns
+        -------
+        model : cogspaces.serving.DecodingModel
+        """
+        key = ('model', estimator, seed)
+        with self._lock:
+            if key in self._cache:
+                return self._cache.get(key)
+        model = DecodingModel.from_dir(self.index_[(estimator, seed)])
+        nbytes = sum(coef.nbytes + model.decoder.intercepts[study].nbytes
+                     for study, coef in model.decoder.coefs.items())
+        with self._lock:
+            self._cache.put(key, model, nbytes)
+        return model
+
+    def predict_proba(self, X, estimator='multi_study', seeds=None):
+        """
+        Predict the probabilities of the contrasts, averaged over seeds.
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray]
+            Dictionary of input data (one array per study), before standard
+            scaling
+
+        estimator : str
+            Name of the estimator
+
+        seeds : Iterable[int] or None
+            Seeds to average, all the indexed ones if None
+
+        Returns
+        -------
+        y: Dict[str, np.ndarray]
+            Mean predicted probabilities
+        """
+        if seeds is None:
+            seeds = self.seeds(estimator)
+        seeds = tuple(seeds)
+        preds = {}
+        for study, this_X in X.items():
+            coef, intercept = self._get_stack(estimator, seeds, study)
+            this_X = np.asarray(this_X, dtype=coef.dtype)
+            logits = this_X.dot(coef.T)
+            logits += intercept
+            n_samples = this_X.shape[0]
+            logits = logits.reshape(n_samples * len(seeds), -1)
+            probas = np.exp(_log_softmax(logits))
+            preds[study] = probas.reshape(n_samples, len(seeds),
+                                          -1).mean(axis=1)
+        return preds
+
+    def predict(self, X, estimator='multi_study', seeds=None):
+        """
+        Predict the consensus contrast names over seeds.
+
+        Parameters
+        ----------
+        X : Dict[str, np.ndarray]
+            Dictionary of input data (one array per study), before standard
+            scaling
+
+        estimator : str
+            Name of the estimator
+
+        seeds : Iterable[int] or None
+            Seeds to average, all the indexed ones if None
+
+        Returns
+        -------
+        y: Dict[str, np.ndarray]
+            Contrast names with the largest mean probability
+        """
+        if seeds is None:
+            seeds = self.seeds(estimator)
+        seeds = list(seeds)
+        model = self.get(estimator, seeds[0])
+        return {study: model.contrasts(study)[np.argmax(proba, axis=1)]
+                for study, proba in self.predict_proba(
+                    X, estimator=estimator, seeds=seeds).items()}
+
+    def _get_stack(self, estimator, seeds, study):
+        """Decoders of all seeds for one study, stacked along targets."""
+        key = ('stack', estimator, seeds, study)
+        with self._lock:
+            if key in self._cache:
+                return self._cache.get(key)
+        models = [self.get(estimator, seed) for seed in seeds]
+        contrasts = models[0].contrasts(study)
+        for model in models[1:]:
+            if not np.array_equal(model.contrasts(study), contrasts):
+                raise ValueError('Seeds of %s disagree on the contrasts of'
+                                 ' %s' % (estimator, study))
+        coef = np.concatenate([model.decoder.coefs[study]
+                               for model in models])
+        intercept = np.concatenate([model.decoder.intercepts[study]
+                                    for model in models])
+        with self._lock:
+            self._cache.put(key, (coef, intercept),
+                            coef.nbytes + intercept.nbytes)
+        return coef, intercept
@@ -36,19 +36,14 @@ def compute_classifs(estimator, standard_scaler, config, return_type='img'):
         module = curate_module(estimator)
         module.eval()
 
-        studies = module.classifiers.keys()
-        in_features = module.embedder.in_features
-
-        with torch.no_grad():
-            classifs = module({study: torch.eye(in_features)
-                               for study in studies}, logits=True)
-            biases = module({study: torch.zeros((1, in_features))
-                             for study in studies}, logits=True)
-            classifs = {study: classifs[study] - biases[study]
-                        for study in studies}
-            classifs = {study: classif - classif.mean(dim=0, keepdim=True)
+        classifs = {study: coef.numpy() for study, (coef, bias)
+                    in module.compute_affine().items()}
+        if hasattr(estimator, 'input_support_'):
+            # Pruned atoms have no weight
+            classifs = {study: estimator.expand_pruned(classif)
                         for study, classif in classifs.items()}
-        classifs = {study: classif.numpy().T
+        # Center the map of each target across features
+        classifs = {study: classif - classif.mean(axis=1, keepdims=True)
                     for study, classif in classifs.items()}
 
     elif config['model']['estimator'] == 'logistic':
@@ -0,0 +1,235 @@
+"""
+Flat, memory-mappable serialization of multi-study models.
+
+A model file starts with a magic string and the size of a JSON header,
+followed by the header and by the raw tensors, each aligned on 64 bytes.
+The header lists the shape, dtype and offset of every tensor, along with
+the metadata needed to rebuild the model. Tensors are memory-mapped at load
+time, so that only the pages actually used are read from disk, and the
+heads of unused studies are never touched.
+"""
+
+import json
+import struct
+
+import numpy as np
+import torch
+
+from cogspaces.modules.factored import VarMultiStudyModule
+
+MAGIC = b'COGSPACE'
+VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_arrays(filename, arrays, meta=None):
+    """
+    Write arrays in a flat, memory-mappable file.
+
+    Parameters
+    ----------
+    filename : str
+
+    arrays : Dict[str, np.ndarray]
+        Arrays to write, indexed by name
+
+    meta : Dict or None
+        JSON-serializable metadata stored in the header
+    """
+    tensors = {}
+    offset = 0
+    arrays = {name: np.require(array, requirements='C')
+              for name, array in arrays.items()}
+    for name, array in arrays.items():
+        tensors[name] = dict(dtype=array.dtype.str, shape=list(array.shape),
+                             offset=offset)
+        offset = _align(offset + array.nbytes)
+    header = json.dumps(dict(version=VERSION, meta=meta,
+                             tensors=tensors)).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.write(b'\0' * (data_start + tensors[name]['offset'] - f.tell()))
+            f.write(array.data)
+
+
+def load_arrays(filename, names=None, mmap_mode='c'):
+    """
+    Load arrays written by `save_arrays`.
+
+    Parameters
+    ----------
+    filename : str
+
+    names : Iterable[str] or None
+        Arrays to load, all if None
+
+    mmap_mode : {'r', 'c'} or None
+        Memory-map the arrays, read-only ('r') or copy-on-write ('c'), or
+        read them in memory if None
+
+    Returns
+    -------
+    arrays : Dict[str, np.ndarray]
+
+    meta : Dict
+        Metadata of the header
+    """
+    header, data_start = read_header(filename)
+    tensors = header['tensors']
+    if names is None:
+        names = tensors.keys()
+    arrays = {}
+    if mmap_mode is not None:
+        buffer = np.memmap(filename, dtype=np.uint8, mode=mmap_mode)
+        for name in names:
+            tensor = tensors[name]
+            dtype = np.dtype(tensor['dtype'])
+            start = data_start + tensor['offset']
+            stop = start + dtype.itemsize * int(np.prod(tensor['shape']))
+            arrays[name] = buffer[start:stop].view(dtype).reshape(
+                tensor['shape'])
+    else:
+        with open(filename, 'rb') as f:
+            for name in names:
+                tensor = tensors[name]
+                f.seek(data_start + tensor['offset'])
+                dtype = np.dtype(tensor['dtype'])
+                count = int(np.prod(tensor['shape']))
+                arrays[name] = np.fromfile(f, dtype=dtype, count=count) \
+                    .reshape(tensor['shape'])
+    return arrays, header['meta']
+
+
+def read_header(filename):
+    """
+    Parameters
+    ----------
+    filename : str
+
+    Returns
+    -------
+    header : Dict
+        Version, metadata and tensor descriptions
+
+    data_start : int
+        Offset of the first tensor in the file
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a cogspaces model file' % filename)
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    if header['version'] > VERSION:
+        raise ValueError('Unsupported model file version %i'
+                         % header['version'])
+    return header, _align(len(MAGIC) + 8 + header_size)
+
+
+def _linear_config(linear):
+    return dict(p=linear.p, var_penalty=linear.var_penalty,
+                adaptive=linear.adaptive, level=linear.level,
+                sparsify=linear.sparsify)
+
+
+def _set_linear_config(linear, config):
+    if config['level'] == 'additive':
+        linear.make_additive()
+    elif config['adaptive']:
+        linear.make_adaptive()
+    linear.p = config['p']
+    linear.var_penalty = config['var_penalty']
+    linear.sparsify = config['sparsify']
+
+
+def module_to_arrays(module):
+    """
+    Describe a VarMultiStudyModule as arrays, without copying them.
+
+    Parameters
+    ----------
+    module : VarMultiStudyModule
+
+    Returns
+    -------
+    arrays : Dict[str, np.ndarray]
+        Parameters and buffers of the module
+
+    config : Dict
+        JSON-serializable structure of the module
+    """
+    classifiers = module.classifiers
+    config = dict(
+        init=module.init,
+        embedder=_linear_config(module.embedder),
+        classifiers={study: _linear_config(classifier.linear)
+                     for study, classifier in classifiers.items()},
+        batch_norm={study: hasattr(classifier, 'batch_norm')
+                    for study, classifier in classifiers.items()})
+    arrays = {name: tensor.detach().cpu().numpy()
+              for name, tensor in module.state_dict().items()}
+    return arrays, config
+
+
+def module_from_arrays(arrays, config, studies=None):
+    """
+    Rebuild a VarMultiStudyModule from `module_to_arrays` output.
+
+    The tensors of the module share the memory of `arrays`, that may be
+    memory-mapped.
+
+    Parameters
+    ----------
+    arrays : Dict[str, np.ndarray]
+
+    config : Dict
+
+    studies : Iterable[str] or None
+        Studies whose heads are rebuilt, all if None
+
+    Returns
+    -------
+    module : VarMultiStudyModule
+    """
+    if studies is None:
+        studies = list(config['classifiers'].keys())
+    latent_size, in_features = arrays['embedder.weight'].shape
+    target_sizes = {study: arrays['classifier_%s.linear.weight'
+                                  % study].shape[0] for study in studies}
+    batch_norm = {config['batch_norm'][study] for study in studies}
+    if len(batch_norm) > 1:
+        raise ValueError('Heads mix batch-norm and no batch-norm')
+    module = VarMultiStudyModule(
+        in_features, latent_size, target_sizes,
+        lengths={study: 1 for study in studies},
+        init=config['init'], batch_norm=batch_norm.pop() if studies else True)
+    _set_linear_config(module.embedder, config['embedder'])
+    for study in studies:
+        _set_linear_config(module.classifiers[study].linear,
+                           config['classifiers'][study])
+    for name, tensor in module.state_dict(keep_vars=True).items():
+        array = arrays[name]
+        if tuple(array.shape) != tuple(tensor.shape):
+            raise ValueError('Wrong shape for %s: %s, expected %s'
+                             % (name, array.shape, tuple(tensor.shape)))
+        tensor.data = torch.from_numpy(array)
+    return module
+
+
+def module_array_names(header, studies=None):
+    """Names of the tensors of a model file needed to load `studies`."""
+    names = [name for name in header['tensors']
+             if name.startswith('module_.')]
+    if studies is None:
+        return names
+    prefixes = tuple('module_.classifier_%s.' % study for study in studies)
+    return [name for name in names
+            if not name.startswith('module_.classifier_')
+            or name.startswith(prefixes)]
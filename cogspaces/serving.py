@@ -0,0 +1,423 @@
+"""
+Local decoding server, coalescing concurrent requests into micro-batches.
+
+Models are directories written by `exps/train.py`, holding `estimator.pkl`
+(or `estimator.cogspaces`), `target_encoder.pkl` and optionally
+`standard_scaler.pkl`. They are loaded
+once and compiled into NumPy-only affine decoders, which are read-only and
+thus safe to share between threads.
+
+Usage::
+
+    python -m cogspaces.serving output/multi_study/1 --port 8000
+
+    curl -X POST localhost:8000/predict \\
+        -d '{"study": "archi", "maps": [[0.1, ..., 0.3]]}'
+"""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import basename, join, normpath
+
+import numpy as np
+from joblib import load
+
+from cogspaces.classification.compiled import CompiledDecoder
+from cogspaces.classification.multi_study import MultiStudyClassifier
+
+
+class DecodingModel(object):
+    def __init__(self, decoder, target_encoder, standard_scaler=None):
+        """
+        Compiled decoder returning contrast names.
+
+        Parameters
+        ----------
+        decoder : cogspaces.classification.compiled.CompiledDecoder
+            Decoder of the numericalized contrasts
+
+        target_encoder : cogspaces.preprocessing.MultiTargetEncoder
+            Encoder used to numericalize the contrasts at training time
+
+        standard_scaler : cogspaces.preprocessing.MultiStandardScaler or None
+            Scaler applied to the inputs at training time. It is folded
+            into the decoder.
+        """
+        if standard_scaler is not None:
+            decoder = _fold_scaler(decoder, standard_scaler)
+        self.decoder = decoder
+        self.target_encoder = target_encoder
+
+    @classmethod
+    def from_dir(cls, output_dir):
+        """
+        Load and compile a model dumped by `exps/train.py`, from
+        `estimator.cogspaces` if present.
+
+        Parameters
+        ----------
+        output_dir : str
+            Directory holding `estimator.pkl` and `target_encoder.pkl`
+
+        Returns
+        -------
+        model : DecodingModel
+        """
+        native_file = join(output_dir, 'estimator.cogspaces')
+        if os.path.exists(native_file):
+            estimator = MultiStudyClassifier.load(native_file)
+        else:
+            estimator = load(join(output_dir, 'estimator.pkl'))
+        target_encoder = load(join(output_dir, 'target_encoder.pkl'))
+        scaler_file = join(output_dir, 'standard_scaler.pkl')
+        if os.path.exists(scaler_file):
+            standard_scaler = load(scaler_file)
+        else:
+            standard_scaler = None
+        return cls(estimator.compile(), target_encoder, standard_scaler)
+
+    @property
+    def studies(self):
+        return self.decoder.studies
+
+    def contrasts(self, study):
+        return self.target_encoder.le_[study]['contrast'].classes_
+
+    def decode(self, study, X):
+        """
+        Parameters
+        ----------
+        study : str
+
+        X : np.ndarray, shape (n_samples, n_features)
+            Input maps, before standard scaling
+
+        Returns
+        -------
+        contrasts : np.ndarray, shape (n_samples, )
+            Decoded contrast names
+        """
+        logits = self.decoder.decision_function({study: X})[study]
+        return self.contrasts(study)[np.argmax(logits, axis=1)]
+
+
+class MicroBatcher(object):
+    def __init__(self, decode, max_latency=0.005, max_batch_size=64):
+        """
+        Coalesce concurrent requests into batches, decoded by a worker
+        thread.
+
+        The worker waits for a first request, then collects the following
+        ones until `max_batch_size` samples are gathered or `max_latency`
+        seconds have elapsed.
+
+        Parameters
+        ----------
+        decode : Callable[[np.ndarray], np.ndarray]
+            Function decoding a batch of samples
+
+        max_latency : float
+            Maximum time spent waiting for other requests, in seconds
+
+        max_batch_size : int
+            Maximum number of samples of a batch
+        """
+        self.decode = decode
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, X):
+        """
+        Parameters
+        ----------
+        X : np.ndarray, shape (n_samples, n_features)
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future holding the decoded batch
+        """
+        future = Future()
+        self.queue.put((X, future))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        closed = False
+        while not closed:
+            request = self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            n_samples = len(request[0])
+            deadline = time.perf_counter() + self.max_latency
+            while n_samples < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        request = self.queue.get(timeout=timeout)
+                    else:
+                        request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    closed = True
+                    break
+                batch.append(request)
+                n_samples += len(request[0])
+            self._decode_batch(batch)
+
+    def _decode_batch(self, batch):
+        try:
+            preds = self.decode(np.concatenate([X for X, _ in batch]))
+        except Exception as exception:
+            for _, future in batch:
+                future.set_exception(exception)
+            return
+        offset = 0
+        for X, future in batch:
+            future.set_result(preds[offset:offset + len(X)])
+            offset += len(X)
+
+
+class DecodingServer(object):
+    def __init__(self, models, max_latency=0.005, max_batch_size=64):
+        """
+        Serve decoding models, with one micro-batcher per (model, study).
+
+        Parameters
+        ----------
+        models : Dict[str, DecodingModel]
+            Models, indexed by name
+
+        max_latency : float
+            See `MicroBatcher`
+
+        max_batch_size : int
+            See `MicroBatcher`
+        """
+        self.models = models
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+
+        self.batchers_ = {}
+        self._lock = threading.Lock()
+
+    def predict(self, study, X, model=None):
+        """
+        Decode input maps, blocking until their batch is processed.
+
+        Parameters
+        ----------
+        study : str
+
+        X : np.ndarray, shape (n_samples, n_features)
+
+        model : str or None
+            Name of the model, may be None if a single model is served
+
+        Returns
+        -------
+        contrasts : np.ndarray, shape (n_samples, )
+            Decoded contrast names
+        """
+        if model is None:
+            if len(self.models) > 1:
+                raise ValueError('A model name must be given when serving'
+                                 ' several models')
+            model = next(iter(self.models))
+        if model not in self.models:
+            raise KeyError('Unknown model %s' % model)
+        if study not in self.models[model].studies:
+            raise KeyError('Unknown study %s' % study)
+        n_features = self.models[model].decoder.n_features
+        if X.ndim != 2 or X.shape[1] != n_features:
+            # Would otherwise fail the whole batch
+            raise ValueError('Expected maps of %i features' % n_features)
+        return self._get_batcher(model, study).submit(X).result()
+
+    def _get_batcher(self, model, study):
+        key = (model, study)
+        with self._lock:
+            if key not in self.batchers_:
+                self.batchers_[key] = MicroBatcher(
+                    partial(self.models[model].decode, study),
+                    max_latency=self.max_latency,
+                    max_batch_size=self.max_batch_size)
+            return self.batchers_[key]
+
+    def describe(self):
+        return {name: {study: model.contrasts(study).tolist()
+                       for study in model.studies}
+                for name, model in self.models.items()}
+
+    def close(self):
+        with self._lock:
+            for batcher in self.batchers_.values():
+                batcher.close()
+            self.batchers_ = {}
+
+    def make_http_server(self, host='127.0.0.1', port=8000,
+                         unix_socket=None):
+        """
+        Parameters
+        ----------
+        host : str
+
+        port : int
+
+        unix_socket : str or None
+            If not None, listen on this Unix socket instead of `host:port`
+
+        Returns
+        -------
+        http_server : socketserver.BaseServer
+            Threaded HTTP server, to be started with `serve_forever`
+        """
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            http_server = ThreadingUnixHTTPServer(unix_socket,
+                                                  DecodingRequestHandler)
+        else:
+            http_server = ThreadingHTTPServer((host, port),
+                                              DecodingRequestHandler)
+        http_server.decoding_server = self
+        return http_server
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class DecodingRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+
+    - `GET /models`: studies and contrasts of each served model
+    - `POST /predict`: JSON body `{"study": str, "maps": [[float]],
+      "model": str (optional)}`, answered by `{"contrasts": [str]}`
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        if not isinstance(self.client_address, tuple):
+            # Unix sockets have no Nagle algorithm
+            self.disable_nagle_algorithm = False
+        super().setup()
+
+    def do_GET(self):
+        if self.path != '/models':
+            self._send(404, {'error': 'Unknown path %s' % self.path})
+            return
+        self._send(200, self.server.decoding_server.describe())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': 'Unknown path %s' % self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            X = np.atleast_2d(np.asarray(request['maps'], dtype=np.float32))
+            contrasts = self.server.decoding_server.predict(
+                request['study'], X, model=request.get('model'))
+        except (KeyError, TypeError, ValueError) as exception:
+            self._send(400, {'error': str(exception)})
+            return
+        self._send(200, {'contrasts': contrasts.tolist()})
+
+    def _send(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if getattr(self.server, 'verbose', False):
+            super().log_message(format, *args)
+
+
+def _fold_scaler(decoder, standard_scaler):
+    """Fold input standardization into the affine maps of a decoder."""
+    coefs, intercepts = {}, {}
+    for study, coef in decoder.coefs.items():
+        sc = standard_scaler.sc_[study]
+        coefs[study] = np.ascontiguousarray(coef / sc.scale_[None, :],
+                                            dtype=coef.dtype)
+        intercepts[study] = (decoder.intercepts[study]
+                             - coefs[study].dot(sc.mean_)).astype(coef.dtype)
+    return CompiledDecoder(coefs, intercepts)
+
+
+def serve(output_dirs, host='127.0.0.1', port=8000, unix_socket=None,
+          max_latency=0.005, max_batch_size=64, verbose=False):
+    models = {basename(normpath(output_dir)): DecodingModel.from_dir(
+        output_dir) for output_dir in output_dirs}
+    decoding_server = DecodingServer(models, max_latency=max_latency,
+                                     max_batch_size=max_batch_size)
+    http_server = decoding_server.make_http_server(host, port, unix_socket)
+    http_server.verbose = verbose
+    print('Serving %s on %s' % (', '.join(models),
+                                unix_socket if unix_socket is not None
+                                else '%s:%i' % (host, port)))
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        decoding_server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('output_dirs', nargs='+',
+                        help='Directories of the models to serve')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', default=None,
+                        help='Listen on a Unix socket instead of host:port')
+    parser.add_argument('--max_latency', type=float, default=5,
+                        help='Maximum batching delay, in milliseconds')
+    parser.add_argument('--max_batch_size', type=int, default=64,
+                        help='Maximum number of maps per batch')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    serve(args.output_dirs, host=args.host, port=args.port,
+          unix_socket=args.unix_socket, max_latency=args.max_latency / 1000,
+          max_batch_size=args.max_batch_size, verbose=args.verbose)
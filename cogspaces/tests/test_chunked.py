@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cogspaces.datasets.chunked import ChunkedStudyWriter, \
+    PreallocatedStudy, chunked_studies, load_chunked_studies, plan_update, \
+    write_chunked_study
+from cogspaces.preprocessing import MultiStandardScaler
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float16])
+def test_chunked_store(tmpdir, dtype):
+    rng = np.random.RandomState(0)
+    X = rng.randn(23, 7)
+    y = pd.DataFrame(dict(study='a', subject=rng.randint(0, 3, 23),
+                          contrast=['c%i' % i
+                                    for i in rng.randint(0, 2, 23)]))
+    dirname = str(tmpdir.join('masked'))
+    write_chunked_study(dirname, 'a', [X[:4], X[4:20], X[20:]], y,
+                        chunk_size=5, dtype=dtype)
+    writer = ChunkedStudyWriter(dirname, 'b', chunk_size=5)
+    writer.append(X[:3])
+    assert chunked_studies(dirname) == ['a']
+    writer.close(y.iloc[:3])
+    assert chunked_studies(dirname) == ['a', 'b']
+
+    Xs, ys = load_chunked_studies(dirname)
+    pd.testing.assert_frame_equal(ys['a'], y, check_dtype=False)
+    X_a = Xs['a']
+    assert X_a.shape == (23, 7) and X_a.dtype == np.float32
+    assert len(X_a.chunks) == 5
+    atol = 1e-2 if dtype == np.float16 else 1e-6
+    assert np.allclose(np.asarray(X_a), X, atol=atol)
+    assert all(len(chunk) <= 3 for chunk in X_a.iter_chunks(3))
+
+    indices = rng.permutation(23)[:11]
+    view = X_a[indices]
+    assert view.shape == (11, 7)
+    assert np.allclose(np.asarray(view[2:]), X[indices[2:]], atol=atol)
+    assert np.allclose(view[1, 3:5], X[indices[1], 3:5], atol=atol)
+    assert np.allclose(np.concatenate(list(view.iter_chunks(4))),
+                       X[indices], atol=atol)
+
+    scaler = MultiStandardScaler().fit({'a': view})
+    ref = MultiStandardScaler().fit({'a': np.asarray(view)})
+    assert np.allclose(scaler.mean_['a'], ref.mean_['a'])
+    assert np.allclose(scaler.scale_['a'], ref.scale_['a'])
+    scaled = scaler.transform({'a': view})['a']
+    assert np.allclose(np.asarray(scaled),
+                       ref.transform({'a': np.asarray(view)})['a'],
+                       atol=1e-5)
+
+
+def test_preallocated_study(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.randn(12, 4)
+    y = pd.DataFrame(dict(study='a', contrast=['c%i' % (i % 2)
+                                               for i in range(12)]))
+    dirname = str(tmpdir.join('masked'))
+    store = PreallocatedStudy(dirname, 'a', 12, 4, chunk_size=5)
+    assert store.pending() == [0, 1, 2]
+    store.write(1, X[5:7])
+    store.write(1, X[7:10], offset=2)
+    store.mark_done(1)
+    with pytest.raises(ValueError):
+        store.close(y)
+
+    # Resume after an interruption
+    store = PreallocatedStudy(dirname, 'a', 12, 4, chunk_size=5)
+    assert store.pending() == [0, 2]
+    for i in store.pending():
+        store.write(i, X[store.rows(i)])
+        store.mark_done(i)
+    store.close(y)
+    assert chunked_studies(dirname) == ['a']
+    store = PreallocatedStudy(dirname, 'a', 12, 4, chunk_size=5)
+    assert store.complete and store.pending() == []
+
+    Xs, ys = load_chunked_studies(dirname)
+    assert np.allclose(np.asarray(Xs['a']), X)
+    pd.testing.assert_frame_equal(ys['a'], y)
+
+    # Filling is not resumed for other maps, even in the same number
+    maps = [['map_%i' % i, 'hash_%i' % i] for i in range(12)]
+    store = PreallocatedStudy(dirname, 'b', 12, 4, chunk_size=5, maps=maps)
+    store.write(0, X[:5])
+    store.mark_done(0)
+    maps[3] = ['map_3', 'hash_3b']
+    store = PreallocatedStudy(dirname, 'b', 12, 4, chunk_size=5, maps=maps)
+    assert store.pending() == [0, 1, 2]
+    for i in store.pending():
+        store.write(i, X[store.rows(i)])
+        store.mark_done(i)
+    store.close(y)
+    assert PreallocatedStudy(dirname, 'b', 12, 4, chunk_size=5,
+                             maps=maps).pending() == []
+    maps[5] = ['map_5', 'hash_5b']
+    assert PreallocatedStudy(dirname, 'b', 12, 4, chunk_size=5,
+                             maps=maps).pending() == [0, 1, 2]
+
+
+def test_incremental_update(tmpdir):
+    rng = np.random.RandomState(0)
+    X = rng.randn(8, 4)
+    y = pd.DataFrame(dict(study='a', contrast=['c%i' % i for i in range(8)]))
+    maps = [['map_%i' % i, 'hash_%i' % i] for i in range(6)]
+    params = dict(smoothing_fwhm=4)
+    dirname = str(tmpdir.join('masked'))
+
+    def update(maps, X, y):
+        new, drop, append = plan_update(dirname, 'a', maps, params)
+        store = PreallocatedStudy(dirname, 'a', len(new), 4, chunk_size=4,
+                                  params=params, append=append)
+        for i in store.pending():
+            store.write(i, X[new][store.rows(i)])
+            store.mark_done(i)
+        store.close(y.iloc[new], maps=[maps[i] for i in new], drop=drop)
+        return new, drop, append
+
+    assert update(maps, X[:6], y.iloc[:6]) == (list(range(6)), [], False)
+    assert plan_update(dirname, 'a', maps, params) == ([], [], True)
+    assert plan_update(dirname, 'a', maps, dict(smoothing_fwhm=6))[0] \
+        == list(range(6))
+
+    # Two new maps, and a changed one
+    X[2] = rng.randn(4)
+    maps = maps + [['map_6', 'hash_6'], ['map_7', 'hash_7']]
+    maps[2] = ['map_2', 'hash_2b']
+    assert update(maps, X, y) == ([2, 6, 7], [2], True)
+    assert plan_update(dirname, 'a', maps, params) == ([], [], True)
+
+    Xs, ys = load_chunked_studies(dirname)
+    order = [0, 1, 3, 4, 5, 2, 6, 7]
+    assert np.allclose(np.asarray(Xs['a']), X[order])
+    assert ys['a']['contrast'].tolist() == y['contrast'][order].tolist()
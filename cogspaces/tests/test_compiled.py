@@ -0,0 +1,39 @@
+import numpy as np
+
+from cogspaces.classification.compiled import CompiledDecoder
+
+
+def make_decoder():
+    rng = np.random.RandomState(0)
+    coefs = {'a': rng.randn(3, 7), 'b': rng.randn(5, 7)}
+    intercepts = {'a': rng.randn(3), 'b': rng.randn(5)}
+    return CompiledDecoder(coefs, intercepts)
+
+
+def test_predict_iter(tmpdir):
+    decoder = make_decoder()
+    rng = np.random.RandomState(1)
+    X = {'a': rng.randn(23, 7), 'b': rng.randn(11, 7)}
+    labels = {study: pred['contrast'].values
+              for study, pred in decoder.predict(X).items()}
+
+    filename = str(tmpdir.join('a.npy'))
+    np.save(filename, X['a'])
+    chunks = {'a': np.load(filename, mmap_mode='r'),
+              'b': (X['b'][i:i + 4] for i in range(0, 11, 4))}
+    chunked_labels = {study: [] for study in X}
+    for study, these_labels in decoder.predict_iter(chunks, chunk_size=5):
+        assert len(these_labels) <= 5
+        chunked_labels[study].append(these_labels)
+    for study in X:
+        assert np.all(np.concatenate(chunked_labels[study]) == labels[study])
+
+
+def test_save_load(tmpdir):
+    decoder = make_decoder()
+    filename = str(tmpdir.join('decoder.npz'))
+    decoder.save(filename)
+    loaded = CompiledDecoder.load(filename)
+    X = {'a': np.ones((2, 7)), 'b': np.ones((2, 7))}
+    for study, pred in decoder.predict_log_proba(X).items():
+        assert np.allclose(loaded.predict_log_proba(X)[study], pred)
@@ -1,7 +1,13 @@
 import os
 
+import numpy as np
+import pandas as pd
+from joblib import dump
+
 from cogspaces.datasets import fetch_atlas_modl, fetch_mask, \
-    fetch_reduced_loadings, STUDY_LIST, fetch_contrasts
+    fetch_reduced_loadings, STUDY_LIST, fetch_contrasts, \
+    load_reduced_loadings
+from cogspaces.datasets.store import store_exists
 
 
 def test_atlas_modl():
@@ -31,3 +37,33 @@ def test_reduced_loadings():
 def test_statistics():
     df =  fetch_contrasts('brainpedia')
     print(df)
+
+
+def test_load_reduced_loadings_lazy(tmpdir):
+    rng = np.random.RandomState(0)
+    dirname = tmpdir.mkdir('loadings')
+
+    def write(study, n_samples):
+        X = rng.randn(n_samples, 3)
+        y = pd.DataFrame(dict(study=study, subject=0,
+                              contrast=['c%i' % i for i in range(n_samples)]))
+        dump((X, y), str(dirname.join('data_%s.pt' % study)))
+
+    for study in STUDY_LIST:
+        write(study, 2)
+    Xs, ys = load_reduced_loadings(str(tmpdir))
+    lazy_Xs, lazy_ys = load_reduced_loadings(str(tmpdir), lazy=True)
+    assert store_exists(str(dirname.join('consolidated')))
+    for study in STUDY_LIST:
+        assert np.allclose(lazy_Xs[study], Xs[study])
+        pd.testing.assert_frame_equal(lazy_ys[study], ys[study],
+                                      check_dtype=False)
+
+    # The store is rebuilt when a study is regenerated
+    write('hcp', 4)
+    os.utime(str(dirname.join('data_hcp.pt')), (0, 0))
+    Xs, _ = load_reduced_loadings(str(tmpdir))
+    lazy_Xs, lazy_ys = load_reduced_loadings(str(tmpdir), lazy=True)
+    assert lazy_Xs['hcp'].shape == (4, 3)
+    assert np.allclose(lazy_Xs['hcp'], Xs['hcp'])
+    assert len(lazy_ys['hcp']) == 4
@@ -0,0 +1,193 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from joblib import dump, load
+
+pytest.importorskip('modl')
+
+from cogspaces.classification.ensemble import EnsembleClassifier, \
+    _OnlineComponents, _RunAccumulator, _SharedData, _compute_coefs, \
+    _compute_coefs_batched  # noqa: E402
+from cogspaces.classification.multi_study import \
+    MultiStudyClassifier  # noqa: E402
+from cogspaces.classification.run_cache import RunCache  # noqa: E402
+
+
+def test_shared_data(tmpdir):
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(5, 3), 'b': rng.randn(4, 3)}
+    y = {study: pd.DataFrame(dict(contrast=np.arange(len(this_X)),
+                                  subject=0))
+         for study, this_X in X.items()}
+    data = _SharedData(X, y, str(tmpdir))
+    loaded_X, loaded_y = data.load()
+    for study in X:
+        assert loaded_X[study].dtype == np.float32
+        assert np.allclose(loaded_X[study], X[study])
+        assert list(loaded_y[study].columns) == ['contrast']
+        assert np.all(loaded_y[study]['contrast'] == y[study]['contrast'])
+    assert _SharedData(X, y, str(tmpdir)).fingerprint == data.fingerprint
+
+
+def test_compute_coefs_batched(tmpdir):
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(20, 6), 'b': rng.randn(30, 6)}
+    y = {'a': pd.DataFrame(dict(contrast=rng.randint(0, 3, 20))),
+         'b': pd.DataFrame(dict(contrast=rng.randint(0, 2, 30)))}
+    estimator = MultiStudyClassifier(
+        latent_size=4, init='orthogonal', batch_size=8, verbose=0,
+        latent_dropout=0.5, input_dropout=0.25,
+        max_iter={'pretrain': 2, 'train': 3, 'finetune': 2})
+    data = _SharedData(X, y, str(tmpdir))
+    res = _compute_coefs_batched(estimator, data, data.fingerprint, [0, 1])
+    weight, full_coef, full_bias = _compute_coefs(estimator, data,
+                                                  data.fingerprint, 0)
+    assert len(res) == 2
+    for this_weight, this_full_coef, this_full_bias in res:
+        assert this_weight.shape == weight.shape
+        for study in X:
+            assert this_full_coef[study].shape == full_coef[study].shape
+            assert this_full_bias[study].shape == full_bias[study].shape
+            assert np.all(np.isfinite(this_full_coef[study].numpy()))
+
+    # A run only depends on its seed, not on the runs it is batched with
+    other_res = _compute_coefs_batched(estimator, data, data.fingerprint,
+                                       [2, 1, 3])
+    for run, other_run in zip(res[1], other_res[1]):
+        if isinstance(run, dict):
+            run, other_run = run['a'], other_run['a']
+        assert torch.allclose(run, other_run, atol=1e-5)
+
+
+def test_run_accumulator(tmpdir):
+    rng = np.random.RandomState(0)
+    runs = [(torch.from_numpy(rng.randn(4, 6).astype(np.float32)),
+             {'a': torch.from_numpy(rng.randn(6, 3).astype(np.float32))},
+             {'a': torch.from_numpy(rng.randn(1, 3).astype(np.float32))})
+            for _ in range(3)]
+    accumulator = _RunAccumulator(str(tmpdir.join('weights.dat')),
+                                  spectrum=True)
+    for index in [2, 0, 1]:
+        accumulator.add(index, *runs[index])
+    assert np.allclose(accumulator.mean_spectrum, np.mean(
+        [np.linalg.svd(run[0].numpy(), compute_uv=False) for run in runs],
+        axis=0))
+    assert _RunAccumulator(str(tmpdir.join('other.dat'))).mean_spectrum \
+        is None
+    embedder_weights = accumulator.embedder_weights()
+    assert embedder_weights.shape == (12, 6)
+    assert np.allclose(embedder_weights,
+                       np.concatenate([run[0].numpy() for run in runs]))
+    assert np.allclose(accumulator.mean_coefs['a'],
+                       np.mean([run[1]['a'].numpy() for run in runs], axis=0))
+    assert accumulator.mean_biases['a'].shape == (3,)
+    assert np.allclose(accumulator.mean_biases['a'],
+                       np.mean([run[2]['a'].numpy()[0] for run in runs],
+                               axis=0))
+
+
+def test_ensemble_tol():
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(20, 6), 'b': rng.randn(30, 6)}
+    y = {'a': pd.DataFrame(dict(contrast=rng.randint(0, 3, 20))),
+         'b': pd.DataFrame(dict(contrast=rng.randint(0, 2, 30)))}
+    estimator = MultiStudyClassifier(
+        latent_size=4, init='orthogonal', batch_size=8, verbose=0, seed=0,
+        max_iter={'pretrain': 2, 'train': 3, 'finetune': 2})
+    ensemble = EnsembleClassifier(estimator, n_runs=6, seed=0, tol=1e3,
+                                  wave_size=2).fit(X, y)
+    assert ensemble.n_runs_ == 4
+    assert [wave['n_runs'] for wave in ensemble.convergence_] == [2, 4]
+    assert ensemble.convergence_[1]['coef_change'] < 1e3
+
+
+def test_ensemble_run_cache(tmpdir):
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(20, 6), 'b': rng.randn(30, 6)}
+    y = {'a': pd.DataFrame(dict(contrast=rng.randint(0, 3, 20))),
+         'b': pd.DataFrame(dict(contrast=rng.randint(0, 2, 30)))}
+    estimator = MultiStudyClassifier(
+        latent_size=4, init='orthogonal', batch_size=8, verbose=0, seed=0,
+        max_iter={'pretrain': 2, 'train': 3, 'finetune': 2})
+    run_cache = RunCache(str(tmpdir))
+    for n_runs in [2, 4]:
+        cached = EnsembleClassifier(estimator, n_runs=n_runs, seed=0,
+                                    engine='batched',
+                                    run_cache=run_cache).fit(X, y)
+    # Two runs are reused from a batch of two, and two computed together
+    assert len(os.listdir(str(tmpdir))) == 4
+    ensemble = EnsembleClassifier(estimator, n_runs=4, seed=0,
+                                  engine='batched').fit(X, y)
+    for study, classifier in ensemble.estimator_.module_.classifiers.items():
+        assert torch.allclose(
+            cached.estimator_.module_.classifiers[study].linear.weight,
+            classifier.linear.weight, atol=1e-4)
+
+
+def test_ensemble_checkpoint(tmpdir):
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(20, 6), 'b': rng.randn(30, 6)}
+    y = {'a': pd.DataFrame(dict(contrast=rng.randint(0, 3, 20))),
+         'b': pd.DataFrame(dict(contrast=rng.randint(0, 2, 30)))}
+    estimator = MultiStudyClassifier(
+        latent_size=4, init='orthogonal', batch_size=8, verbose=0, seed=0,
+        max_iter={'pretrain': 2, 'train': 3, 'finetune': 2})
+    checkpoint = str(tmpdir.join('checkpoint.pkl'))
+    ensemble = EnsembleClassifier(estimator, n_runs=2, seed=0, wave_size=1,
+                                  tol=0, consolidation='online',
+                                  checkpoint=checkpoint)
+    data = _SharedData(X, y, str(tmpdir))
+    embedder_init = np.abs(rng.randn(4, 6))
+    consolidator = ensemble._load_checkpoint(data, embedder_init)
+    consolidator.partial_fit(0, embedder_init)
+    dump(consolidator, checkpoint)
+    assert ensemble._load_checkpoint(data, embedder_init).seen_ == {0}
+    ensemble.set_params(alpha=1e-1)
+    with pytest.warns(UserWarning):
+        assert ensemble._load_checkpoint(data, embedder_init).seen_ == set()
+
+    ensemble.fit(X, y)
+    assert not os.path.exists(checkpoint)
+
+
+def test_online_components(tmpdir):
+    rng = np.random.RandomState(0)
+    embedder_weights = np.abs(rng.randn(5 * 4, 6))
+    consolidator = _OnlineComponents(np.abs(rng.randn(4, 6)), 1e-4,
+                                     n_warmup_runs=2)
+    for index in range(3):
+        consolidator.partial_fit(index, embedder_weights[4 * index:
+                                                         4 * (index + 1)])
+    filename = str(tmpdir.join('checkpoint.pkl'))
+    dump(consolidator, filename)
+    consolidator = load(filename)
+    for index in range(5):
+        consolidator.partial_fit(index, embedder_weights[4 * index:
+                                                         4 * (index + 1)])
+    assert consolidator.seen_ == set(range(5))
+    components = consolidator.finalize(embedder_weights)
+    assert components.shape == (4, 6)
+    assert np.all(components >= 0)
+
+
+@pytest.mark.parametrize('consolidation', ['batch', 'online'])
+def test_ensemble_predict(consolidation):
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(20, 6), 'b': rng.randn(30, 6)}
+    y = {'a': pd.DataFrame(dict(contrast=rng.randint(0, 3, 20))),
+         'b': pd.DataFrame(dict(contrast=rng.randint(0, 2, 30)))}
+    estimator = MultiStudyClassifier(
+        latent_size=4, init='orthogonal', batch_size=8, verbose=0, seed=0,
+        max_iter={'pretrain': 2, 'train': 3, 'finetune': 2})
+    ensemble = EnsembleClassifier(estimator, n_runs=3, seed=0, wave_size=2,
+                                  consolidation=consolidation).fit(X, y)
+    module = ensemble.estimator_.module_
+    assert module.embedder.weight.dtype == torch.float32
+    for classifier in module.classifiers.values():
+        assert classifier.linear.weight.dtype == torch.float32
+    preds = ensemble.predict(X)
+    for study, this_y in y.items():
+        assert len(preds[study]) == len(this_y)
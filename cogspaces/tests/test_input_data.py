@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import TensorDataset
+
+from cogspaces.input_data import MultiStudyLoader, RandomChoiceIter, \
+    StratifiedChoiceIter
+
+
+def make_data():
+    data = {}
+    for study, n_samples in [('a', 10), ('b', 25)]:
+        X = torch.arange(n_samples * 3, dtype=torch.float).view(n_samples, 3)
+        y = torch.arange(n_samples)
+        data[study] = TensorDataset(X, y)
+    return data
+
+
+@pytest.mark.parametrize('engine', ['torch', 'indexed'])
+@pytest.mark.parametrize('sampling', ['random', 'stratified-block', 'cycle',
+                                      'all'])
+def test_loader_shapes(engine, sampling):
+    data = make_data()
+    loader = MultiStudyLoader(data, batch_size=4, sampling=sampling,
+                              study_weights={'a': .5, 'b': .5}, seed=0,
+                              engine=engine)
+    loader_iter = iter(loader)
+    for _ in range(10):
+        inputs, targets = next(loader_iter)
+        assert set(inputs.keys()) == set(targets.keys())
+        for study in inputs:
+            assert inputs[study].shape[1] == 3
+            assert len(inputs[study]) == len(targets[study])
+            # Rows and targets must stay aligned
+            assert torch.all(inputs[study][:, 0] == 3 * targets[study])
+
+
+def test_indexed_loader_epoch():
+    data = make_data()
+    loader = MultiStudyLoader(data, batch_size=4, sampling='all', seed=0,
+                              engine='indexed')
+    loader_iter = iter(loader)
+    seen = []
+    # 25 samples in batch of 4 -> 7 batches per epoch
+    for _ in range(7):
+        inputs, targets = next(loader_iter)
+        seen.append(targets['b'].numpy())
+    seen = np.concatenate(seen)
+    assert len(seen) == 25
+    assert np.all(np.sort(seen) == np.arange(25))
+
+
+def test_indexed_loader_seed():
+    data = make_data()
+    batches = []
+    for _ in range(2):
+        loader = MultiStudyLoader(data, batch_size=4, sampling='random',
+                                  study_weights={'a': .3, 'b': .7}, seed=10,
+                                  engine='indexed')
+        loader_iter = iter(loader)
+        batches.append([next(loader_iter)[1] for _ in range(5)])
+    for targets_1, targets_2 in zip(*batches):
+        assert targets_1.keys() == targets_2.keys()
+        for study in targets_1:
+            assert torch.all(targets_1[study] == targets_2[study])
+
+
+def test_random_choice_iter():
+    choices = ['a', 'b', 'c']
+    p = np.array([.2, .5, .3])
+    random_state = np.random.RandomState(0)
+    choice_iter = RandomChoiceIter(choices, p, seed=0, block_size=7)
+    for _ in range(30):
+        assert next(choice_iter) == random_state.choice(choices, p=p)
+
+
+def test_stratified_choice_iter():
+    choices = ['a', 'b', 'c']
+    p = np.array([.2, .5, .3])
+    choice_iter = StratifiedChoiceIter(choices, p, seed=0, block_size=100)
+    block = [next(choice_iter) for _ in range(100)]
+    counts = np.array([block.count(choice) for choice in choices])
+    assert np.all(counts == 100 * p)
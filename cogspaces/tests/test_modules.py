@@ -0,0 +1,211 @@
+import pickle
+
+import pytest
+import torch
+from torch.nn import functional as F
+
+from cogspaces.input_data import PackedTensor
+from cogspaces.modules.batched import BatchedLatentClassifiers, \
+    BatchedMultiStudyModules
+from cogspaces.modules.factored import VarMultiStudyModule
+from cogspaces.modules.linear import DropoutLinear, k1, k2, k3
+from cogspaces.modules.loss import MultiStudyLoss
+
+
+def make_module():
+    target_sizes = {'a': 3, 'b': 5}
+    lengths = {'a': 10, 'b': 20}
+    return VarMultiStudyModule(in_features=7, latent_size=4,
+                               target_sizes=target_sizes, lengths=lengths,
+                               input_dropout=0.25, latent_dropout=0.5)
+
+
+def test_packed_forward():
+    torch.manual_seed(0)
+    module = make_module()
+    module.eval()
+    inputs = {'a': torch.randn(6, 7), 'b': torch.randn(4, 7)}
+    targets = {'a': torch.randint(0, 3, (6,)), 'b': torch.randint(0, 5, (4,))}
+    offsets = torch.tensor([0, 6, 10])
+    packed_inputs = PackedTensor(torch.cat([inputs['a'], inputs['b']]),
+                                 ['a', 'b'], offsets)
+    packed_targets = PackedTensor(torch.cat([targets['a'], targets['b']]),
+                                  ['a', 'b'], offsets)
+    loss_function = MultiStudyLoss({'a': 1., 'b': .5})
+    with torch.no_grad():
+        preds = module(inputs)
+        packed_preds = module(packed_inputs)
+        loss = loss_function(preds, targets)
+        packed_loss = loss_function(packed_preds, packed_targets)
+    split = packed_preds.split()
+    for study, pred in preds.items():
+        assert torch.allclose(split[study][:, :pred.shape[1]], pred)
+    assert torch.allclose(loss, packed_loss)
+    assert torch.allclose(module.penalty(packed_inputs),
+                          module.penalty(inputs))
+
+
+def test_batched_latent_classifiers():
+    torch.manual_seed(0)
+    module = make_module()
+    classifiers = [module.classifiers['a'], module.classifiers['b']]
+    for classifier in classifiers:
+        classifier.batch_norm.running_mean.normal_()
+        classifier.eval()
+    heads = BatchedLatentClassifiers(classifiers)
+    heads.eval()
+    input = torch.randn(2, 6, 4)
+    row_mask = torch.ones(2, 6, dtype=torch.bool)
+    with torch.no_grad():
+        preds = heads(input, row_mask)
+        for i, classifier in enumerate(classifiers):
+            pred = classifier(input[i])
+            assert torch.allclose(preds[i, :, :pred.shape[1]], pred,
+                                  atol=1e-6)
+
+
+def test_batched_multi_study_modules():
+    torch.manual_seed(0)
+    modules = [make_module() for _ in range(3)]
+    for module in modules:
+        for classifier in module.classifiers.values():
+            classifier.batch_norm.running_mean.normal_()
+            classifier.linear.make_adaptive()
+    runs = BatchedMultiStudyModules(modules)
+    runs.eval()
+    input = torch.randn(3, 6, 7)
+    studies = torch.tensor([0, 1, 1])
+    row_mask = torch.ones(3, 6, dtype=torch.bool)
+    with torch.no_grad():
+        preds = runs(input, studies, row_mask)
+        penalties = runs.penalty(studies)
+    for i, (module, study) in enumerate(zip(modules, ['a', 'b', 'b'])):
+        module.eval()
+        with torch.no_grad():
+            pred = module({study: input[i]})[study]
+        assert torch.allclose(preds[i, :, :pred.shape[1]], pred, atol=1e-5)
+        assert torch.allclose(penalties[i], module.penalty([study]))
+
+    runs.train()
+    state = runs.get_run_state()
+    runs(input, studies, row_mask,
+         active=torch.tensor([True, False, True]))
+    assert not torch.equal(runs.running_mean[2 * 2 + 1],
+                           state['running_mean'][2 * 2 + 1])
+    assert torch.equal(runs.running_mean[1 * 2 + 1],
+                       state['running_mean'][1 * 2 + 1])
+    runs.set_run_state(state, runs=torch.tensor([True, False, True]))
+    assert torch.equal(runs.running_mean, state['running_mean'])
+    runs.head_weight.data.add_(1.)
+    runs.to_modules(modules)
+    assert torch.allclose(modules[2].classifiers['b'].linear.weight,
+                          runs.head_weight[2 * 2 + 1])
+
+
+@pytest.mark.parametrize('level', ['layer', 'atom', 'coef', 'additive'])
+def test_dropout_linear_fused(level):
+    torch.manual_seed(0)
+    linear = DropoutLinear(7, 5, p=.3, level=level, adaptive=True,
+                           var_penalty=.1).double()
+    if level != 'additive':
+        linear.log_alpha.data.normal_()
+    linear.train()
+    input = torch.randn(11, 7, dtype=torch.double, requires_grad=True)
+    params = list(linear.parameters()) + [input]
+    results = []
+    for forward in [linear.forward, linear._forward_reference]:
+        torch.manual_seed(1)
+        for param in params:
+            param.grad = None
+        output = forward(input)
+        torch.sum(output ** 3).backward()
+        results.append([output.detach()] + [param.grad for param in params])
+    for fused, reference in zip(*results):
+        if reference is None:
+            assert fused is None
+        else:
+            assert torch.allclose(fused, reference)
+
+    log_alpha = linear.get_log_alpha()
+    penalty = - k1 * (torch.sigmoid(k2 + k3 * log_alpha)
+                      - .5 * F.softplus(-log_alpha)
+                      - 1).expand(*linear.weight.shape).sum()
+    assert torch.allclose(linear.penalty(), penalty * linear.var_penalty)
+
+
+@pytest.mark.parametrize('threshold', [0., 1.])
+def test_dropout_linear_compile_sparse(threshold):
+    torch.manual_seed(0)
+    linear = DropoutLinear(20, 5, p=.3, level='coef', sparsify=True)
+    linear.log_alpha.data.normal_(0, 4)
+    # Prune two input atoms entirely
+    linear.log_alpha.data[:, :2] = 8
+    linear.eval()
+    input = torch.randn(11, 20)
+    with torch.no_grad():
+        output = linear(input)
+        density = linear.compile_sparse(threshold)
+        assert linear._compiled_columns is not None
+        assert 0 < density < 1
+        assert torch.allclose(linear(input), output, atol=1e-5)
+    with linear.keep_compiled():
+        linear.train()
+    assert linear._compiled_weight is not None
+    linear.train()
+    assert linear._compiled_weight is None
+
+    linear.eval()
+    linear.compile_sparse(threshold)
+    linear.load_state_dict(linear.state_dict())
+    assert linear._compiled_weight is None
+
+
+def test_dropout_linear_legacy_pickle():
+    torch.manual_seed(0)
+    linear = DropoutLinear(20, 5, p=.3, level='coef', sparsify=True)
+    # Modules pickled before `compile_sparse` lack the compiled attributes
+    del linear._compiled_weight, linear._compiled_columns
+    linear = pickle.loads(pickle.dumps(linear))
+    linear.eval()
+    input = torch.randn(11, 20)
+    with torch.no_grad():
+        output = linear(input)
+        linear.compile_sparse()
+        assert torch.allclose(linear(input), output, atol=1e-5)
+
+
+def test_select():
+    torch.manual_seed(0)
+    module = make_module()
+    for classifier in module.classifiers.values():
+        classifier.batch_norm.running_mean.normal_()
+        classifier.linear.weight.data[:, 1] = 0
+    module.embedder.weight.data[:, [0, 5]] = 0
+    module.eval()
+    inputs = {'a': torch.randn(6, 7), 'b': torch.randn(4, 7)}
+    atom_indices = torch.tensor([1, 2, 3, 4, 6])
+    with torch.no_grad():
+        preds = module(inputs)
+        module.select(latent_indices=torch.tensor([0, 2, 3]),
+                      atom_indices=atom_indices)
+        assert module.embedder.weight.shape == (3, 5)
+        pruned_preds = module({study: input[:, atom_indices]
+                               for study, input in inputs.items()})
+    for study, pred in preds.items():
+        assert torch.allclose(pruned_preds[study], pred, atol=1e-6)
+
+
+def test_compute_affine():
+    torch.manual_seed(0)
+    module = make_module()
+    for classifier in module.classifiers.values():
+        classifier.batch_norm.running_mean.normal_()
+    inputs = {'a': torch.randn(6, 7), 'b': torch.randn(4, 7)}
+    affine = module.compute_affine()
+    assert module.training
+    module.eval()
+    with torch.no_grad():
+        preds = module(inputs, logits=True)
+    for study, (coef, bias) in affine.items():
+        assert torch.allclose(inputs[study].matmul(coef.t()) + bias,
+                              preds[study], atol=1e-5)
@@ -0,0 +1,113 @@
+import io
+import pickle
+
+import numpy as np
+import pandas as pd
+import torch
+
+from cogspaces.classification.multi_study import MultiStudyClassifier
+from cogspaces.modules.linear import DropoutLinear
+
+
+def make_data():
+    rng = np.random.RandomState(0)
+    X = {'a': rng.randn(40, 10), 'b': rng.randn(30, 10)}
+    y = {study: pd.DataFrame(dict(contrast=rng.randint(0, n_targets,
+                                                       len(X[study])),
+                                  subject=0, study=study))
+         for study, n_targets in [('a', 3), ('b', 2)]}
+    return X, y
+
+
+def make_estimator():
+    X, y = make_data()
+    estimator = MultiStudyClassifier(
+        latent_size=4, init='orthogonal', batch_size=8, seed=0,
+        max_iter={'pretrain': 2, 'train': 3, 'finetune': 2})
+    return estimator.fit(X, y), X
+
+
+def assert_same_preds(preds, other_preds, atol=1e-5):
+    assert set(preds) == set(other_preds)
+    for study, pred in preds.items():
+        assert np.allclose(other_preds[study], pred, atol=atol)
+
+
+def test_compile():
+    estimator, X = make_estimator()
+    decoder = estimator.compile()
+    assert_same_preds(estimator.predict_log_proba(X),
+                      decoder.predict_log_proba(X))
+
+    estimator.module_.train()
+    estimator.module_.compile_sparse(threshold=1.)
+    decoder = estimator.compile()
+    # The weights compiled by `compile_sparse` are kept
+    assert estimator.module_.embedder._compiled_weight is not None
+    assert_same_preds(estimator.predict_log_proba(X),
+                      decoder.predict_log_proba(X))
+
+
+def test_prune(tmpdir):
+    estimator, X = make_estimator()
+    preds = estimator.predict_log_proba(X)
+    estimator.prune(threshold=0)
+    assert estimator.module_.embedder.weight.shape == (4, 10)
+    assert_same_preds(preds, estimator.predict_log_proba(X))
+
+    # Atoms without weights, and a latent unit ignored by the heads
+    estimator.module_.embedder.weight.data[:, [2, 7]] = 0
+    for classifier in estimator.module_.classifiers.values():
+        classifier.linear.weight.data[:, 1] = 0
+    preds = estimator.predict_log_proba(X)
+    estimator.prune(threshold=1e-2)
+    assert estimator.module_.embedder.weight.shape == (3, 8)
+    assert all(classifier.linear.weight.shape[1] == 3
+               for classifier in estimator.module_.classifiers.values())
+    assert estimator.input_support_.tolist() == [0, 1, 3, 4, 5, 6, 8, 9]
+    assert estimator.prune_report_['in_features'] == (10, 8)
+    assert_same_preds(preds, estimator.predict_log_proba(X))
+    assert_same_preds(preds, estimator.compile().predict_log_proba(X))
+
+    filename = str(tmpdir.join('estimator.cogspaces'))
+    estimator.save(filename)
+    loaded = MultiStudyClassifier.load(filename)
+    assert np.array_equal(loaded.input_support_, estimator.input_support_)
+    assert_same_preds(preds, loaded.predict_log_proba(X))
+
+
+def test_save_load(tmpdir):
+    estimator, X = make_estimator()
+    preds = estimator.predict_log_proba(X)
+
+    filename = str(tmpdir.join('estimator.cogspaces'))
+    estimator.save(filename)
+    loaded = MultiStudyClassifier.load(filename)
+    assert loaded.get_params() == estimator.get_params()
+    assert_same_preds(preds, loaded.predict_log_proba(X), atol=0)
+    loaded = MultiStudyClassifier.load(filename, studies=['b'])
+    assert list(loaded.module_.classifiers.keys()) == ['b']
+    assert_same_preds({'b': preds['b']},
+                      loaded.predict_log_proba({'b': X['b']}), atol=0)
+
+    loaded = pickle.loads(pickle.dumps(estimator))
+    assert_same_preds(preds, loaded.predict_log_proba(X), atol=0)
+
+
+def test_setstate_legacy():
+    estimator, X = make_estimator()
+    preds = estimator.predict_log_proba(X)
+    # Former versions pickled the module as a torch archive, before
+    # `DropoutLinear.compile_sparse` existed
+    state = estimator.__dict__.copy()
+    module = state['module_']
+    for linear in module.modules():
+        if isinstance(linear, DropoutLinear):
+            del linear._compiled_weight, linear._compiled_columns
+    f = io.BytesIO()
+    torch.save(module, f)
+    state['module_'] = f.getvalue()
+    loaded = MultiStudyClassifier.__new__(MultiStudyClassifier)
+    loaded.__setstate__(state)
+    assert_same_preds(preds, loaded.predict_log_proba(X), atol=0)
+    assert_same_preds(preds, loaded.compile().predict_log_proba(X))
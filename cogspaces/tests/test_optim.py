@@ -0,0 +1,103 @@
+import torch
+from torch.optim import Adam
+
+from cogspaces.optim import LazyAdam, MaskedAdam, minimize_lbfgs, \
+    minimize_newton
+
+
+def test_masked_adam():
+    torch.manual_seed(0)
+    target = torch.randn(3, 4)
+    init = torch.randn(3, 4)
+    param = init.clone().requires_grad_()
+    ref_params = [init[i].clone().requires_grad_() for i in range(3)]
+    optimizer = MaskedAdam([param], lr=1e-2, amsgrad=True)
+    ref_optimizers = [Adam([ref_param], lr=1e-2, amsgrad=True)
+                      for ref_param in ref_params]
+    for step in range(20):
+        # Slice 2 is frozen after 5 steps
+        mask = torch.tensor([True, True, step < 5])
+        frozen = param[2].detach().clone()
+        optimizer.zero_grad()
+        torch.sum((param - target) ** 2).backward()
+        optimizer.step(mask)
+        if step >= 5:
+            assert torch.equal(param[2], frozen)
+            assert optimizer.state[param]['step'][2] == 5
+        for i, (ref_param, ref_optimizer) in enumerate(
+                zip(ref_params, ref_optimizers)):
+            if mask[i]:
+                ref_optimizer.zero_grad()
+                torch.sum((ref_param - target[i]) ** 2).backward()
+                ref_optimizer.step()
+    for i, ref_param in enumerate(ref_params):
+        assert torch.allclose(param[i], ref_param, atol=1e-6)
+
+
+def test_full_batch_solvers():
+    torch.manual_seed(0)
+    X = torch.randn(50, 5)
+    y = torch.randint(0, 3, (50,))
+    losses = []
+    for solver in [minimize_lbfgs, minimize_newton]:
+        weight = torch.zeros(3, 5, requires_grad=True)
+
+        def objective():
+            return (torch.nn.functional.cross_entropy(X @ weight.t(), y)
+                    + torch.sum(weight ** 2))
+
+        losses.append(solver(objective, [weight], max_iter=50))
+    assert abs(losses[0] - losses[1]) < 1e-4
+
+
+def test_lazy_adam():
+    torch.manual_seed(0)
+    target = torch.randn(4)
+    param = torch.zeros(4, requires_grad=True)
+    skipped = torch.zeros(4, requires_grad=True)
+    ref_param = torch.zeros(4, requires_grad=True)
+    optimizer = LazyAdam([param, skipped], lr=1e-2, amsgrad=True)
+    ref_optimizer = Adam([ref_param], lr=1e-2, amsgrad=True)
+    for step in range(10):
+        optimizer.zero_grad()
+        ref_optimizer.zero_grad()
+        torch.sum((param - target) ** 2).backward()
+        torch.sum((ref_param - target) ** 2).backward()
+        optimizer.step()
+        ref_optimizer.step()
+    assert skipped.grad is None
+    assert torch.all(skipped == 0)
+    assert torch.allclose(param, ref_param)
+
+
+def test_lazy_adam_resume():
+    torch.manual_seed(0)
+    target = torch.randn(4)
+    param = torch.zeros(4, requires_grad=True)
+    ref_param = torch.zeros(4, requires_grad=True)
+    optimizer = LazyAdam([param], lr=1e-2, amsgrad=True)
+    ref_optimizer = Adam([ref_param], lr=1e-2, amsgrad=True)
+    # Dense Adam moves skipped parameters by their momentum
+    drift = torch.zeros(4)
+    for step in range(15):
+        # Skipped for 5 steps, then resumed
+        active = step < 3 or step >= 8
+        optimizer.zero_grad()
+        ref_optimizer.zero_grad()
+        if active:
+            # Linear loss: the gradient does not depend on the drift
+            torch.sum(param * target).backward()
+            torch.sum(ref_param * target).backward()
+        else:
+            ref_param.grad = torch.zeros(4)
+        before = ref_param.detach().clone()
+        optimizer.step()
+        ref_optimizer.step()
+        if not active:
+            drift += ref_param.detach() - before
+    assert optimizer.n_steps == 15
+    state, ref_state = optimizer.state[param], ref_optimizer.state[ref_param]
+    for name in ['exp_avg', 'exp_avg_sq', 'max_exp_avg_sq']:
+        assert torch.allclose(state[name], ref_state[name])
+    assert torch.any(drift != 0)
+    assert torch.allclose(param, ref_param - drift, atol=1e-6)
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+from cogspaces.datasets.chunked import load_chunked_study, \
+    write_chunked_study
+from cogspaces.projection import AtlasProjector
+
+
+@pytest.mark.parametrize('sparse', [True, False])
+def test_atlas_projector(tmpdir, sparse):
+    rng = np.random.RandomState(0)
+    components = sp.random(6, 50, density=0.3, random_state=0).toarray()
+    X = rng.randn(23, 50)
+    projector = AtlasProjector(components, sparse=sparse)
+    assert sp.issparse(projector.components_) == sparse
+
+    lstsq = np.linalg.lstsq(components.T, X.T, rcond=None)[0].T
+    assert np.allclose(projector.transform(X, block_size=5), lstsq,
+                       atol=1e-4)
+    assert np.allclose(projector.transform(X, method='dot'),
+                       X.dot(components.T), atol=1e-4)
+
+    filename = str(tmpdir.join('projector.npz'))
+    projector.save(filename)
+    projector = AtlasProjector.load(filename)
+    targets = pd.DataFrame(dict(study=['a'] * 23))
+    write_chunked_study(str(tmpdir), 'a', X, targets, chunk_size=7)
+    X_chunked, _ = load_chunked_study(str(tmpdir), 'a')
+    assert np.allclose(projector.transform(X_chunked, block_size=4), lstsq,
+                       atol=1e-4)
+
+
+def test_atlas_projector_dependent():
+    components = np.ones((2, 10))
+    projector = AtlasProjector(components)
+    assert np.allclose(projector.transform(np.ones((3, 10)), method='dot'),
+                       10)
+    with pytest.raises(ValueError):
+        projector.transform(np.ones((3, 10)))
@@ -0,0 +1,53 @@
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import torch
+from joblib import dump
+
+from cogspaces.classification.multi_study import MultiStudyClassifier
+from cogspaces.modules.factored import VarMultiStudyModule
+from cogspaces.preprocessing import MultiTargetEncoder
+from cogspaces.registry import ModelRegistry
+
+
+def make_output_dir(output_dir, seeds):
+    targets = {study: pd.DataFrame(dict(
+        contrast=['%s_%i' % (study, i) for i in range(n_targets)],
+        subject=0, study=study, study_contrast=0))
+        for study, n_targets in [('a', 3), ('b', 5)]}
+    target_encoder = MultiTargetEncoder().fit(targets)
+    for seed in seeds:
+        torch.manual_seed(seed)
+        estimator = MultiStudyClassifier()
+        estimator.module_ = VarMultiStudyModule(
+            in_features=7, latent_size=4, target_sizes={'a': 3, 'b': 5},
+            lengths={'a': 10, 'b': 20})
+        estimator.n_features_in_ = 7
+        model_dir = join(output_dir, 'multi_study', str(seed))
+        os.makedirs(model_dir)
+        estimator.save(join(model_dir, 'estimator.cogspaces'))
+        dump(target_encoder, join(model_dir, 'target_encoder.pkl'))
+
+
+def test_registry(tmpdir):
+    output_dir = str(tmpdir)
+    make_output_dir(output_dir, [1, 2, 3])
+    registry = ModelRegistry(output_dir)
+    assert registry.estimators == ['multi_study']
+    assert registry.seeds('multi_study') == [1, 2, 3]
+
+    X = {'a': np.random.RandomState(0).randn(4, 7)}
+    probas = registry.predict_proba(X)['a']
+    expected = np.mean([np.exp(registry.get('multi_study', seed).decoder
+                               .predict_log_proba(X)['a'])
+                        for seed in [1, 2, 3]], axis=0)
+    assert np.allclose(probas, expected, atol=1e-5)
+    contrasts = registry.get('multi_study', 1).contrasts('a')
+    assert np.all(registry.predict(X)['a']
+                  == contrasts[np.argmax(expected, axis=1)])
+
+    registry = ModelRegistry(output_dir, max_bytes=1)
+    registry.predict_proba(X)
+    assert len(registry._cache) == 1
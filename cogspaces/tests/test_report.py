@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('nilearn.input_data')
+
+from cogspaces.report import compute_classifs, curate_module  # noqa: E402
+from cogspaces.tests.test_multi_study import make_estimator  # noqa: E402
+
+
+def test_compute_classifs():
+    estimator, _ = make_estimator()
+    config = dict(model=dict(estimator='multi_study'),
+                  data=dict(reduced=False))
+    classifs = compute_classifs(estimator, None, config,
+                                return_type='arrays')
+
+    # Logits of the canonical basis, centered across features
+    module = curate_module(estimator)
+    module.eval()
+    in_features = module.embedder.in_features
+    with torch.no_grad():
+        logits = module({study: torch.eye(in_features)
+                         for study in classifs}, logits=True)
+        biases = module({study: torch.zeros((1, in_features))
+                         for study in classifs}, logits=True)
+    for study, classif in classifs.items():
+        expected = logits[study] - biases[study]
+        expected -= expected.mean(dim=0, keepdim=True)
+        assert np.allclose(classif, expected.numpy().T, atol=1e-5)
+
+
+def test_compute_classifs_pruned():
+    estimator, _ = make_estimator()
+    estimator.module_.embedder.weight.data[:, [2, 7]] = 0
+    config = dict(model=dict(estimator='multi_study'),
+                  data=dict(reduced=False))
+    classifs = compute_classifs(estimator, None, config,
+                                return_type='arrays')
+    estimator.prune(threshold=1e-2)
+    pruned_classifs = compute_classifs(estimator, None, config,
+                                       return_type='arrays')
+    for study, classif in classifs.items():
+        assert pruned_classifs[study].shape == classif.shape
+        assert np.allclose(pruned_classifs[study], classif, atol=1e-5)
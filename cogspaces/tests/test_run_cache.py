@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import torch
+
+from cogspaces.classification.multi_study import MultiStudyClassifier
+from cogspaces.classification.run_cache import RunCache
+
+
+def make_run(seed):
+    rng = np.random.RandomState(seed)
+    return (torch.from_numpy(rng.randn(4, 6).astype(np.float32)),
+            {'a': torch.from_numpy(rng.randn(6, 3).astype(np.float32)),
+             'b': torch.from_numpy(rng.randn(6, 2).astype(np.float32))},
+            {'a': torch.from_numpy(rng.randn(1, 3).astype(np.float32)),
+             'b': torch.from_numpy(rng.randn(1, 2).astype(np.float32))})
+
+
+def test_run_cache(tmpdir):
+    cache = RunCache(str(tmpdir))
+    estimator = MultiStudyClassifier(latent_size=4)
+    key = cache.key('data', estimator, 0)
+    assert key == cache.key('data', MultiStudyClassifier(latent_size=4,
+                                                         n_jobs=4), 0)
+    assert key != cache.key('data', estimator, 1)
+    assert key != cache.key('other_data', estimator, 0)
+    assert key != cache.key('data', MultiStudyClassifier(latent_size=8), 0)
+    assert cache.get(key) is None
+
+    run = make_run(0)
+    cache.put(key, run)
+    assert key in cache
+    weight, full_coef, full_bias = cache.get(key)
+    assert torch.equal(weight, run[0])
+    for study in ['a', 'b']:
+        assert torch.equal(full_coef[study], run[1][study])
+        assert torch.equal(full_bias[study], run[2][study])
+
+
+def test_run_cache_eviction(tmpdir):
+    cache = RunCache(str(tmpdir))
+    for seed in range(3):
+        cache.put(str(seed), make_run(seed))
+        os.utime(str(tmpdir.join('%i.npz' % seed)), (seed, seed))
+    cache.get('0')
+    size = os.path.getsize(str(tmpdir.join('0.npz')))
+    cache.max_bytes = 2 * size
+    cache.evict()
+    assert '0' in cache and '2' in cache and '1' not in cache
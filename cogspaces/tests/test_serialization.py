@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+from cogspaces.modules.factored import VarMultiStudyModule
+from cogspaces.serialization import load_arrays, module_from_arrays, \
+    module_to_arrays, save_arrays
+
+
+def test_save_load_arrays(tmpdir):
+    arrays = {'a': np.arange(7, dtype=np.float32),
+              'b': np.ones((3, 5), dtype=np.float64)[:, ::2],
+              'c': np.array(3, dtype=np.int64)}
+    filename = str(tmpdir.join('arrays.cogspaces'))
+    save_arrays(filename, arrays, meta={'key': [1, 2]})
+    for mmap_mode in ['c', None]:
+        loaded, meta = load_arrays(filename, mmap_mode=mmap_mode)
+        assert meta == {'key': [1, 2]}
+        for name, array in arrays.items():
+            assert loaded[name].dtype == array.dtype
+            assert np.array_equal(loaded[name], array)
+    loaded, _ = load_arrays(filename, names=['b'])
+    assert list(loaded.keys()) == ['b']
+
+
+def test_module_arrays(tmpdir):
+    torch.manual_seed(0)
+    module = VarMultiStudyModule(in_features=7, latent_size=4,
+                                 target_sizes={'a': 3, 'b': 5},
+                                 lengths={'a': 10, 'b': 20},
+                                 input_dropout=0.25, latent_dropout=0.5)
+    module.classifiers['b'].batch_norm.running_mean.normal_()
+    module.eval()
+    arrays, config = module_to_arrays(module)
+    filename = str(tmpdir.join('module.cogspaces'))
+    save_arrays(filename, arrays, meta=config)
+    arrays, config = load_arrays(filename)
+    loaded = module_from_arrays(arrays, config, studies=['b'])
+    loaded.eval()
+    assert list(loaded.classifiers.keys()) == ['b']
+    assert loaded.classifiers['b'].linear.var_penalty \
+        == module.classifiers['b'].linear.var_penalty
+    input = {'b': torch.randn(6, 7)}
+    with torch.no_grad():
+        assert torch.allclose(loaded(input)['b'], module(input)['b'])
@@ -0,0 +1,61 @@
+import http.client
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cogspaces.classification.compiled import CompiledDecoder
+from cogspaces.preprocessing import MultiTargetEncoder
+from cogspaces.serving import DecodingModel, DecodingServer
+
+
+def make_model():
+    rng = np.random.RandomState(0)
+    coefs = {'a': rng.randn(3, 7), 'b': rng.randn(2, 7)}
+    intercepts = {'a': rng.randn(3), 'b': rng.randn(2)}
+    targets = {study: pd.DataFrame(dict(
+        contrast=['%s_%i' % (study, i) for i in range(len(coef))],
+        subject=0, study=study, study_contrast=0))
+        for study, coef in coefs.items()}
+    target_encoder = MultiTargetEncoder().fit(targets)
+    return DecodingModel(CompiledDecoder(coefs, intercepts), target_encoder)
+
+
+def test_decoding_server():
+    model = make_model()
+    server = DecodingServer({'model': model}, max_latency=0.01,
+                            max_batch_size=8)
+    X = np.random.RandomState(1).randn(20, 7)
+    requests = [('a' if i % 3 else 'b', X[i:i + 1]) for i in range(20)]
+    with ThreadPoolExecutor(8) as executor:
+        preds = list(executor.map(lambda request: server.predict(*request),
+                                  requests))
+    for (study, this_X), pred in zip(requests, preds):
+        assert pred.tolist() == model.decode(study, this_X).tolist()
+
+    http_server = server.make_http_server(port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    connection = http.client.HTTPConnection('127.0.0.1',
+                                            http_server.server_address[1])
+    connection.request('POST', '/predict', json.dumps(
+        {'study': 'a', 'maps': X[:2].tolist()}))
+    response = connection.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read())['contrasts'] \
+        == model.decode('a', X[:2]).tolist()
+    # Wrong shape, and malformed requests
+    for request in [{'study': 'a', 'maps': X[:2, :3].tolist()},
+                    {'study': 'a', 'maps': {'map': 1}},
+                    {'study': 'a', 'maps': [{'map': 1}]},
+                    [X[0].tolist()]]:
+        connection.request('POST', '/predict', json.dumps(request))
+        response = connection.getresponse()
+        assert response.status == 400
+        assert 'error' in json.loads(response.read())
+    connection.close()
+    http_server.shutdown()
+    http_server.server_close()
+    server.close()
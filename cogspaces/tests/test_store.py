@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from cogspaces.datasets.store import load_multi_study, store_exists, \
+    write_multi_study
+
+
+def test_multi_study_store(tmpdir):
+    rng = np.random.RandomState(0)
+    Xs = {'a': rng.randn(5, 3), 'b': rng.randn(4, 3)}
+    ys = {study: pd.DataFrame(dict(
+        study=study, subject=rng.randint(0, 3, len(this_X)),
+        contrast=['c%i' % i for i in rng.randint(0, 2, len(this_X))]))
+        for study, this_X in Xs.items()}
+    ys['b'].loc[0, 'contrast'] = np.nan
+    dirname = str(tmpdir.join('store'))
+    assert not store_exists(dirname)
+    write_multi_study(Xs, ys, dirname)
+    assert store_exists(dirname)
+
+    loaded_Xs, loaded_ys = load_multi_study(dirname)
+    assert list(loaded_Xs) == ['a', 'b']
+    assert 'b' in loaded_ys and len(loaded_ys) == 2
+    for study in Xs:
+        assert loaded_Xs[study].dtype == np.float32
+        assert np.allclose(loaded_Xs[study], Xs[study])
+        pd.testing.assert_frame_equal(loaded_ys[study], ys[study],
+                                      check_dtype=False)
+    assert isinstance(loaded_ys['a']['contrast'][0], str)
+
+    sources = [['a.pt', 10, 1.5]]
+    assert not store_exists(dirname, sources)
+    write_multi_study(Xs, ys, dirname, sources=sources)
+    assert store_exists(dirname, sources)
+    assert not store_exists(dirname, [['a.pt', 10, 2.5]])
+    assert np.issubdtype(loaded_ys['a']['subject'].dtype, np.integer)
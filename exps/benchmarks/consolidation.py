@@ -0,0 +1,80 @@
+"""Benchmark the consolidation of the embedders of `EnsembleClassifier`:
+two-pass dictionary learning once all runs are done ('batch'), against
+dictionary learning fed run by run as runs finish ('online').
+
+Runs are simulated: each is a noisy, permuted copy of shared sparse
+non-negative atoms, and takes `run_time` seconds. Reports the wall time
+spent after the last run, the total wall time, and the relative error of
+the ridge reconstruction of the runs with the learned components."""
+
+import argparse
+import time
+
+import numpy as np
+
+from cogspaces.classification.ensemble import _OnlineComponents, \
+    _compute_components
+
+
+def make_runs(n_runs, latent_size=128, n_features=453, seed=0):
+    random_state = np.random.RandomState(seed)
+    atoms = random_state.randn(latent_size, n_features)
+    atoms[np.abs(atoms) < 1.5] = 0
+    atoms = np.abs(atoms)
+    runs = [atoms[random_state.permutation(latent_size)]
+            + .1 * random_state.randn(latent_size, n_features)
+            for _ in range(n_runs)]
+    init = random_state.randn(latent_size, n_features) / np.sqrt(n_features)
+    return np.concatenate(runs).astype(np.float32), init
+
+
+def reconstruction_error(X, components, alpha):
+    gram = components.dot(components.T)
+    gram.flat[::len(gram) + 1] += alpha
+    code = np.linalg.solve(gram, components.dot(X.T)).T
+    return (np.sum((X - code.dot(components)) ** 2)
+            / np.sum(X.astype(np.float64) ** 2))
+
+
+def run(n_runs=120, run_time=0.5, alpha=1e-5, online_epochs=2):
+    X, init = make_runs(n_runs)
+    latent_size = init.shape[0]
+    results = {}
+
+    t0 = time.perf_counter()
+    time.sleep(run_time * n_runs)
+    t1 = time.perf_counter()
+    components = _compute_components(X, init, alpha, True)
+    t2 = time.perf_counter()
+    results['batch'] = (t2 - t1, t2 - t0, components)
+
+    t0 = time.perf_counter()
+    consolidator = _OnlineComponents(init, alpha, n_epochs=online_epochs)
+    for i in range(n_runs):
+        time_run = time.perf_counter()
+        consolidator.partial_fit(i, X[i * latent_size:
+                                      (i + 1) * latent_size])
+        time.sleep(max(0., run_time - (time.perf_counter() - time_run)))
+    t1 = time.perf_counter()
+    components = consolidator.finalize(X)
+    t2 = time.perf_counter()
+    results['online'] = (t2 - t1, t2 - t0, components)
+
+    print('%-8s %12s %12s %12s' % ('mode', 'after runs', 'total', 'error'))
+    for mode, (after_runs, total, components) in results.items():
+        print('%-8s %11.2fs %11.2fs %12.4f'
+              % (mode, after_runs, total,
+                 reconstruction_error(X, components, alpha)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--n_runs', type=int, default=120,
+                        help='Number of runs')
+    parser.add_argument('-t', '--run_time', type=float, default=0.5,
+                        help='Simulated duration of a run, in seconds')
+    parser.add_argument('-e', '--online_epochs', type=int, default=2,
+                        help='Final passes of the online consolidation')
+    args = parser.parse_args()
+
+    run(args.n_runs, args.run_time, online_epochs=args.online_epochs)
@@ -0,0 +1,74 @@
+"""Benchmark the fused training forward/backward and penalty of
+`cogspaces.modules.linear.DropoutLinear` against the unfused reference,
+for every dropout `level`.
+
+Shapes default to the embedder of the reduced models (453 -> 128)."""
+
+import argparse
+import time
+
+import torch
+from torch.nn import functional as F
+
+from cogspaces.modules.linear import DropoutLinear, k1, k2, k3
+
+
+def reference_penalty(linear):
+    log_alpha = linear.get_log_alpha()
+    return - k1 * (torch.sigmoid(k2 + k3 * log_alpha)
+                   - .5 * F.softplus(-log_alpha)
+                   - 1).expand(*linear.weight.shape).sum() \
+        * linear.var_penalty
+
+
+def timeit(func, n_iter):
+    func()
+    t0 = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    return (time.perf_counter() - t0) / n_iter
+
+
+def run(in_features=453, out_features=128, batch_size=128, n_iter=200):
+    input = torch.randn(batch_size, in_features)
+    print('%-9s %-9s %16s %16s' % ('level', 'path', 'fwd+bwd (us)',
+                                   'penalty (us)'))
+    for level in ['layer', 'atom', 'coef', 'additive']:
+        linear = DropoutLinear(in_features, out_features, p=0.25,
+                               level=level, adaptive=True,
+                               var_penalty=1e-3)
+        linear.train()
+
+        def step(forward):
+            linear.zero_grad()
+            output = forward(input)
+            loss = output.sum()
+            if level != 'additive':
+                loss = loss + linear.penalty()
+            loss.backward()
+
+        paths = [('reference', linear._forward_reference,
+                  lambda: reference_penalty(linear).backward()),
+                 ('fused', linear.forward,
+                  lambda: linear.penalty().backward())]
+        for name, forward, penalty in paths:
+            forward_time = timeit(lambda: step(forward), n_iter)
+            if level == 'additive':
+                # log_alpha is not used by additive dropout
+                penalty_time = float('nan')
+            else:
+                penalty_time = timeit(penalty, n_iter)
+            print('%-9s %-9s %16.1f %16.1f' % (level, name,
+                                               forward_time * 1e6,
+                                               penalty_time * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-b', '--batch_size', type=int, default=128,
+                        help='Batch size')
+    parser.add_argument('-n', '--n_iter', type=int, default=200,
+                        help='Number of timed iterations')
+    args = parser.parse_args()
+
+    run(batch_size=args.batch_size, n_iter=args.n_iter)
@@ -0,0 +1,65 @@
+"""Benchmark the engines of `EnsembleClassifier`: runs fitted one by one
+('joblib'), or stacked and trained together with batched matrix products
+('batched').
+
+Reports the wall time of the runs and their mean train accuracy, on a
+single core. Synthetic data mimics the reduced loadings: 35 studies of 453
+features."""
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from cogspaces.classification.ensemble import _SharedData, _compute_coefs, \
+    _compute_coefs_batched
+from cogspaces.classification.multi_study import MultiStudyClassifier
+from head_solvers import make_data
+
+
+def accuracy(X, y, full_coefs, full_biases):
+    return np.mean([np.mean(np.argmax(X[study].dot(full_coefs[study].numpy())
+                                      + full_biases[study].numpy(), axis=1)
+                            == y[study]['contrast'].values)
+                    for study in X])
+
+
+def run(n_runs=16, max_iter=20):
+    torch.set_num_threads(1)
+    X, y = make_data()
+    estimator = MultiStudyClassifier(
+        latent_size=128, latent_dropout=0.75, input_dropout=0.25,
+        init='orthogonal', head_solver='lbfgs', verbose=0,
+        max_iter={'pretrain': max_iter, 'train': max_iter,
+                  'finetune': max_iter})
+    seeds = list(range(n_runs))
+    with tempfile.TemporaryDirectory() as folder:
+        data = _SharedData(X, y, folder)
+        t0 = time.perf_counter()
+        res = [_compute_coefs(estimator, data, data.fingerprint, seed)
+               for seed in seeds]
+        timings = {'joblib': (time.perf_counter() - t0, res)}
+        t0 = time.perf_counter()
+        res = _compute_coefs_batched(estimator, data, data.fingerprint,
+                                     seeds)
+        timings['batched'] = (time.perf_counter() - t0, res)
+    print('%-10s %10s %10s' % ('engine', 'time (s)', 'accuracy'))
+    for engine, (elapsed, res) in timings.items():
+        print('%-10s %10.2f %10.4f'
+              % (engine, elapsed, np.mean([accuracy(X, y, full_coef,
+                                                    full_bias)
+                                           for _, full_coef, full_bias
+                                           in res])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--n_runs', type=int, default=16,
+                        help='Number of runs')
+    parser.add_argument('-n', '--max_iter', type=int, default=20,
+                        help='Maximum number of epochs per phase')
+    args = parser.parse_args()
+
+    run(args.n_runs, args.max_iter)
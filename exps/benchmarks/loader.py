@@ -0,0 +1,76 @@
+"""Benchmark the engines of `cogspaces.input_data.MultiStudyLoader`.
+
+Synthetic data mimics the reduced loadings: 35 studies of 453 features."""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from cogspaces.input_data import MultiStudyLoader, _get_study_iter
+
+
+def make_data(n_studies=35, n_features=453, seed=0):
+    random_state = np.random.RandomState(seed)
+    data = {}
+    for i in range(n_studies):
+        n_samples = random_state.randint(50, 2000)
+        X = torch.from_numpy(
+            random_state.randn(n_samples, n_features).astype(np.float32))
+        y = torch.from_numpy(random_state.randint(0, 10, size=n_samples))
+        data['study_%i' % i] = TensorDataset(X, y)
+    return data
+
+
+def bench(data, engine, sampling, n_steps, batch_size):
+    lengths = {study: len(this_data) for study, this_data in data.items()}
+    total = sum(lengths.values())
+    study_weights = {study: length / total
+                     for study, length in lengths.items()}
+    loader = MultiStudyLoader(data, batch_size=batch_size, sampling=sampling,
+                              study_weights=study_weights, seed=0,
+                              engine=engine)
+    loader_iter = iter(loader)
+    next(loader_iter)
+    t0 = time.perf_counter()
+    for _ in range(n_steps):
+        next(loader_iter)
+    return (time.perf_counter() - t0) / n_steps
+
+
+def bench_sampler(data, sampling, n_steps):
+    studies = list(data.keys())
+    study_weights = {study: len(this_data)
+                     for study, this_data in data.items()}
+    study_iter = _get_study_iter(studies, sampling, study_weights, seed=0)
+    t0 = time.perf_counter()
+    for _ in range(n_steps):
+        next(study_iter)
+    return (time.perf_counter() - t0) / n_steps
+
+
+def run(n_steps=2000, batch_size=128):
+    data = make_data()
+    print('%-18s %15s' % ('study sampling', 'time/step (us)'))
+    for sampling in ['random', 'stratified-block', 'cycle']:
+        timing = bench_sampler(data, sampling, n_steps * 10)
+        print('%-18s %15.2f' % (sampling, timing * 1e6))
+    print('%-10s %-8s %15s' % ('sampling', 'engine', 'time/step (us)'))
+    for sampling in ['random', 'all']:
+        this_n_steps = n_steps if sampling == 'random' else n_steps // 35
+        for engine in ['torch', 'indexed']:
+            timing = bench(data, engine, sampling, this_n_steps, batch_size)
+            print('%-10s %-8s %15.1f' % (sampling, engine, timing * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n_steps', type=int, default=2000,
+                        help='Number of loader steps to time')
+    parser.add_argument('-b', '--batch_size', type=int, default=128,
+                        help='Batch size')
+    args = parser.parse_args()
+
+    run(args.n_steps, args.batch_size)
@@ -0,0 +1,60 @@
+"""Benchmark the least-squares reduction of masked maps on an atlas with
+`cogspaces.projection.AtlasProjector`, against `np.linalg.lstsq` on each
+batch as `exps/reduce.py` used to do, and against plain dot products.
+
+Components are random sparse maps of the `components_453_gm` shapes."""
+
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from cogspaces.projection import AtlasProjector
+
+
+def make_data(n_samples, n_features=212445, n_components=453,
+              density=0.02):
+    rng = np.random.RandomState(0)
+    components = sp.random(n_components, n_features, density=density,
+                           random_state=0, dtype=np.float32).toarray()
+    X = rng.randn(n_samples, n_features).astype(np.float32)
+    return components, X
+
+
+def run(n_samples=512, density=0.02, batch_size=256):
+    components, X = make_data(n_samples, density=density)
+
+    t0 = time.perf_counter()
+    for start in range(0, n_samples, batch_size):
+        batch = X[start:start + batch_size]
+        np.linalg.lstsq(components.T, batch.T, rcond=None)
+    print('Batch lstsq: %.2f s' % (time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    for start in range(0, n_samples, batch_size):
+        X[start:start + batch_size].dot(components.T)
+    print('Dense dot: %.2f s' % (time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    projector = AtlasProjector(components)
+    print('Factorization: %.2f s' % (time.perf_counter() - t0))
+    for method in ['dot', 'lstsq']:
+        t0 = time.perf_counter()
+        projector.transform(X, method=method, block_size=batch_size)
+        print('Projector, %s: %.2f s'
+              % (method, time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n_samples', type=int, default=512,
+                        help='Number of maps to reduce')
+    parser.add_argument('-d', '--density', type=float, default=0.02,
+                        help='Density of the components')
+    parser.add_argument('-b', '--batch_size', type=int, default=256,
+                        help='Number of maps reduced at once')
+    args = parser.parse_args()
+
+    run(n_samples=args.n_samples, density=args.density,
+        batch_size=args.batch_size)
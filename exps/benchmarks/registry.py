@@ -0,0 +1,81 @@
+"""Benchmark seed-averaged predictions of `cogspaces.registry.ModelRegistry`
+against loading each pickled estimator and predicting seed by seed.
+
+Models are untrained modules of the reduced-loadings shapes (35 studies of
+453 features, 128 latent units), written as `exps/train.py` does."""
+
+import argparse
+import os
+import tempfile
+import time
+from os.path import join
+
+import numpy as np
+import pandas as pd
+import torch
+from joblib import dump, load
+
+from cogspaces.classification.multi_study import MultiStudyClassifier
+from cogspaces.modules.factored import VarMultiStudyModule
+from cogspaces.preprocessing import MultiTargetEncoder
+from cogspaces.registry import ModelRegistry
+
+
+def make_output_dir(output_dir, n_seeds, n_studies=35, n_features=453):
+    target_sizes = {'study_%i' % i: 10 for i in range(n_studies)}
+    targets = {study: pd.DataFrame(dict(
+        contrast=['contrast_%i' % i for i in range(n_targets)], subject=0,
+        study=study, study_contrast=0))
+        for study, n_targets in target_sizes.items()}
+    target_encoder = MultiTargetEncoder().fit(targets)
+    for seed in range(n_seeds):
+        torch.manual_seed(seed)
+        estimator = MultiStudyClassifier()
+        estimator.module_ = VarMultiStudyModule(
+            n_features, 128, target_sizes,
+            lengths={study: 1 for study in target_sizes})
+        estimator.n_features_in_ = n_features
+        model_dir = join(output_dir, 'multi_study', str(seed))
+        os.makedirs(model_dir)
+        dump(estimator, join(model_dir, 'estimator.pkl'))
+        estimator.save(join(model_dir, 'estimator.cogspaces'))
+        dump(target_encoder, join(model_dir, 'target_encoder.pkl'))
+
+
+def seed_by_seed(output_dir, X):
+    probas = []
+    for seed in os.listdir(join(output_dir, 'multi_study')):
+        estimator = load(join(output_dir, 'multi_study', seed,
+                              'estimator.pkl'))
+        probas.append({study: np.exp(pred) for study, pred in
+                       estimator.predict_log_proba(X).items()})
+    return {study: np.mean([proba[study] for proba in probas], axis=0)
+            for study in X}
+
+
+def run(n_seeds=20, n_samples=100):
+    X = {'study_0': np.random.RandomState(0).randn(n_samples, 453)}
+    with tempfile.TemporaryDirectory() as output_dir:
+        make_output_dir(output_dir, n_seeds)
+
+        t0 = time.perf_counter()
+        seed_by_seed(output_dir, X)
+        print('Seed by seed: %.1f ms' % ((time.perf_counter() - t0) * 1e3))
+
+        registry = ModelRegistry(output_dir)
+        for name in ['cold', 'warm']:
+            t0 = time.perf_counter()
+            registry.predict(X)
+            print('Registry, %s: %.1f ms'
+                  % (name, (time.perf_counter() - t0) * 1e3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--n_seeds', type=int, default=20,
+                        help='Number of seeds')
+    parser.add_argument('-n', '--n_samples', type=int, default=100,
+                        help='Number of maps to decode')
+    args = parser.parse_args()
+
+    run(n_seeds=args.n_seeds, n_samples=args.n_samples)
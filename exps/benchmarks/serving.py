@@ -0,0 +1,131 @@
+"""Load-generate the local decoding server of `cogspaces.serving`.
+
+Concurrent clients send single maps to a model trained on synthetic data
+(35 studies of 453 features), with and without micro-batching. Reports the
+p50/p99 latency and the throughput of each configuration, and the latency
+of `MultiStudyClassifier.predict` on a single map for reference."""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import tempfile
+import threading
+import time
+from os.path import join
+
+import numpy as np
+import pandas as pd
+from joblib import dump
+
+from cogspaces.classification.multi_study import MultiStudyClassifier
+from cogspaces.preprocessing import MultiTargetEncoder
+from cogspaces.serving import DecodingModel, DecodingServer
+
+
+def make_artifacts(output_dir, n_studies=35, n_features=453, seed=0):
+    random_state = np.random.RandomState(seed)
+    X, y = {}, {}
+    for i in range(n_studies):
+        study = 'study_%i' % i
+        n_samples = random_state.randint(50, 500)
+        contrasts = random_state.randint(0, 10, size=n_samples)
+        X[study] = random_state.randn(n_samples, n_features)
+        y[study] = pd.DataFrame(dict(
+            contrast=['contrast_%i' % contrast for contrast in contrasts],
+            subject=0, study=study, study_contrast=['%s_%i' % (study, c)
+                                                    for c in contrasts]))
+    target_encoder = MultiTargetEncoder().fit(y)
+    estimator = MultiStudyClassifier(latent_size=128, head_solver='lbfgs',
+                                     max_iter={'pretrain': 10, 'train': 10,
+                                               'finetune': 10}, seed=0)
+    estimator.fit(X, target_encoder.transform(y))
+    dump(estimator, join(output_dir, 'estimator.pkl'))
+    dump(target_encoder, join(output_dir, 'target_encoder.pkl'))
+    return estimator, X
+
+
+def client(port, maps, study, duration):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    end = time.perf_counter() + duration
+    latencies = []
+    i = 0
+    while time.perf_counter() < end:
+        body = json.dumps({'study': study,
+                           'maps': [maps[i % len(maps)].tolist()]})
+        t0 = time.perf_counter()
+        connection.request('POST', '/predict', body)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - t0)
+        i += 1
+    connection.close()
+    return latencies
+
+
+def bench(model, X, n_clients, duration, max_latency, max_batch_size):
+    decoding_server = DecodingServer({'model': model},
+                                     max_latency=max_latency,
+                                     max_batch_size=max_batch_size)
+    http_server = decoding_server.make_http_server(port=0)
+    port = http_server.server_address[1]
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+
+    # Clients run in separate processes to leave the GIL to the server
+    studies = list(X.keys())
+    with multiprocessing.Pool(n_clients) as pool:
+        t0 = time.perf_counter()
+        latencies = pool.starmap(client, [
+            (port, X[studies[i % 2]][:100], studies[i % 2], duration)
+            for i in range(n_clients)])
+        elapsed = time.perf_counter() - t0
+
+    http_server.shutdown()
+    http_server.server_close()
+    decoding_server.close()
+    latencies = np.concatenate(latencies)
+    return (np.percentile(latencies, 50), np.percentile(latencies, 99),
+            len(latencies) / elapsed)
+
+
+def run(n_clients=16, duration=5, max_latency=0.002, max_batch_size=64):
+    with tempfile.TemporaryDirectory() as output_dir:
+        estimator, X = make_artifacts(output_dir)
+        model = DecodingModel.from_dir(output_dir)
+
+    study = next(iter(X))
+    this_X = {study: X[study][:1]}
+    estimator.predict(this_X)
+    n_iter = 100
+    t0 = time.perf_counter()
+    for _ in range(n_iter):
+        estimator.predict(this_X)
+    print('MultiStudyClassifier.predict, one map: %.3f ms'
+          % ((time.perf_counter() - t0) / n_iter * 1e3))
+
+    print('%-10s %10s %10s %14s' % ('batching', 'p50 (ms)', 'p99 (ms)',
+                                    'throughput (/s)'))
+    for name, this_max_latency, this_max_batch_size in [
+            ('none', 0., 1), ('micro', max_latency, max_batch_size)]:
+        p50, p99, throughput = bench(model, X, n_clients, duration,
+                                     this_max_latency, this_max_batch_size)
+        print('%-10s %10.3f %10.3f %14.1f' % (name, p50 * 1e3, p99 * 1e3,
+                                              throughput))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--n_clients', type=int, default=16,
+                        help='Number of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=5,
+                        help='Duration of each run, in seconds')
+    parser.add_argument('-l', '--max_latency', type=float, default=2,
+                        help='Maximum batching delay, in milliseconds')
+    parser.add_argument('-b', '--max_batch_size', type=int, default=64,
+                        help='Maximum number of maps per batch')
+    args = parser.parse_args()
+
+    run(n_clients=args.n_clients, duration=args.duration,
+        max_latency=args.max_latency / 1000,
+        max_batch_size=args.max_batch_size)
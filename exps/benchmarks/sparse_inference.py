@@ -0,0 +1,63 @@
+"""Benchmark eval-mode inference of `DropoutLinear` after `compile_sparse`,
+for various weight densities, against the masked dense path.
+
+'coef' prunes individual weights, 'atom' prunes whole input atoms (whose
+columns are dropped at compile time)."""
+
+import argparse
+import time
+
+import torch
+
+from cogspaces.modules.linear import DropoutLinear
+
+
+def make_linear(in_features, out_features, level, density):
+    linear = DropoutLinear(in_features, out_features, p=0.25, level=level,
+                           sparsify=True)
+    # log_alpha > 3 prunes the weights
+    log_alpha = torch.zeros(linear.log_alpha.shape)
+    log_alpha[torch.rand(log_alpha.shape) > density] = 8
+    linear.log_alpha.data = log_alpha
+    linear.eval()
+    return linear
+
+
+def timeit(func, n_iter):
+    func()
+    t0 = time.perf_counter()
+    for _ in range(n_iter):
+        func()
+    return (time.perf_counter() - t0) / n_iter
+
+
+def run(in_features=453, out_features=128, n_samples=10000, n_iter=10,
+        threshold=0.01):
+    input = torch.randn(n_samples, in_features)
+    print('%-6s %8s %12s %14s' % ('level', 'density', 'masked (ms)',
+                                  'compiled (ms)'))
+    for level in ['coef', 'atom']:
+        for density in [0.005, 0.01, 0.05, 0.1, 0.3]:
+            linear = make_linear(in_features, out_features, level, density)
+            with torch.no_grad():
+                linear.decompile_sparse()
+                masked_time = timeit(lambda: linear(input), n_iter)
+                linear.compile_sparse(threshold)
+                compiled_time = timeit(lambda: linear(input), n_iter)
+            print('%-6s %8.3f %12.2f %14.2f' % (level, linear.density,
+                                                masked_time * 1e3,
+                                                compiled_time * 1e3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--in_features', type=int, default=453,
+                        help='Number of input features')
+    parser.add_argument('-n', '--n_samples', type=int, default=10000,
+                        help='Number of maps to decode')
+    parser.add_argument('-t', '--threshold', type=float, default=0.01,
+                        help='Density threshold for the CSR format')
+    args = parser.parse_args()
+
+    run(in_features=args.in_features, n_samples=args.n_samples,
+        threshold=args.threshold)
@@ -1,89 +1,168 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from os.path import join
 from typing import List, Union
 
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed, dump, load
+from joblib import dump, effective_n_jobs
 from nilearn.input_data import NiftiMasker
 from sklearn.utils import gen_batches
 
 from cogspaces.datasets import fetch_mask, fetch_atlas_modl, \
     fetch_contrasts
+from cogspaces.datasets.chunked import PreallocatedStudy, chunked_studies, \
+    live_rows, load_chunked_study, plan_update, read_manifest
+from cogspaces.datasets.utils import hash_file
+from cogspaces.projection import AtlasProjector
 
 idx = pd.IndexSlice
 
 
-def single_mask(masker, imgs):
-    return masker.transform(imgs)
+# Masker of the worker process, built once by `_init_masker`
+_masker = None
 
 
-def single_reduce(components, data, lstsq=False):
-    if not lstsq:
-        return data.dot(components.T)
-    else:
-        X, _, _, _ = np.linalg.lstsq(components.T, data.T)
-        return X.T
+def _init_masker(mask_img, smoothing_fwhm):
+    global _masker
+    _masker = NiftiMasker(smoothing_fwhm=smoothing_fwhm, mask_img=mask_img,
+                          verbose=0, memory_level=1, memory=None).fit()
+
+
+def _mask_chunk(store, i, imgs, batch_size):
+    """Mask the images of the i-th chunk of a study, and write them in
+    place, `batch_size` images at a time."""
+    for batch in gen_batches(len(imgs), batch_size):
+        store.write(i, _masker.transform(list(imgs[batch])),
+                    offset=batch.start)
+    store.mark_done(i)
+    return len(imgs)
 
 
 def mask_contrasts(studies: Union[str, List[str]] ='all',
                    output_dir: str = 'masked',
-                   n_jobs: int = 1):
-    batch_size = 10
-
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    data = fetch_contrasts(studies)
+                   n_jobs: int = 1, dtype=np.float32, smoothing_fwhm=4,
+                   batch_size=10, chunk_size=None, fetch_mode='download_new'):
+    """
+    Smooth and mask contrast maps into a chunked store (see
+    `cogspaces.datasets.chunked`).
+
+    The store of each study is preallocated. Each worker process builds its
+    masker once, then loads, smooths and masks the images of one chunk at a
+    time, and writes them in place: neither the workers nor the main
+    process hold a full study. Chunks written before an interruption are
+    skipped when called again.
+
+    The manifest of each study records the file name and content hash of
+    each map, and the mask and smoothing used. Called again, only new or
+    changed maps are masked, and appended to the study. `fetch_mode` is
+    passed to `fetch_contrasts`.
+    """
+    data = fetch_contrasts(studies, mode=fetch_mode)
     mask = fetch_mask()
-    masker = NiftiMasker(smoothing_fwhm=4, mask_img=mask,
-                         verbose=0, memory_level=1, memory=None).fit()
+    n_features = int(np.count_nonzero(
+        NiftiMasker(mask_img=mask).fit().mask_img_.get_fdata()))
+    params = dict(mask=hash_file(mask), smoothing_fwhm=smoothing_fwhm,
+                  dtype=np.dtype(dtype).name)
 
+    jobs = {}
     for study, this_data in data.groupby('study'):
         imgs = this_data['z_map'].values
+        maps = [[os.path.basename(img), hash_file(img)] for img in imgs]
+        new, drop, append = plan_update(output_dir, study, maps, params)
+        if not new:
+            print('%s: up to date' % study)
+            continue
+        store = PreallocatedStudy(output_dir, study, len(new), n_features,
+                                  chunk_size=chunk_size, dtype=dtype,
+                                  params=params, append=append,
+                                  maps=[maps[i] for i in new])
         targets = this_data.reset_index()[['study', 'subject', 'contrast']]
-
-        n_samples = this_data.shape[0]
-        batches = list(gen_batches(n_samples, batch_size))
-        this_data = Parallel(n_jobs=n_jobs, verbose=10,
-                             backend='multiprocessing', mmap_mode='r')(
-            delayed(single_mask)(masker, imgs[batch]) for batch in batches)
-        this_data = np.concatenate(this_data, axis=0)
-
-        dump((this_data, targets), join(output_dir, 'data_%s.pt' % study))
+        jobs[study] = (store, imgs[new], targets.iloc[new], drop)
+    n_images = sum(store.chunks_[i]['n_samples']
+                   for store, *_ in jobs.values() for i in store.pending())
+
+    t0 = time.perf_counter()
+    n_done = 0
+    with ProcessPoolExecutor(effective_n_jobs(n_jobs),
+                             initializer=_init_masker,
+                             initargs=(mask, smoothing_fwhm)) as executor:
+        futures = {}
+        for study, (store, imgs, _, _) in jobs.items():
+            for i in store.pending():
+                future = executor.submit(_mask_chunk, store, i,
+                                         imgs[store.rows(i)], batch_size)
+                futures[future] = study
+        for future in as_completed(futures):
+            study = futures.pop(future)
+            n_done += future.result()
+            print('%s: %i/%i images, %.1f images/s'
+                  % (study, n_done, n_images,
+                     n_done / (time.perf_counter() - t0)))
+    for study, (store, _, targets, drop) in jobs.items():
+        store.close(targets, drop=drop)
 
 
 def reduce_contrasts(components: str = 'components_453_gm',
                      studies: Union[str, List[str]] = 'all',
                      masked_dir='unmasked', output_dir='reduced',
-                     n_jobs=1, lstsq=False, ):
-    batch_size = 200
-
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+                     lstsq=False, block_size=256):
+    """
+    Project masked contrasts on the components of the MODL atlas.
+
+    The projector (see `cogspaces.projection.AtlasProjector`) is factorized
+    once and cached next to the atlas, and masked contrasts are read from
+    the chunked store `block_size` maps at a time.
+
+    Loadings are kept in a chunked store, `output_dir/loadings`, with the
+    content hash of their maps and the atlas and masking parameters. Called
+    again, only the maps masked since are projected. `data_<study>.pt` is
+    then written from the store, as downloaded by `fetch_reduced_loadings`.
+    """
+    store_dir = join(output_dir, 'loadings')
+    os.makedirs(store_dir, exist_ok=True)
 
     modl_atlas = fetch_atlas_modl()
     mask = fetch_mask()
-    dictionary = modl_atlas[components]
-    masker = NiftiMasker(mask_img=mask).fit()
-    components = masker.transform(dictionary)
+    projector = AtlasProjector.from_atlas(modl_atlas[components], mask)
+    method = 'lstsq' if lstsq else 'dot'
+    atlas_hash = hash_file(modl_atlas[components])
+    if studies == 'all':
+        studies = chunked_studies(masked_dir)
     for study in studies:
-        this_data, targets = load(join(masked_dir, 'masked_%s.pt' % study))
-        n_samples = this_data.shape[0]
-        batches = list(gen_batches(n_samples, batch_size))
-        this_data = Parallel(n_jobs=n_jobs, verbose=10,
-                             backend='multiprocessing', mmap_mode='r')(
-            delayed(single_reduce)(components,
-                                   this_data[batch], lstsq=lstsq)
-            for batch in batches)
-        this_data = np.concatenate(this_data, axis=0)
-
-        dump((this_data, targets), join(output_dir,
-                                        'data_%s.pt' % study))
-
-
-mask_contrasts(studies=['archi'], output_dir='masked')
-
-reduce_contrasts(studies=['archi'],
-                 masked_dir='masked',
-                 output_dir='reduced',
-                 components='components_453_gm', n_jobs=2, lstsq=False)
+        manifest = read_manifest(masked_dir, study)
+        params = dict(atlas=atlas_hash, method=method,
+                      masking=manifest.get('params'))
+        this_data, targets = load_chunked_study(masked_dir, study)
+        if 'maps' in manifest:
+            maps = [manifest['maps'][row] for row in live_rows(manifest)]
+            new, drop, append = plan_update(store_dir, study, maps, params)
+        else:
+            maps, new, drop, append = None, list(range(len(this_data))), \
+                [], False
+        if new:
+            store = PreallocatedStudy(
+                store_dir, study, len(new), projector.n_components,
+                params=params, append=append,
+                maps=None if maps is None else [maps[i] for i in new])
+            new_data = this_data[new]
+            for i in store.pending():
+                store.write(i, projector.transform(new_data[store.rows(i)],
+                                                   method=method,
+                                                   block_size=block_size))
+                store.mark_done(i)
+            store.close(targets.iloc[new], drop=drop)
+        print('%s: %i new maps reduced' % (study, len(new)))
+        this_data, targets = load_chunked_study(store_dir, study)
+        dump((np.asarray(this_data), targets), join(output_dir,
+                                                    'data_%s.pt' % study))
+
+
+if __name__ == '__main__':
+    mask_contrasts(studies=['archi'], output_dir='masked')
+
+    reduce_contrasts(studies=['archi'],
+                     masked_dir='masked',
+                     output_dir='reduced',
+                     components='components_453_gm', lstsq=False)
@@ -14,6 +14,7 @@ from sklearn.metrics import accuracy_score
 from cogspaces.classification.ensemble import EnsembleClassifier
 from cogspaces.classification.logistic import MultiLogisticClassifier
 from cogspaces.classification.multi_study import MultiStudyClassifier
+from cogspaces.classification.run_cache import RunCache
 from cogspaces.datasets import STUDY_LIST, load_reduced_loadings
 from cogspaces.datasets.contrast import load_masked_contrasts
 from cogspaces.datasets.utils import get_output_dir
@@ -22,7 +23,7 @@ from cogspaces.preprocessing import MultiStandardScaler, MultiTargetEncoder
 from cogspaces.utils import compute_metrics, ScoreCallback, MultiCallback
 
 
-def run(estimator='multi_study', seed=0, plot=False, n_jobs=1):
+def run(estimator='multi_study', seed=0, plot=False, n_jobs=1, tol=None):
     # Parameters
     system = dict(
         verbose=1,
@@ -64,7 +65,11 @@ def run(estimator='multi_study', seed=0, plot=False, n_jobs=1):
             ensemble = dict(
                 seed=100,
                 n_runs=120,
-                alpha=1e-5, )
+                alpha=1e-5,
+                # Adaptive stopping is opt-in: the published results use
+                # all runs
+                tol=tol,
+                wave_size=10, )
             config['ensemble'] = ensemble
     else:
         logistic = dict(l2_penalty=np.logspace(-7, 0, 8).tolist(),
@@ -93,9 +98,11 @@ def run(estimator='multi_study', seed=0, plot=False, n_jobs=1):
         raise ValueError("Studies should be a list or 'all'")
 
     if data['reduced']:
-        input_data, target = load_reduced_loadings(data_dir=data['data_dir'])
+        input_data, target = load_reduced_loadings(data_dir=data['data_dir'],
+                                                   lazy=True)
     else:
-        input_data, target = load_masked_contrasts(data_dir=data['data_dir'])
+        input_data, target = load_masked_contrasts(data_dir=data['data_dir'],
+                                                   studies=studies)
 
     input_data = {study: input_data[study] for study in studies}
     target = {study: target[study] for study in studies}
@@ -121,10 +128,15 @@ def run(estimator='multi_study', seed=0, plot=False, n_jobs=1):
                                          n_jobs=system['n_jobs'],
                                          **multi_study)
         if model['estimator'] == 'ensemble':
-            memory = Memory(cachedir=None)
+            memory = Memory(location=None)
+            # Runs are shared by all seeds of the split and all values of
+            # the consolidation parameters
+            run_cache = RunCache(join(get_output_dir(system['output_dir']),
+                                      'run_cache'))
             estimator = EnsembleClassifier(estimator,
                                            n_jobs=system['n_jobs'],
                                            memory=memory,
+                                           run_cache=run_cache,
                                            **ensemble
                                            )
             callback = None
@@ -146,6 +158,9 @@ def run(estimator='multi_study', seed=0, plot=False, n_jobs=1):
 
     print("Training model")
     estimator.fit(train_data, train_targets, callback=callback)
+    if model['estimator'] == 'ensemble':
+        info['n_runs'] = estimator.n_runs_
+        info['convergence'] = estimator.convergence_
 
     print("Evaluating model")
     test_preds = estimator.predict(test_data)
@@ -158,6 +173,8 @@ def run(estimator='multi_study', seed=0, plot=False, n_jobs=1):
     if model['normalize']:
         dump(standard_scaler, join(output_dir, 'standard_scaler.pkl'))
     dump(estimator, join(output_dir, 'estimator.pkl'))
+    if hasattr(estimator, 'save'):
+        estimator.save(join(output_dir, 'estimator.cogspaces'))
     with open(join(output_dir, 'metrics.json'), 'w+') as f:
         json.dump(metrics, f)
     with open(join(output_dir, 'info.json'), 'w+') as f:
@@ -189,6 +206,9 @@ if __name__ == '__main__':
                         help='Plot the results (classification maps, cognitive components)')
     parser.add_argument('-j', '--n_jobs', type=int,
                         default=1, help='Number of CPUs to use')
+    parser.add_argument('-t', '--tol', type=float, default=None,
+                        help='Stop the ensemble once its averages change by'
+                             ' less than this, in waves of 10 runs')
     args = parser.parse_args()
 
-    run(args.estimator, args.seed, args.plot, args.n_jobs)
+    run(args.estimator, args.seed, args.plot, args.n_jobs, args.tol)